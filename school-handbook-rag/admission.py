@@ -0,0 +1,412 @@
+"""
+Admission control in front of the retrieval and generation pipeline.
+
+Every question that needs Gemini goes through three gates:
+
+    rate_limiter.acquire(session_id)                # per-session token bucket, else Rejected (429)
+    answer, shared = single_flight.do(key, work)    # identical questions in flight share one answer
+    with admission.acquire(INTERACTIVE, cost):      # global concurrency cap, else queued or Rejected (503)
+        ...
+
+At most `max_concurrent` questions are answered at once (match it to the
+upstream quota); the rest wait in a bounded priority queue. Waiting requests
+are ordered by a virtual start time: their arrival time, plus `batch_delay`
+for batch work and `delay_per_token` for each token of the question.
+Interactive questions overtake batch work and short questions overtake long
+ones, but a request is never passed by ones that arrive much later, so
+nothing starves. When the queue is full, a request that ranks ahead of the
+last waiter takes its place and the last one is shed; otherwise it is
+rejected at once. Rejections carry a Retry-After estimated from how long
+questions have recently held their slot.
+
+Queue depth, questions in flight, waits and rejections are exported on
+/metrics (rag_admission_*) and by `stats()` on /health; a request's wait is
+timed as its `admission` stage. Requests wait on their thread in the Flask
+app (`acquire`) and on the event loop in the ASGI app (`acquire_async`).
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, wait
+
+import metrics
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+REJECTION_MESSAGES = {
+    'rate_limited': "You're asking questions too quickly. Please wait a moment and try again.",
+    'busy': "The assistant is busy right now. Please try again in a moment.",
+}
+
+
+class Rejected(Exception):
+    """A request was not admitted; answer it with `status` (429 or 503) and Retry-After `retry_after` seconds"""
+
+    def __init__(self, reason: str, status: int, retry_after: float):
+        super().__init__(REJECTION_MESSAGES['rate_limited' if status == 429 else 'busy'])
+        self.reason = reason
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class SessionRateLimiter:
+    """Token buckets holding `burst` questions and refilled at `rate_per_minute`, one per session"""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_sessions: int = 10000):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.max_sessions = max_sessions
+        self._buckets = OrderedDict()  # session -> (tokens, last refill), least recently used first
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def acquire(self, session_id: str):
+        """Take a token for one of the session's questions; raises Rejected (429) if there is none"""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(session_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[session_id] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+            if not allowed:
+                self.limited += 1
+        if not allowed:
+            metrics.admission_rejections_total.inc(reason="rate_limited")
+            raise Rejected("rate_limited", 429, (1 - tokens) / self.rate)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rate_per_minute': round(self.rate * 60, 3),
+                'burst': self.burst,
+                'sessions': len(self._buckets),
+                'limited': self.limited,
+            }
+
+
+class Ticket:
+    """An admitted request's slot; released once, by `release()` or leaving the `with` block"""
+
+    def __init__(self, controller, priority: str):
+        self._controller = controller
+        self.priority = priority
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+    def hold(self, body):
+        """Keep the slot until a streamed response body is finished or closed (even if it is never iterated)"""
+        return _HeldAsyncBody(body, self) if hasattr(body, '__aiter__') else _HeldBody(body, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class _HeldBody:
+    """A response body that releases its ticket when exhausted or closed"""
+
+    def __init__(self, body, ticket: Ticket):
+        self.body = body
+        self.ticket = ticket
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.body)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.ticket.release()
+
+
+class _HeldAsyncBody:
+    """Async version of _HeldBody"""
+
+    def __init__(self, body, ticket: Ticket):
+        self.body = body
+        self.ticket = ticket
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.body.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self.body, 'aclose'):
+                await self.body.aclose()
+        finally:
+            self.ticket.release()
+
+
+class _Waiter:
+    __slots__ = ('rank', 'priority', 'enqueued', 'outcome', 'notify')
+
+    def __init__(self, rank: tuple, priority: str, notify):
+        self.rank = rank            # (virtual start, arrival order)
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.outcome = None         # "granted", "shed" or "timeout", decided under the controller's lock
+        self.notify = notify
+
+    def __lt__(self, other):
+        return self.rank < other.rank
+
+
+class AdmissionController:
+    """A concurrency cap with a bounded priority queue of waiting requests (see the module docstring)"""
+
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float, batch_delay: float = 30,
+                 delay_per_token: float = 0.01):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.batch_delay = batch_delay
+        self.delay_per_token = delay_per_token
+
+        self._lock = threading.Lock()
+        self._queue = []            # heap of _Waiter
+        self._order = itertools.count()
+        self.in_flight = 0
+        self.admitted = Counter()   # priority -> requests
+        self.rejected = Counter()   # reason -> requests
+        self.hold_seconds = None    # Moving average of how long a request holds its slot
+        self.max_wait_seconds = 0.0
+
+    def _rank(self, priority: str, cost: int) -> tuple:
+        delay = (self.batch_delay if priority == BATCH else 0) + self.delay_per_token * cost
+        return time.monotonic() + delay, next(self._order)
+
+    def _retry_after(self) -> float:
+        """Seconds until a slot is likely to be free for a request joining the back of the queue"""
+        hold = self.hold_seconds or 1.0
+        return hold * (len(self._queue) + 1) / self.max_concurrent
+
+    def _reject(self, reason: str) -> Rejected:
+        self.rejected[reason] += 1
+        metrics.admission_rejections_total.inc(reason=reason)
+        return Rejected(reason, 503, self._retry_after())
+
+    def _update_gauges(self):
+        metrics.admission_in_flight.set(self.in_flight)
+        metrics.admission_queue_depth.set(len(self._queue))
+
+    def _enter(self, priority: str, cost: int, notify):
+        """A ticket if a slot is free, else the queued waiter; raises Rejected if the queue is full"""
+        with self._lock:
+            if self.in_flight < self.max_concurrent and not self._queue:
+                self.in_flight += 1
+                self.admitted[priority] += 1
+                self._update_gauges()
+                metrics.admission_wait.observe(0.0, priority=priority)
+                return Ticket(self, priority), None
+            waiter = _Waiter(self._rank(priority, cost), priority, notify)
+            if len(self._queue) >= self.max_queue:
+                last = max(self._queue, default=None)
+                if last is None or last.rank < waiter.rank:
+                    raise self._reject("queue_full")
+                # The new request ranks ahead: shed the last waiter instead
+                self._queue.remove(last)
+                heapq.heapify(self._queue)
+                last.outcome = "shed"
+                last.notify()
+            heapq.heappush(self._queue, waiter)
+            self._update_gauges()
+            return None, waiter
+
+    def _settle(self, waiter: _Waiter, reason: str) -> Ticket:
+        """After waiting: the ticket if the waiter was granted a slot, else raise Rejected (removing it on timeout)"""
+        with self._lock:
+            if waiter.outcome is None:
+                waiter.outcome = reason
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                self._update_gauges()
+            if waiter.outcome != "granted":
+                raise self._reject(waiter.outcome)
+            self.admitted[waiter.priority] += 1
+            waited = time.monotonic() - waiter.enqueued
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        metrics.admission_wait.observe(waited, priority=waiter.priority)
+        metrics.observe_stage("admission", waited)
+        return Ticket(self, waiter.priority)
+
+    def _release(self, ticket: Ticket):
+        held = time.monotonic() - ticket.started
+        with self._lock:
+            self.hold_seconds = held if self.hold_seconds is None else 0.9 * self.hold_seconds + 0.1 * held
+            if self._queue:
+                # Hand the slot straight to the first waiter, so arrivals cannot take it first
+                waiter = heapq.heappop(self._queue)
+                waiter.outcome = "granted"
+                waiter.notify()
+            else:
+                self.in_flight -= 1
+            self._update_gauges()
+
+    def _timeout(self, priority: str, timeout) -> float:
+        """How long a request may wait: batch work waits as long as it takes, unless given a timeout"""
+        if timeout is not None:
+            return timeout
+        return None if priority == BATCH else self.max_wait
+
+    def acquire(self, priority: str = INTERACTIVE, cost: int = 0, timeout: float = None) -> Ticket:
+        """Wait for a slot (at most `timeout`, default max_wait); raises Rejected (503)"""
+        ready = threading.Event()
+        ticket, waiter = self._enter(priority, cost, ready.set)
+        if ticket is not None:
+            return ticket
+        ready.wait(self._timeout(priority, timeout))
+        return self._settle(waiter, "timeout")
+
+    async def acquire_async(self, priority: str = INTERACTIVE, cost: int = 0, timeout: float = None) -> Ticket:
+        """Async version of `acquire`: waits on the event loop"""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+        ticket, waiter = self._enter(priority, cost, notify)
+        if ticket is not None:
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), self._timeout(priority, timeout))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away: leave the queue, or give back a slot granted meanwhile
+            try:
+                self._settle(waiter, "cancelled").release()
+            except Rejected:
+                pass
+            raise
+        return self._settle(waiter, "timeout")
+
+    def stats(self) -> dict:
+        with self._lock:
+            waiting = Counter(waiter.priority for waiter in self._queue)
+            return {
+                'max_concurrent': self.max_concurrent,
+                'in_flight': self.in_flight,
+                'queue_depth': len(self._queue),
+                'max_queue': self.max_queue,
+                'waiting': dict(waiting),
+                'admitted': dict(self.admitted),
+                'rejected': dict(self.rejected),
+                'avg_hold_ms': round(self.hold_seconds * 1000, 1) if self.hold_seconds is not None else None,
+                'max_wait_ms': round(self.max_wait_seconds * 1000, 1),
+                'wait': metrics.admission_wait.snapshot(),
+            }
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time; callers asking for a key already in
+    flight wait for its result. A caller that gives up waiting gets Rejected (503).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.followers += 1
+                metrics.single_flight_total.inc(role="follower")
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+        metrics.single_flight_total.inc(role="leader")
+        return future, True
+
+    def _timed_out(self) -> Rejected:
+        with self._lock:
+            self.timeouts += 1
+        metrics.admission_rejections_total.inc(reason="single_flight_timeout")
+        # The leader's answer goes to the answer cache, so a retry is likely answered from it
+        return Rejected("single_flight_timeout", 503, 1)
+
+    def _finish(self, key, future: Future, result=None, error: BaseException = None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, timeout: float = None) -> tuple:
+        """(fn(), False), or (the in-flight call's result, True) if the key is already being computed"""
+        future, leader = self._join(key)
+        if not leader:
+            if not wait([future], timeout).done:
+                raise self._timed_out()
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result, False
+
+    async def do_async(self, key, make_coro, timeout: float = None) -> tuple:
+        """Async version of `do`: awaits make_coro() or the in-flight call"""
+        future, leader = self._join(key)
+        if not leader:
+            # Shielded: a follower that goes away must not cancel the leader's future
+            try:
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout), True
+            except asyncio.TimeoutError:
+                if future.done():
+                    return future.result(), True  # Finished just now, or the leader's own timeout
+                raise self._timed_out()
+        try:
+            result = await make_coro()
+        except asyncio.CancelledError:
+            self._finish(key, future, error=RuntimeError("The request answering this question was cancelled"))
+            raise
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._calls), 'leaders': self.leaders, 'followers': self.followers,
+                    'timeouts': self.timeouts}
@@ -0,0 +1,103 @@
+"""
+FAISS index construction for the handbook vectors.
+
+Index types:
+
+    flat      exact search, linear in corpus size (the original IndexFlatL2)
+    ivf-flat  inverted file: search only the `nprobe` closest of `nlist` clusters
+    ivf-pq    inverted file with product-quantized vectors (much smaller, approximate distances)
+    hnsw      graph search, tuned at query time with `efSearch`
+
+Metrics are "l2" (Euclidean) or "ip" (inner product). With "ip" the vectors
+are L2-normalized before indexing and searching, so scores are cosine
+similarities, which is what the embedding models are trained for.
+"""
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw")
+METRICS = ("l2", "ip")
+
+# FAISS warns below this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def _faiss_metric(metric: str):
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    return faiss.METRIC_INNER_PRODUCT if metric == "ip" else faiss.METRIC_L2
+
+
+def default_nlist(vector_count: int) -> int:
+    """About 4 * sqrt(n) clusters, limited so every cluster has enough training points"""
+    nlist = int(4 * math.sqrt(vector_count))
+    return max(1, min(nlist, vector_count // MIN_POINTS_PER_CENTROID))
+
+
+def factory_string(index_type: str, dimension: int, vector_count: int, nlist: int = None,
+                   pq_m: int = None, hnsw_m: int = 32) -> str:
+    """The faiss.index_factory description for an index type, sized for the corpus"""
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m}"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+
+    # Too few vectors to train the clustering: exact search is all that makes sense
+    if vector_count < 2 * MIN_POINTS_PER_CENTROID:
+        return "Flat"
+
+    nlist = min(nlist or default_nlist(vector_count), vector_count // MIN_POINTS_PER_CENTROID)
+    if index_type == "ivf-flat":
+        return f"IVF{nlist},Flat"
+
+    # ivf-pq: m sub-quantizers must divide the dimension (default: sub-vectors
+    # of at least 8 dimensions, at most 64 codes per vector); 8 bits per code
+    # needs 256 centroids per sub-quantizer, so small corpora get fewer bits
+    pq_m = pq_m or max(m for m in range(1, min(64, max(1, dimension // 8)) + 1) if dimension % m == 0)
+    nbits = min(8, int(math.log2(vector_count // MIN_POINTS_PER_CENTROID)))
+    return f"IVF{nlist},PQ{pq_m}x{nbits}"
+
+
+def create_index(vectors: np.ndarray, index_type: str = "flat", metric: str = "l2",
+                 nlist: int = None, pq_m: int = None, hnsw_m: int = 32) -> tuple:
+    """Train (if needed) and fill a FAISS index; returns (index, factory string)"""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if metric == "ip":
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+
+    description = factory_string(index_type, vectors.shape[1], vectors.shape[0], nlist, pq_m, hnsw_m)
+    index = faiss.index_factory(vectors.shape[1], description, _faiss_metric(metric))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index, description
+
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """Apply query-time knobs to the index types that have them"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if ef_search and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+
+def enable_reconstruction(index):
+    """Let IVF indexes return stored vectors by id (index.reconstruct_batch), which needs their direct map"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+
+
+def prepare_queries(query_matrix: np.ndarray, metric: str) -> np.ndarray:
+    """Normalize query vectors when the index uses cosine (inner product) scores"""
+    query_matrix = np.ascontiguousarray(query_matrix, dtype='float32')
+    if metric == "ip":
+        query_matrix = query_matrix.copy()
+        faiss.normalize_L2(query_matrix)
+    return query_matrix
@@ -0,0 +1,166 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(text: str) -> str:
+    """Normalize a question for exact-match cache lookups"""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+class SemanticAnswerCache:
+    """
+    Caches generated answers in front of the RAG pipeline.
+
+    Lookups happen in two steps:
+    1. An exact lookup on the normalized question text (no embedding needed).
+    2. A nearest-neighbour lookup over the embeddings of cached questions. If the
+       cosine similarity of the closest cached question is above
+       `similarity_threshold`, its answer is reused.
+
+    Entries are evicted least-recently-used first when either `max_entries` or
+    `max_bytes` is exceeded, and expire after `ttl_seconds`. The owner calls
+    `clear()` when it swaps in a rebuilt index, so answers never outlive the
+    index snapshot they were generated from.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 1000,
+                 ttl_seconds: float = 3600, max_bytes: int = 16 * 1024 * 1024):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # normalized question -> entry dict
+        self._matrix = None            # stacked unit vectors, rebuilt lazily
+        self._matrix_keys = []
+        self._total_bytes = 0
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # --- Invalidation -------------------------------------------------------
+
+    def _clear(self):
+        self._entries.clear()
+        self._matrix = None
+        self._matrix_keys = []
+        self._total_bytes = 0
+
+    def clear(self):
+        """Remove all cached answers"""
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    # --- Lookups ------------------------------------------------------------
+
+    def _is_expired(self, entry, now):
+        return self.ttl_seconds is not None and now - entry['created'] > self.ttl_seconds
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry['size']
+        self._matrix = None
+
+    def get_exact(self, question: str):
+        """Return the cached entry for the normalized question, if any"""
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._is_expired(entry, time.time()):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry
+
+    def get_similar(self, query_vector):
+        """Return the cached entry whose question embedding is closest to `query_vector`"""
+        vector = _unit_vector(query_vector)
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            if self._matrix is None:
+                self._matrix_keys = list(self._entries.keys())
+                self._matrix = np.vstack([self._entries[k]['vector'] for k in self._matrix_keys])
+
+            similarities = self._matrix @ vector
+            best = int(np.argmax(similarities))
+            key = self._matrix_keys[best]
+            entry = self._entries[key]
+
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            if self._is_expired(entry, time.time()):
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.semantic_hits += 1
+            return entry
+
+    # --- Insertion ----------------------------------------------------------
+
+    def put(self, question: str, query_vector, response: str, sources_info: list):
+        """Store an answer and evict old entries until the cache fits its limits"""
+        key = normalize_question(question)
+        vector = _unit_vector(query_vector)
+        size = (sys.getsizeof(response) + sys.getsizeof(key) + vector.nbytes
+                + sum(sys.getsizeof(str(info)) for info in sources_info))
+        entry = {
+            'response': response,
+            'sources_info': sources_info,
+            'vector': vector,
+            'created': time.time(),
+            'size': size,
+        }
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._total_bytes += size
+            self._matrix = None
+
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._total_bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """Counters for the /health endpoint"""
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+def _unit_vector(vector):
+    vector = np.asarray(vector, dtype='float32').reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
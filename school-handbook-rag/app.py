@@ -1,124 +1,1117 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
 import os
 import google.generativeai as genai
-import faiss
 import numpy as np
-import pickle
 import re
+import json
+import time
 from datetime import datetime
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+import upstream
+from admission import BATCH, INTERACTIVE, AdmissionController, Rejected, SessionRateLimiter, SingleFlight
+from answer_cache import SemanticAnswerCache, normalize_question
+from batch_answers import parse_questions, read_batch_request, unique_count, with_summary
+from context_packer import chunk_token_counts, pack_context
+from conversation import condense_prompt, format_turns, heuristic_rewrite, is_follow_up, new_terms, parse_condensed
+from micro_batcher import MicroBatcher
+from precomputed_answers import PrecomputedAnswers, append_query_log, question_catalog, top_logged_questions
+from ann_index import prepare_queries
+from chunk_store import estimate_tokens, parse_section_header
+from embedders import get_embedder
+from history_store import get_history_store
+from lexical_index import reciprocal_rank_fusion
+from index_snapshot import SnapshotReloader, load_snapshot
+from profiler import SamplingProfiler
+from reranker import CrossEncoderScorer, Reranker
+from tenants import Tenant, TenantError, TenantRegistry, read_tenant_settings
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'  # Change this in production
 
 # Configuration
 GEMINI_API_KEY = 'YOUR_API_KEY'  # Move to environment variable in production
+# Send Gemini requests to another server speaking the same REST API, e.g. the
+# stand-in in benchmarks/fake_gemini.py; unset uses Google's endpoint over gRPC
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT")
 EMBEDDING_MODEL_NAME = "models/text-embedding-004"
 GENERATION_MODEL_NAME = "gemini-2.0-flash-exp"  # For generating responses
 FAISS_INDEX_PATH = "school_handbook.faiss"
-CHUNKS_DATA_PATH = "school_handbook_chunks.pkl"
+CHUNKS_DATA_PATH = "school_handbook.chunks"   # Memory-mapped chunk store (see chunk_store.py)
+LEGACY_CHUNKS_PICKLE_PATH = "school_handbook_chunks.pkl"  # Read only if the chunk store is missing
+INDEX_METADATA_PATH = "school_handbook.meta.json"  # Records which embedder built the index
+LEXICAL_INDEX_PATH = "school_handbook.bm25.npz"    # BM25 keyword index (see lexical_index.py)
+FAISS_MMAP = True  # Memory-map the index read-only so worker processes share its pages
+
+# Index type and metric used by build_index.py: "flat", "ivf-flat", "ivf-pq" or
+# "hnsw"; "l2" distance or "ip" (cosine similarity on normalized vectors). The
+# app reads the type and metric from the index metadata. With "ip" the
+# "distance" reported for each source is a similarity: higher is closer.
+FAISS_INDEX_TYPE = "flat"
+FAISS_METRIC = "l2"
+# Search-time recall/latency knobs for approximate indexes (see benchmarks/ann.py)
+FAISS_NPROBE = 16       # IVF clusters searched per query
+FAISS_EF_SEARCH = 64    # HNSW candidate list size
+
+# Chunking limits used by build_index.py and ingest.py: chunks longer than
+# CHUNK_MAX_TOKENS (estimated) are split into pieces overlapping by
+# CHUNK_OVERLAP_TOKENS, each repeating its section header (see chunking.py).
+CHUNK_MAX_TOKENS = 800
+CHUNK_OVERLAP_TOKENS = 80
+INGEST_WORKERS = os.cpu_count() or 1  # Processes chunking documents in parallel
+
+# Embedding backend: "gemini" (text-embedding-004 API) or "local-hashing"
+# (in-process hashed TF-IDF, no network). Must match the backend the index was built with.
+EMBEDDING_BACKEND = "gemini"
+LOCAL_EMBEDDER_PATH = "school_handbook.embedder.npz"
+
+# Hybrid retrieval: the best HYBRID_CANDIDATES chunks from vector search and
+# from BM25 keyword search are fused with reciprocal rank fusion, so exact terms
+# ("Form 4.2", "PTO", email addresses) are found too. If the question cannot be
+# embedded, keyword search alone answers instead of returning no sources.
+HYBRID_RETRIEVAL = True
+HYBRID_CANDIDATES = 20
+RRF_K = 60
+
+# Section-aware retrieval: requests may pass `section` (a top-level section
+# number or title) to search only that section, and `expand` ("parent" or
+# "siblings") to add the enclosing or neighbouring sections of each hit.
+# Filtered vector searches fetch SECTION_FILTER_CANDIDATES neighbours and keep
+# those in the section.
+RETRIEVAL_EXPAND = None
+EXPAND_MAX_CHUNKS = 4
+SECTION_FILTER_CANDIDATES = 200
+
+# Context packing: retrieve CONTEXT_CANDIDATES chunks, drop near-duplicates and
+# greedily pack the best into CONTEXT_TOKEN_BUDGET prompt tokens, trimming a
+# chunk to its most relevant lines when it does not fit whole (and at least
+# CONTEXT_MIN_TRIM_TOKENS remain). Uses the token counts stored with the chunks.
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_CANDIDATES = 8
+CONTEXT_MIN_TRIM_TOKENS = 50
+CONTEXT_OVERLAP_THRESHOLD = 0.8
+
+# Reranking: retrieve a wider pool of RERANK_CANDIDATES chunks and keep the
+# RERANK_TOP_K picked by maximal marginal relevance over their stored vectors,
+# so near-duplicate sections do not crowd out the relevant one (see
+# reranker.py). With RERANK_CROSS_ENCODER_MODEL set (needs sentence-transformers)
+# a CPU cross-encoder scores relevance when it fits the RERANK_BUDGET_MS
+# budget; when the budget is spent the pool is used in first-stage order.
+RERANK_ENABLED = False
+RERANK_CANDIDATES = 20
+RERANK_TOP_K = 4
+RERANK_MMR_LAMBDA = 0.7
+RERANK_BUDGET_MS = 25
+RERANK_CROSS_ENCODER_MODEL = None  # e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Answer cache: reuse answers for questions that were already asked (or asked
+# in slightly different words) instead of calling the generation model again
+ANSWER_CACHE_SIMILARITY = 0.95      # Minimum cosine similarity for a semantic hit
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS = 6 * 60 * 60
+ANSWER_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Micro-batching: questions arriving within a few milliseconds of each other are
+# embedded in one API call and searched with one multi-row FAISS query
+QUERY_BATCHING_ENABLED = True
+QUERY_BATCH_MAX_SIZE = 32
+QUERY_BATCH_MAX_WAIT_MS = 5
+
+# Hot reload: the index artifacts are watched and a rebuilt index is loaded in
+# the background and swapped in without a restart. POST /admin/reload forces a
+# reload and requires the X-Admin-Token header to match ADMIN_TOKEN.
+INDEX_RELOAD_POLL_SECONDS = 5
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Precomputed answers (see precomputed_answers.py): the quick questions on the
+# main page and the PRECOMPUTE_TOP_QUERIES most frequent standalone questions
+# in QUERY_LOG_PATH are answered ahead of time for the current index version
+# and served from PRECOMPUTED_ANSWERS_PATH without embedding, search or
+# generation. When the index changes they are regenerated in the background by
+# the first worker to notice; `python precomputed_answers.py` (or build_index.py
+# --precompute-answers) does it up front. QUERY_LOG_PATH = None stops logging;
+# past QUERY_LOG_MAX_BYTES the log is rotated, keeping one previous generation,
+# so ranking it costs the same however much traffic the app has served.
+PRECOMPUTED_ANSWERS_ENABLED = True
+PRECOMPUTED_ANSWERS_PATH = "school_handbook.answers.json"
+PRECOMPUTE_TOP_QUERIES = 50
+QUERY_LOG_PATH = "query_log.txt"
+QUERY_LOG_MAX_BYTES = 4 * 1024 * 1024
+QUICK_QUESTIONS = [
+    # (Font Awesome icon, button label, question)
+    ('fa-bullseye', 'Mission & Vision', "What is the school's mission and vision?"),
+    ('fa-tshirt', 'Dress Code', 'Tell me about the dress code policy'),
+    ('fa-calendar-check', 'Attendance Policy', 'What are the attendance requirements?'),
+    ('fa-phone', 'Contact Information', 'How do I contact the school administration?'),
+    ('fa-shield-alt', 'Emergency Procedures', 'What are the emergency procedures?'),
+    ('fa-book', 'Academic Policies', 'Tell me about academic policies'),
+]
+
+# Multi-school serving (see tenants.py): a request naming a school ("school" in
+# the /ask body, ?school= on the other routes) is answered from that school's
+# handbook in TENANTS_DIR/<school>/ with its own name, prompt template and
+# quick questions (tenant.json). Schools are loaded on first use, and the least
+# recently used are unloaded when the loaded ones exceed
+# TENANT_MEMORY_BUDGET_BYTES. Requests without a school use the handbook in the
+# working directory, with SCHOOL_NAME and PROMPT_TEMPLATE.
+TENANTS_DIR = "tenants"
+TENANT_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024
+SCHOOL_NAME = "Pathways Academy"
+PROMPT_TEMPLATE = """You are a helpful assistant for {school_name}. Use the following information from the school handbook to answer the student's question accurately and helpfully.
 
-# Initialize Gemini
-genai.configure(api_key=GEMINI_API_KEY)
+CONTEXT FROM SCHOOL HANDBOOK:
+{context}
+{conversation}
+STUDENT QUESTION: {question}
 
-# Global variables for loaded data
-loaded_index = None
-loaded_chunks = []
+INSTRUCTIONS:
+- Answer based primarily on the provided context from the school handbook
+- Be clear, helpful, and student-friendly
+- If the context doesn't fully answer the question, mention what information is available and suggest contacting school administration for additional details
+- Use a warm, supportive tone appropriate for students and parents
+- Structure your response clearly with headings or bullet points when appropriate
+
+ANSWER:"""
+
+# Chat history is kept server-side, keyed by the session_id in the session
+# cookie: "memory" (per process), "sqlite" (shared by the workers on one host)
+# or "redis" (shared across hosts; needs the redis package). Each session keeps
+# its latest HISTORY_MAX_TURNS turns and expires after HISTORY_TTL_SECONDS idle.
+HISTORY_BACKEND = "memory"
+HISTORY_SQLITE_PATH = "chat_history.sqlite"
+HISTORY_REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+HISTORY_MAX_TURNS = 100
+HISTORY_MAX_SESSIONS = 10000   # memory backend only
+HISTORY_TTL_SECONDS = 7 * 24 * 60 * 60
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+# Conversational follow-ups (see conversation.py): a question that refers back
+# to the previous turn is rewritten into a standalone retrieval query, and the
+# last CONVERSATION_WINDOW turns go into the generation prompt with answers cut
+# to CONVERSATION_ANSWER_CHARS. Follow-ups without new terms reuse the previous
+# turn's retrieved chunks. Rewrites use one short generation call, or append the
+# follow-up to the previous query if CONVERSATION_REWRITE_WITH_MODEL is False.
+# Requests can opt out with "conversation": false.
+CONVERSATION_MODE = True
+CONVERSATION_WINDOW = 3
+CONVERSATION_ANSWER_CHARS = 600
+CONVERSATION_REWRITE_WITH_MODEL = True
+
+# Instrumentation (see metrics.py): each stage of answering a question is timed
+# into histograms exported on GET /metrics. With METRICS_RESPONSE_TIMING every
+# /ask response carries its per-stage timings; otherwise requests ask for them
+# with "timing": true. The sampling profiler is started and stopped at runtime
+# via /admin/profiler (requires ADMIN_TOKEN).
+METRICS_RESPONSE_TIMING = False
+PROFILER_INTERVAL_MS = 10
+
+# Upstream resilience (see upstream.py): Gemini calls are made in attempts with
+# a timeout each, retried with exponential backoff and jitter on transient
+# errors (timeouts, 429, 5xx), and never run past the request's deadline
+# (REQUEST_DEADLINE_SECONDS; for streamed answers, until the first token).
+# After UPSTREAM_BREAKER_FAILURES consecutive failures a call's circuit breaker
+# opens and calls fail fast for UPSTREAM_BREAKER_RESET_SECONDS: questions are
+# then answered by keyword search and the matched handbook sections instead
+# of a generated answer. Hedging sends a duplicate request when one is slower
+# than the recent p95 of its call; it is on for the cheap embedding calls only.
+REQUEST_DEADLINE_SECONDS = 30
+UPSTREAM_EMBED_TIMEOUT_SECONDS = 5
+UPSTREAM_GENERATION_TIMEOUT_SECONDS = 25
+UPSTREAM_MAX_ATTEMPTS = 3
+UPSTREAM_BACKOFF_BASE_SECONDS = 0.2
+UPSTREAM_BACKOFF_MAX_SECONDS = 2.0
+UPSTREAM_BREAKER_FAILURES = 5
+UPSTREAM_BREAKER_RESET_SECONDS = 30
+UPSTREAM_HEDGE_EMBEDDINGS = True
+UPSTREAM_HEDGE_GENERATION = False
+RETRIEVAL_ONLY_EXCERPT_CHARS = 500
+
+# Bulk answering (POST /ask/batch and batch_answers.py, admin only): duplicate
+# questions are answered once, questions are embedded BATCH_EMBED_SIZE per
+# call and searched together, and BATCH_CONCURRENCY answers are generated at
+# once. Batch calls to Gemini only start while fewer than UPSTREAM_BATCH_LIMIT
+# calls of their kind are in flight, so interactive questions never wait
+# behind a batch.
+BATCH_MAX_QUESTIONS = 1000
+BATCH_EMBED_SIZE = 100
+BATCH_CONCURRENCY = 4
+UPSTREAM_BATCH_LIMIT = 8
+
+# Admission control (see admission.py): at most ADMISSION_MAX_CONCURRENT
+# questions are retrieved and answered at once (match it to the Gemini
+# quota) and up to ADMISSION_MAX_QUEUE more wait, interactive questions
+# before batch ones and short before long, for at most
+# ADMISSION_MAX_WAIT_SECONDS. Questions beyond that are turned away with 503
+# and Retry-After, and a session asking more than SESSION_RATE_PER_MINUTE
+# questions (after a burst of SESSION_BURST) gets 429. Identical standalone
+# questions in flight at the same time are answered by one pipeline run.
+# Precomputed and exactly cached answers need no slot.
+ADMISSION_MAX_CONCURRENT = 16
+ADMISSION_MAX_QUEUE = 64
+ADMISSION_MAX_WAIT_SECONDS = 10
+ADMISSION_BATCH_DELAY_SECONDS = 30       # Batch questions queue as if they had arrived this much later
+ADMISSION_DELAY_PER_TOKEN_SECONDS = 0.01  # ...and so does each token of a question
+SESSION_RATE_PER_MINUTE = 20              # 0 turns the limit off
+SESSION_BURST = 5
+SINGLE_FLIGHT_ENABLED = True
+
+NO_CONTEXT_RESPONSE = "I couldn't find relevant information in the school handbook to answer your question. Please try rephrasing your question or contact the school administration directly."
+GENERATION_ERROR_RESPONSE = "I apologize, but I'm having trouble generating a response right now. Please try again later or contact the school directly."
+RETRIEVAL_ONLY_RESPONSE = "I can't generate an answer right now, but these sections of the school handbook match your question:"
+
+# Initialize Gemini
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
+
+# The loaded index, chunks and embedder. Replaced as a whole on reload; each
+# request reads it once so in-flight requests finish on the version they started with.
+current_snapshot = None
+
+history_store = get_history_store(
+    HISTORY_BACKEND,
+    max_turns=HISTORY_MAX_TURNS,
+    ttl_seconds=HISTORY_TTL_SECONDS,
+    max_sessions=HISTORY_MAX_SESSIONS,
+    sqlite_path=HISTORY_SQLITE_PATH,
+    redis_url=HISTORY_REDIS_URL,
+)
+
+profiler = SamplingProfiler(interval_ms=PROFILER_INTERVAL_MS)
+
+embedding_client = upstream.UpstreamClient(
+    "embed",
+    timeout=UPSTREAM_EMBED_TIMEOUT_SECONDS,
+    max_attempts=UPSTREAM_MAX_ATTEMPTS,
+    backoff_base=UPSTREAM_BACKOFF_BASE_SECONDS,
+    backoff_max=UPSTREAM_BACKOFF_MAX_SECONDS,
+    breaker=upstream.CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET_SECONDS),
+    hedge=UPSTREAM_HEDGE_EMBEDDINGS,
+    batch_limit=UPSTREAM_BATCH_LIMIT,
+)
+generation_client = upstream.UpstreamClient(
+    "generate",
+    timeout=UPSTREAM_GENERATION_TIMEOUT_SECONDS,
+    max_attempts=UPSTREAM_MAX_ATTEMPTS,
+    backoff_base=UPSTREAM_BACKOFF_BASE_SECONDS,
+    backoff_max=UPSTREAM_BACKOFF_MAX_SECONDS,
+    breaker=upstream.CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET_SECONDS),
+    hedge=UPSTREAM_HEDGE_GENERATION,
+    batch_limit=UPSTREAM_BATCH_LIMIT,
+)
+
+admission = AdmissionController(
+    ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT_SECONDS,
+    batch_delay=ADMISSION_BATCH_DELAY_SECONDS,
+    delay_per_token=ADMISSION_DELAY_PER_TOKEN_SECONDS,
+)
+rate_limiter = SessionRateLimiter(SESSION_RATE_PER_MINUTE, SESSION_BURST, max_sessions=HISTORY_MAX_SESSIONS)
+single_flight = SingleFlight()
+
+def new_answer_cache() -> SemanticAnswerCache:
+    """An empty answer cache; each school has its own"""
+    return SemanticAnswerCache(
+        similarity_threshold=ANSWER_CACHE_SIMILARITY,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+        max_bytes=ANSWER_CACHE_MAX_BYTES,
+    )
+
+answer_cache = new_answer_cache()
+
+_shared_embedder = None
+
+def make_embedder(directory: str = ""):
+    """The configured embedder; the stateless Gemini embedder is shared so all schools' questions batch together"""
+    global _shared_embedder
+    if EMBEDDING_BACKEND != "gemini":
+        return get_embedder(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, os.path.join(directory, LOCAL_EMBEDDER_PATH))
+    if _shared_embedder is None:
+        _shared_embedder = get_embedder(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME)
+    return _shared_embedder
+
+def artifact_paths(directory: str = "") -> list:
+    """The index artifacts of the handbook in `directory`, as watched for changes"""
+    return [os.path.join(directory, path) for path in
+            (FAISS_INDEX_PATH, CHUNKS_DATA_PATH, INDEX_METADATA_PATH, LOCAL_EMBEDDER_PATH, LEXICAL_INDEX_PATH)]
+
+def load_index_snapshot(directory: str = ""):
+    """Load the index artifacts in `directory` (default: the working directory) with the configured embedder"""
+    chunks_path = os.path.join(directory, CHUNKS_DATA_PATH)
+    legacy_path = os.path.join(directory, LEGACY_CHUNKS_PICKLE_PATH)
+    if not os.path.exists(chunks_path) and os.path.exists(legacy_path):
+        chunks_path = legacy_path
+    return load_snapshot(
+        os.path.join(directory, FAISS_INDEX_PATH), chunks_path, os.path.join(directory, INDEX_METADATA_PATH),
+        lambda: make_embedder(directory),
+        lexical_path=os.path.join(directory, LEXICAL_INDEX_PATH),
+        mmap_index=FAISS_MMAP,
+        nprobe=FAISS_NPROBE,
+        ef_search=FAISS_EF_SEARCH,
+        reconstruct=RERANK_ENABLED
+    )
+
+def swap_snapshot(snapshot):
+    """Serve a newly loaded snapshot of the default handbook; answers cached from the old one are dropped"""
+    global current_snapshot
+    current_snapshot = snapshot
+    default_tenant.snapshot = snapshot
+    answer_cache.clear()
+    print(f"✅ Loaded FAISS index version {snapshot.version} with {snapshot.index.ntotal} vectors and {len(snapshot.chunks)} chunks")
+
+index_reloader = SnapshotReloader(
+    artifact_paths(),
+    load_index_snapshot,
+    swap_snapshot,
+    poll_seconds=INDEX_RELOAD_POLL_SECONDS,
+)
 
 def load_rag_data():
     """Load FAISS index and chunks data"""
-    global loaded_index, loaded_chunks
-    try:
-        loaded_index = faiss.read_index(FAISS_INDEX_PATH)
-        with open(CHUNKS_DATA_PATH, "rb") as f:
-            loaded_chunks = pickle.load(f)
-        print(f"✅ Loaded FAISS index with {loaded_index.ntotal} vectors and {len(loaded_chunks)} chunks")
-        return True
-    except Exception as e:
-        print(f"❌ Error loading RAG data: {e}")
-        return False
+    return index_reloader.reload()
+
+def embed_queries(queries: list):
+    """Embed several (embedder, user_prompt) pairs, one call per embedder"""
+    vectors = [None] * len(queries)
+    by_embedder = {}
+    for i, (query_embedder, _) in enumerate(queries):
+        by_embedder.setdefault(id(query_embedder), (query_embedder, []))[1].append(i)
+    for query_embedder, positions in by_embedder.values():
+        texts = [queries[i][1] for i in positions]
+        if query_embedder.remote:
+            batch_vectors = embedding_client.call(query_embedder.embed_queries, texts)
+        else:
+            batch_vectors = query_embedder.embed_queries(texts)
+        for i, vector in zip(positions, batch_vectors):
+            vectors[i] = vector
+    return vectors
+
+def search_index_batch(queries: list):
+    """Search the FAISS index for several (snapshot, query_vector, top_k) triples, one search per snapshot"""
+    results = [None] * len(queries)
+    by_snapshot = {}
+    for i, (snapshot, _, _) in enumerate(queries):
+        by_snapshot.setdefault(id(snapshot), (snapshot, []))[1].append(i)
+    for snapshot, positions in by_snapshot.values():
+        query_matrix = prepare_queries(np.vstack([queries[i][1].reshape(1, -1) for i in positions]), snapshot.metric)
+        max_k = max(queries[i][2] for i in positions)
+        distances, indices = snapshot.index.search(query_matrix, max_k)
+        for row, i in enumerate(positions):
+            top_k = queries[i][2]
+            results[i] = (distances[row, :top_k], indices[row, :top_k])
+    return results
+
+embedding_batcher = MicroBatcher(
+    embed_queries,
+    max_batch_size=QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=QUERY_BATCH_MAX_WAIT_MS,
+    name="embed-batch",
+)
+search_batcher = MicroBatcher(
+    search_index_batch,
+    max_batch_size=QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=QUERY_BATCH_MAX_WAIT_MS,
+    max_concurrent_batches=1,
+    name="search-batch",
+)
+
+def embed_query(user_prompt: str, snapshot=None):
+    """Embed a user question for retrieval"""
+    query = ((snapshot or current_snapshot).embedder, user_prompt)
+    with metrics.stage("embed"):
+        if QUERY_BATCHING_ENABLED:
+            # The batch is embedded on the batcher's thread, under the tightest deadline of its callers
+            return embedding_batcher.submit(query, timeout=upstream.remaining())
+        return embed_queries([query])[0]
+
+def section_mask(snapshot, section):
+    """Boolean mask of the chunks in a top-level section, or None to search everything"""
+    if not section:
+        return None
+    return snapshot.chunks.top_level_mask(section)
+
+def parse_retrieval_options(data: dict, snapshot):
+    """Validated (section, expand) retrieval options from a request body; raises ValueError"""
+    section = str(data.get('section') or '').strip() or None
+    expand = data.get('expand', RETRIEVAL_EXPAND) or None
+    if expand not in (None, 'parent', 'siblings'):
+        raise ValueError("expand must be 'parent' or 'siblings'")
+    if section is not None:
+        if snapshot is None or not hasattr(snapshot.chunks, 'top_level_mask'):
+            raise ValueError("Section filters need the chunk store")
+        try:
+            section_mask(snapshot, section)
+        except KeyError:
+            raise ValueError(f"Unknown section: {section}")
+    return section, expand
+
+def search_vectors(query_vector, top_k: int, snapshot, allowed=None, vector_hits=None):
+    """Nearest neighbours of an embedded question as (distances, indices), optionally only `allowed` chunks.
+
+    `vector_hits` are the question's (distances, indices) from an earlier, wider search, used instead of searching.
+    """
+    if vector_hits is not None and allowed is None:
+        return vector_hits[0][:top_k], vector_hits[1][:top_k]
+    k = top_k if allowed is None else min(snapshot.index.ntotal, max(top_k, SECTION_FILTER_CANDIDATES))
+    query = (snapshot, query_vector, k)
+    with metrics.stage("vector_search"):
+        if QUERY_BATCHING_ENABLED:
+            distances, indices = search_batcher.submit(query)
+        else:
+            distances, indices = search_index_batch([query])[0]
+    if allowed is not None:
+        keep = (indices >= 0) & allowed[np.maximum(indices, 0)]
+        distances, indices = distances[keep][:top_k], indices[keep][:top_k]
+    return distances, indices
+
+def collect_chunks(snapshot, indices, scores: dict):
+    """Chunk texts and sources_info for ranked chunk ids; `scores` maps a field name to per-rank scores"""
+    relevant_chunks = []
+    chunk_info = []
+    
+    for rank, idx in enumerate(indices):
+        if 0 <= idx < len(snapshot.chunks):
+            chunk_text = snapshot.chunks[idx]
+            relevant_chunks.append(chunk_text)
+            info = {'index': int(idx)}
+            info.update({field: values[rank] for field, values in scores.items()})
+            if hasattr(snapshot.chunks, 'section_path'):
+                # Cite the section instead of repeating the chunk text
+                info['section'] = snapshot.chunks.section(idx)
+                info['section_path'] = snapshot.chunks.section_path(idx)
+            else:
+                info['preview'] = chunk_text[:200] + "..." if len(chunk_text) > 200 else chunk_text
+            chunk_info.append(info)
+    
+    return relevant_chunks, chunk_info
 
-def retrieve_relevant_chunks(user_prompt: str, top_k: int = 3):
-    """Retrieve the most relevant chunks from the FAISS index"""
-    if not loaded_index or not loaded_chunks:
+def expand_sections(snapshot, relevant_chunks: list, chunk_info: list, expand: str):
+    """Append the parent or sibling sections of each hit, up to EXPAND_MAX_CHUNKS chunks"""
+    if not expand or not hasattr(snapshot.chunks, 'parents'):
+        return relevant_chunks, chunk_info
+    seen = {info['index'] for info in chunk_info}
+    added = []
+    for info in chunk_info:
+        hit = info['index']
+        related = [int(snapshot.chunks.parents[hit])] if expand == 'parent' else snapshot.chunks.siblings(hit)
+        for idx in related:
+            if idx >= 0 and idx not in seen and len(added) < EXPAND_MAX_CHUNKS:
+                seen.add(int(idx))
+                added.append((int(idx), hit))
+    extra_chunks, extra_info = collect_chunks(snapshot, [idx for idx, _ in added], {
+        'retrieval': ['expanded'] * len(added),
+        'expanded_from': [hit for _, hit in added],
+    })
+    return relevant_chunks + extra_chunks, chunk_info + extra_info
+
+reranker = Reranker(
+    top_k=RERANK_TOP_K,
+    mmr_lambda=RERANK_MMR_LAMBDA,
+    budget_ms=RERANK_BUDGET_MS,
+    cross_encoder=CrossEncoderScorer(RERANK_CROSS_ENCODER_MODEL) if RERANK_CROSS_ENCODER_MODEL else None,
+)
+
+def rerank_chunks(user_prompt: str, snapshot, relevant_chunks: list, chunk_info: list, top_k: int):
+    """Keep the best `top_k` of the candidate pool as picked by the reranker"""
+    if not chunk_info:
+        return relevant_chunks, chunk_info
+    with metrics.stage("rerank"):
+        keep, scores, details = reranker.rerank(user_prompt, snapshot.index,
+                                                [info['index'] for info in chunk_info], relevant_chunks, top_k)
+    metrics.rerank_total.inc(result=details['skipped'] or ('cross_encoder' if details['cross_encoder'] else 'mmr'))
+    reranked_info = []
+    for rank, i in enumerate(keep):
+        info = dict(chunk_info[i])
+        if scores is not None:
+            info['rerank_score'] = round(scores[rank], 4)
+            info['first_stage_rank'] = i + 1
+        reranked_info.append(info)
+    return [relevant_chunks[i] for i in keep], reranked_info
+
+def search_chunks(query_vector, top_k: int = 3, snapshot=None, section: str = None, vector_hits=None):
+    """Search the FAISS index with an embedded question"""
+    snapshot = snapshot or current_snapshot
+    distances, indices = search_vectors(query_vector, top_k, snapshot, section_mask(snapshot, section), vector_hits)
+    return collect_chunks(snapshot, indices, {'distance': [float(d) for d in distances]})
+
+def keyword_search_chunks(user_prompt: str, top_k: int = 3, snapshot=None, section: str = None):
+    """Search the BM25 keyword index"""
+    snapshot = snapshot or current_snapshot
+    with metrics.stage("keyword_search"):
+        scores, indices = snapshot.lexical.search(user_prompt, top_k, section_mask(snapshot, section))
+    return collect_chunks(snapshot, indices, {'bm25': [float(score) for score in scores],
+                                              'retrieval': ['keyword'] * len(indices)})
+
+def hybrid_search_chunks(user_prompt: str, query_vector, top_k: int = 3, snapshot=None, section: str = None,
+                         vector_hits=None):
+    """Fuse vector and BM25 rankings with reciprocal rank fusion"""
+    snapshot = snapshot or current_snapshot
+    candidates = max(top_k, HYBRID_CANDIDATES)
+    allowed = section_mask(snapshot, section)
+    distances, vector_ids = search_vectors(query_vector, candidates, snapshot, allowed, vector_hits)
+    with metrics.stage("keyword_search"):
+        bm25_scores, keyword_ids = snapshot.lexical.search(user_prompt, candidates, allowed)
+    fused, indices = reciprocal_rank_fusion([vector_ids, keyword_ids], len(snapshot.chunks), k=RRF_K)
+    indices = indices[:top_k]
+
+    distance_by_id = {int(i): float(d) for i, d in zip(vector_ids, distances)}
+    bm25_by_id = {int(i): float(score) for i, score in zip(keyword_ids, bm25_scores)}
+    return collect_chunks(snapshot, indices, {
+        'distance': [distance_by_id.get(int(i)) for i in indices],
+        'bm25': [bm25_by_id.get(int(i)) for i in indices],
+        'rrf': [round(float(score), 6) for score in fused[:top_k]],
+        'retrieval': ['hybrid'] * len(indices),
+    })
+
+def search_relevant_chunks(user_prompt: str, query_vector, top_k: int = 3, snapshot=None,
+                           section: str = None, expand: str = RETRIEVAL_EXPAND, vector_hits=None):
+    """Hybrid search when a keyword index is loaded, keyword search alone if the question could not be embedded.
+
+    With reranking, a pool of RERANK_CANDIDATES is searched and at most RERANK_TOP_K of it kept.
+    `vector_hits` are precomputed FAISS results for the question (see answer_batch).
+    """
+    snapshot = snapshot or current_snapshot
+    pool = max(top_k, RERANK_CANDIDATES) if RERANK_ENABLED else top_k
+    if query_vector is None:
+        if snapshot.lexical is None:
+            return [], []
+        results = keyword_search_chunks(user_prompt, pool, snapshot, section)
+    elif HYBRID_RETRIEVAL and snapshot.lexical is not None:
+        results = hybrid_search_chunks(user_prompt, query_vector, pool, snapshot, section, vector_hits)
+    else:
+        results = search_chunks(query_vector, pool, snapshot, section, vector_hits)
+    if RERANK_ENABLED:
+        results = rerank_chunks(user_prompt, snapshot, *results, min(top_k, RERANK_TOP_K))
+    return expand_sections(snapshot, *results, expand)
+
+def retrieve_relevant_chunks(user_prompt: str, top_k: int = 3, query_vector=None, snapshot=None,
+                             section: str = None, expand: str = RETRIEVAL_EXPAND):
+    """Retrieve the most relevant chunks from the FAISS and keyword indexes"""
+    snapshot = snapshot or current_snapshot
+    if snapshot is None:
         return [], []
     
     try:
-        # Embed the user prompt
-        query_embedding_response = genai.embed_content(
-            model=EMBEDDING_MODEL_NAME,
-            content=user_prompt,
-            task_type="RETRIEVAL_QUERY"
-        )
-        query_embedding = query_embedding_response['embedding']
-        query_vector_np = np.array([query_embedding]).astype('float32')
-        
-        # Search the FAISS index
-        distances, indices = loaded_index.search(query_vector_np, top_k)
-        
-        relevant_chunks = []
-        chunk_info = []
-        
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            dist = distances[0][i]
-            if idx < len(loaded_chunks):
-                chunk_text = loaded_chunks[idx]
-                relevant_chunks.append(chunk_text)
-                chunk_info.append({
-                    'index': int(idx),
-                    'distance': float(dist),
-                    'preview': chunk_text[:200] + "..." if len(chunk_text) > 200 else chunk_text
-                })
+        # Embed the user prompt (unless the caller already did); keyword search still works without it
+        if query_vector is None:
+            try:
+                query_vector = embed_query(user_prompt, snapshot)
+            except Exception as e:
+                print(f"⚠️ Embedding failed, falling back to keyword search: {e}")
         
-        return relevant_chunks, chunk_info
+        return search_relevant_chunks(user_prompt, query_vector, top_k, snapshot, section, expand)
     
     except Exception as e:
+        metrics.errors_total.inc(stage="retrieval")
         print(f"Error during retrieval: {e}")
         return [], []
 
-def generate_response(user_question: str, relevant_chunks: list):
-    """Generate a response using Gemini with the retrieved context"""
-    if not relevant_chunks:
-        return "I couldn't find relevant information in the school handbook to answer your question. Please try rephrasing your question or contact the school administration directly."
-    
+def pack_retrieved(user_prompt: str, snapshot, relevant_chunks: list, chunk_info: list):
+    """Pack retrieved candidates into the context token budget; returns (chunks, sources_info, stats)"""
+    with metrics.stage("pack"):
+        token_counts = chunk_token_counts(snapshot.chunks, chunk_info) if chunk_info else []
+        return pack_context(user_prompt, relevant_chunks, chunk_info, token_counts, CONTEXT_TOKEN_BUDGET,
+                            CONTEXT_OVERLAP_THRESHOLD, CONTEXT_MIN_TRIM_TOKENS)
+
+def build_prompt(user_question: str, relevant_chunks: list, turns: list = None, tenant=None) -> str:
+    """Build the school's generation prompt from the retrieved context and, for follow-ups, the earlier turns"""
+    tenant = tenant or default_tenant
     # Prepare context from retrieved chunks
     context = "\n\n".join([f"Source {i+1}:\n{chunk}" for i, chunk in enumerate(relevant_chunks)])
+    conversation = f"""
+CONVERSATION SO FAR:
+{format_turns(turns, CONVERSATION_ANSWER_CHARS)}
+""" if turns else ""
     
-    # Create prompt for Gemini
-    prompt = f"""You are a helpful assistant for Pathways Academy. Use the following information from the school handbook to answer the student's question accurately and helpfully.
+    return tenant.prompt_template.format(school_name=tenant.name, context=context, conversation=conversation,
+                                         question=user_question)
+
+def retrieval_only_response(relevant_chunks: list, chunk_info: list) -> str:
+    """Answer with excerpts of the matched handbook sections when no answer can be generated"""
+    parts = [RETRIEVAL_ONLY_RESPONSE]
+    for i, chunk in enumerate(relevant_chunks):
+        info = chunk_info[i] if chunk_info and i < len(chunk_info) else {}
+        excerpt = chunk.strip()
+        first_line, _, rest = excerpt.partition("\n")
+        if parse_section_header(first_line)[0]:
+            excerpt = rest.strip()  # The section path names it
+        if len(excerpt) > RETRIEVAL_ONLY_EXCERPT_CHARS:
+            excerpt = excerpt[:RETRIEVAL_ONLY_EXCERPT_CHARS].rsplit(" ", 1)[0] + "..."
+        parts.append(f"**{info.get('section_path') or f'Source {i + 1}'}**\n{excerpt}")
+    return "\n\n".join(parts)
+
+def is_retrieval_only(response: str) -> bool:
+    """Whether a response is the retrieval-only fallback rather than a generated answer"""
+    return response.startswith(RETRIEVAL_ONLY_RESPONSE)
+
+def generate_response(user_question: str, relevant_chunks: list, turns: list = None, chunk_info: list = None,
+                      tenant=None):
+    """Generate a response using Gemini with the retrieved context, or list the matched sections if that fails"""
+    if not relevant_chunks:
+        return NO_CONTEXT_RESPONSE
+    
+    with metrics.stage("prompt"):
+        prompt = build_prompt(user_question, relevant_chunks, turns, tenant)
+    metrics.tokens_total.inc(estimate_tokens(prompt), direction="in")
 
-CONTEXT FROM SCHOOL HANDBOOK:
-{context}
+    try:
+        model = genai.GenerativeModel(GENERATION_MODEL_NAME)
+        with metrics.stage("generate"):
+            response = generation_client.call(model.generate_content, prompt)
+        metrics.tokens_total.inc(estimate_tokens(response.text), direction="out")
+        return response.text
+    except Exception as e:
+        print(f"Error generating response, answering with the matched sections: {e!r}")
+        return retrieval_only_response(relevant_chunks, chunk_info)
 
-STUDENT QUESTION: {user_question}
+def generate_response_stream(user_question: str, relevant_chunks: list, turns: list = None, tenant=None):
+    """Yield the response text piece by piece as Gemini generates it"""
+    if not relevant_chunks:
+        yield NO_CONTEXT_RESPONSE
+        return
+    
+    with metrics.stage("prompt"):
+        prompt = build_prompt(user_question, relevant_chunks, turns, tenant)
+    metrics.tokens_total.inc(estimate_tokens(prompt), direction="in")
+    model = genai.GenerativeModel(GENERATION_MODEL_NAME)
+    with metrics.stage("generate"):
+        started = time.perf_counter()
+        for chunk in generation_client.stream(lambda: model.generate_content(prompt, stream=True)):
+            if chunk.text:
+                if started is not None:
+                    metrics.observe_stage("first_token", time.perf_counter() - started)
+                    started = None
+                metrics.tokens_total.inc(estimate_tokens(chunk.text), direction="out")
+                yield chunk.text
+
+def precompute_questions(tenant=None) -> list:
+    """The questions to answer ahead of time: the quick questions, then the most frequent logged ones"""
+    tenant = tenant or default_tenant
+    logged = top_logged_questions(tenant.query_log_path, PRECOMPUTE_TOP_QUERIES) if tenant.query_log_path else []
+    return question_catalog([question for _, _, question in tenant.quick_questions], logged)
+
+def regenerate_precomputed_answers(index_version: str, tenant=None):
+    """Answer the precompute questions against the served index.
+
+    Returns (answers, number of questions left out with degraded answers), or None if `index_version` is no longer served.
+    """
+    tenant = tenant or default_tenant
+    snapshot = tenant.snapshot
+    if snapshot is None or snapshot.version != index_version:
+        return None
+    answers = {}
+    dropped = 0
+    for question in precompute_questions(tenant):
+        # Background work: it queues behind interactive questions and only uses spare upstream capacity
+        with upstream.batch_priority(), admit_batch(question):
+            relevant_chunks, chunk_info = retrieve_relevant_chunks(question, top_k=CONTEXT_CANDIDATES,
+                                                                   snapshot=snapshot)
+            relevant_chunks, chunk_info, context_stats = pack_retrieved(question, snapshot, relevant_chunks,
+                                                                        chunk_info)
+            response = generate_response(question, relevant_chunks, None, chunk_info, tenant)
+        if response == NO_CONTEXT_RESPONSE:
+            continue  # Nothing to precompute; the normal path answers it the same way
+        if is_retrieval_only(response):
+            dropped += 1  # Left to the normal path, and the store regenerated once the upstream recovers
+            continue
+        answers[normalize_question(question)] = {
+            'question': question,
+            'response': response,
+            'sources_info': chunk_info,
+            'context': context_stats,
+        }
+    return (answers, dropped) if snapshot is tenant.snapshot else None
+
+precomputed_answers = PrecomputedAnswers(PRECOMPUTED_ANSWERS_PATH, regenerate_precomputed_answers)
+
+# The handbook in the working directory, served to requests that name no school
+default_tenant = Tenant(None, "", SCHOOL_NAME, PROMPT_TEMPLATE, QUICK_QUESTIONS, answer_cache,
+                        precomputed_answers, QUERY_LOG_PATH)
+default_tenant.reloader = index_reloader
+
+def open_tenant(tenant_id: str, directory: str) -> Tenant:
+    """Load a school's handbook and settings from its directory (the tenant registry's loader)"""
+    settings = read_tenant_settings(directory)
+    tenant = Tenant(tenant_id, directory,
+                    name=settings.get('name', tenant_id),
+                    prompt_template=settings.get('prompt_template', PROMPT_TEMPLATE),
+                    quick_questions=settings.get('quick_questions', QUICK_QUESTIONS),
+                    answer_cache=new_answer_cache(),
+                    query_log_path=os.path.join(directory, QUERY_LOG_PATH) if QUERY_LOG_PATH else None)
+    tenant.precomputed = PrecomputedAnswers(os.path.join(directory, PRECOMPUTED_ANSWERS_PATH),
+                                            lambda version: regenerate_precomputed_answers(version, tenant))
+    tenant.reloader = SnapshotReloader(artifact_paths(directory), lambda: load_index_snapshot(directory),
+                                       tenant.swap, poll_seconds=INDEX_RELOAD_POLL_SECONDS)
+    if not tenant.reloader.reload():
+        raise RuntimeError(tenant.reloader.last_error)
+    return tenant
+
+tenant_registry = TenantRegistry(TENANTS_DIR, open_tenant, TENANT_MEMORY_BUDGET_BYTES,
+                                 poll_seconds=INDEX_RELOAD_POLL_SECONDS)
+
+def resolve_tenant(school) -> Tenant:
+    """The school a request names, loading it if needed, or the default handbook; raises TenantError"""
+    if not school:
+        return default_tenant
+    return tenant_registry.get(str(school))
+
+def history_key(session_id: str, tenant) -> str:
+    """The history store key of a session's conversation with one school"""
+    return session_id if tenant.id is None else f"{session_id}:{tenant.id}"
+
+def log_query(question: str, plan: dict, tenant=None):
+    """Append a standalone question to the query log the precompute job ranks questions from"""
+    tenant = tenant or default_tenant
+    if tenant.query_log_path and not plan['follow_up']:
+        try:
+            append_query_log(tenant.query_log_path, question, QUERY_LOG_MAX_BYTES)
+        except OSError as e:
+            print(f"Error writing query log: {e}")
+
+def lookup_exact_answer(question: str, snapshot=None, tenant=None):
+    """The precomputed answer, else the cached answer to exactly this question text; no upstream calls.
+
+    Only hits are counted: a miss goes on to lookup_cached_answer.
+    """
+    tenant = tenant or default_tenant
+    snapshot = snapshot or tenant.snapshot
+    cached = None
+    if PRECOMPUTED_ANSWERS_ENABLED and snapshot is not None:
+        cached = tenant.precomputed.get(question, snapshot.version)
+    result = "precomputed"
+    if cached is None:
+        cached = tenant.answer_cache.get_exact(question)
+        result = "exact"
+    if cached is not None:
+        metrics.cache_lookups_total.inc(result=result)
+    return cached
+
+def lookup_cached_answer(question: str, snapshot=None, tenant=None):
+    """Look up the precomputed answers, then the answer cache: exact question text first, then similar questions.
+
+    Returns the cached entry (or None) and the question embedding, which is
+    None on an exact hit or if embedding failed.
+    """
+    tenant = tenant or default_tenant
+    snapshot = snapshot or tenant.snapshot
+    cached = lookup_exact_answer(question, snapshot, tenant)
+    if cached is not None:
+        return cached, None
+    query_vector = None
+    try:
+        query_vector = embed_query(question, snapshot)
+        cached = tenant.answer_cache.get_similar(query_vector)
+        result = "semantic" if cached is not None else "miss"
+    except Exception as e:
+        result = "error"
+        print(f"Error embedding question: {e}")
+    metrics.cache_lookups_total.inc(result=result)
+    return cached, query_vector
+
+def embed_batch(questions: list, snapshot) -> list:
+    """Embed questions BATCH_EMBED_SIZE per call; questions whose call failed get None (keyword search only)"""
+    vectors = [None] * len(questions)
+    for start in range(0, len(questions), BATCH_EMBED_SIZE):
+        texts = questions[start:start + BATCH_EMBED_SIZE]
+        try:
+            with metrics.stage("embed"):
+                vectors[start:start + len(texts)] = embed_queries([(snapshot.embedder, text) for text in texts])
+        except Exception as e:
+            print(f"⚠️ Embedding {len(texts)} batch questions failed, answering them with keyword search: {e!r}")
+    return vectors
+
+def admit_batch(question: str):
+    """An admission ticket for batch work, which queues behind interactive questions and queues again if shed"""
+    while True:
+        try:
+            return admission.acquire(BATCH, estimate_tokens(question))
+        except Rejected as e:
+            time.sleep(e.retry_after)
+
+def answer_batch(items: list, tenant=None, concurrency: int = BATCH_CONCURRENCY):
+    """Answer [{'id', 'question'}] items, yielding one result per item as its answer completes (see batch_answers.py)"""
+    tenant = tenant or default_tenant
+    snapshot = tenant.snapshot
+    if snapshot is None:
+        for item in items:
+            yield {**item, 'error': 'The handbook index is not loaded'}
+        return
+
+    # Questions with the same normalized text are answered once
+    groups = {}
+    for item in items:
+        groups.setdefault(normalize_question(item['question']) or item['question'], []).append(item)
+
+    def results(group: list, answer: dict):
+        return [{'id': item['id'], 'question': item['question'], **answer} for item in group]
+
+    def cached_answer(cached: dict) -> dict:
+        return {'response': cached['response'], 'sources_info': cached['sources_info'], 'cached': True,
+                'degraded': False}
+
+    # Precomputed and exactly cached answers need no upstream calls
+    pending = []
+    for group in groups.values():
+        cached = lookup_exact_answer(group[0]['question'], snapshot, tenant)
+        if cached is not None:
+            yield from results(group, cached_answer(cached))
+        else:
+            pending.append(group)
+    if not pending:
+        return
+
+    # Embed the rest in large calls, then search the index once for all of them
+    questions = [group[0]['question'] for group in pending]
+    with upstream.batch_priority():
+        vectors = embed_batch(questions, snapshot)
+    embedded = [i for i, vector in enumerate(vectors) if vector is not None]
+    vector_hits = [None] * len(pending)
+    if embedded:
+        k = max(CONTEXT_CANDIDATES, HYBRID_CANDIDATES, RERANK_CANDIDATES if RERANK_ENABLED else 0)
+        with metrics.stage("vector_search"):
+            hits = search_index_batch([(snapshot, vectors[i], min(k, snapshot.index.ntotal)) for i in embedded])
+        for i, hit in zip(embedded, hits):
+            vector_hits[i] = hit
+
+    to_generate = []
+    for i, group in enumerate(pending):
+        cached = tenant.answer_cache.get_similar(vectors[i]) if vectors[i] is not None else None
+        metrics.cache_lookups_total.inc(result="semantic" if cached is not None else "miss")
+        if cached is not None:
+            yield from results(group, cached_answer(cached))
+        else:
+            to_generate.append(i)
+
+    def answer(i: int) -> dict:
+        question, query_vector = questions[i], vectors[i]
+        started = time.perf_counter()
+        # Set here: pool threads do not inherit the caller's context
+        with upstream.batch_priority(), admit_batch(question):
+            relevant_chunks, chunk_info = search_relevant_chunks(question, query_vector, CONTEXT_CANDIDATES, snapshot,
+                                                                 vector_hits=vector_hits[i])
+            relevant_chunks, chunk_info, _ = pack_retrieved(question, snapshot, relevant_chunks, chunk_info)
+            response = generate_response(question, relevant_chunks, None, chunk_info, tenant)
+        if (query_vector is not None and snapshot is tenant.snapshot
+                and response != NO_CONTEXT_RESPONSE and not is_retrieval_only(response)):
+            tenant.answer_cache.put(question, query_vector, response, chunk_info)
+        return {'response': response, 'sources_info': chunk_info, 'cached': False,
+                'degraded': is_retrieval_only(response), 'ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch-answer")
+    try:
+        futures = {executor.submit(answer, i): i for i in to_generate}
+        for future in as_completed(futures):
+            group = pending[futures[future]]
+            try:
+                yield from results(group, future.result())
+            except Exception as e:
+                metrics.errors_total.inc(stage="batch")
+                print(f"Error answering batch question: {e!r}")
+                yield from results(group, {'error': 'An error occurred while processing this question'})
+    finally:
+        # A client that went away stops the questions not started yet
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def current_session_id() -> str:
+    """The session's history key; the cookie holds nothing else"""
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    if 'chat_history' in session:
+        session.pop('chat_history')  # Drop history stored in the cookie by older versions
+    return session['session_id']
 
-INSTRUCTIONS:
-- Answer based primarily on the provided context from the school handbook
-- Be clear, helpful, and student-friendly
-- If the context doesn't fully answer the question, mention what information is available and suggest contacting school administration for additional details
-- Use a warm, supportive tone appropriate for students and parents
-- Structure your response clearly with headings or bullet points when appropriate
+def record_turn(session_id: str, question: str, response: str, sources_used: int, retrieval: dict = None):
+    """Append a question and answer (and what was retrieved for it) to the session's server-side history"""
+    try:
+        history_store.append(session_id, {
+            'timestamp': datetime.now().isoformat(),
+            'question': question,
+            'response': response,
+            'sources_used': sources_used,
+            **(retrieval or {}),
+        })
+    except Exception as e:
+        print(f"Error saving chat history: {e}")
 
-ANSWER:"""
+def parse_history_page(args) -> tuple:
+    """(offset, limit) from the /history query string"""
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        offset, limit = 0, HISTORY_PAGE_SIZE
+    return offset, min(max(1, limit), HISTORY_MAX_PAGE_SIZE)
+
+def history_page(session_id: str, offset: int, limit: int) -> dict:
+    """One page of a session's history, oldest first; offset 0 is the most recent page"""
+    history, total = history_store.page(session_id, offset, limit)
+    return {
+        'history': history,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'has_more': offset + len(history) < total,
+    }
+
+def recent_turns(session_id: str) -> list:
+    """The session's last CONVERSATION_WINDOW turns, oldest first"""
+    try:
+        return history_store.page(session_id, 0, CONVERSATION_WINDOW)[0]
+    except Exception as e:
+        print(f"Error reading chat history: {e}")
+        return []
+
+def plan_conversation(question: str, turns: list, snapshot) -> dict:
+    """Decide how to retrieve for a question given the recent turns (no I/O).
+
+    `query` is the retrieval query, `turns` the history window for the prompt
+    (empty for standalone questions), `reuse` the previous turn's candidate
+    chunk ids if the topic has not changed, and `condense` whether `query`
+    still has to be rewritten from the follow-up.
+    """
+    plan = {'follow_up': False, 'query': question, 'turns': [], 'reuse': None, 'condense': False}
+    if not turns:
+        return plan
+    previous = turns[-1]
+    previous_query = previous.get('retrieval_query') or previous['question']
+    if not is_follow_up(question, previous_query):
+        return plan
+
+    plan.update(follow_up=True, turns=turns)
+    if new_terms(question, previous_query):
+        plan.update(query=heuristic_rewrite(question, previous_query), condense=CONVERSATION_REWRITE_WITH_MODEL)
+    else:
+        plan['query'] = previous_query
+        if snapshot is not None and previous.get('index_version') == snapshot.version and previous.get('chunk_ids'):
+            plan['reuse'] = previous['chunk_ids']
+    return plan
 
+def condense_question(question: str, turns: list, fallback: str) -> str:
+    """Rewrite a follow-up as a standalone question with the generation model"""
     try:
         model = genai.GenerativeModel(GENERATION_MODEL_NAME)
-        response = model.generate_content(prompt)
-        return response.text
+        with metrics.stage("condense"):
+            response = generation_client.call(model.generate_content, condense_prompt(question, turns))
+            return parse_condensed(response.text, fallback)
     except Exception as e:
-        print(f"Error generating response: {e}")
-        return "I apologize, but I'm having trouble generating a response right now. Please try again later or contact the school directly."
+        print(f"⚠️ Query rewriting failed, using the heuristic rewrite: {e}")
+        return fallback
+
+def retrieve_for_plan(plan: dict, snapshot, query_vector=None, section: str = None, expand: str = RETRIEVAL_EXPAND):
+    """Retrieve the candidate pool for a conversation plan, reusing the previous turn's chunks if it says so"""
+    if plan['reuse'] is not None:
+        return collect_chunks(snapshot, plan['reuse'], {'retrieval': ['reused'] * len(plan['reuse'])})
+    return retrieve_relevant_chunks(plan['query'], top_k=CONTEXT_CANDIDATES, query_vector=query_vector,
+                                    snapshot=snapshot, section=section, expand=expand)
+
+def turn_retrieval(plan: dict, snapshot, chunk_info: list) -> dict:
+    """What a turn retrieved, stored with it so a follow-up can reuse it"""
+    return {
+        'retrieval_query': plan['query'],
+        'chunk_ids': [info['index'] for info in chunk_info if 'index' in info],
+        'index_version': snapshot.version if snapshot is not None else None,
+    }
+
+def describe_plan(plan: dict) -> dict:
+    """The conversation plan as reported to clients"""
+    return {
+        'follow_up': plan['follow_up'],
+        'query': plan['query'],
+        'history_turns': len(plan['turns']),
+        'reused_retrieval': plan['reuse'] is not None,
+    }
+
+def cached_turn(cached: dict, plan: dict, snapshot) -> dict:
+    """A cached answer in the shape answer_question returns"""
+    return {
+        'response': cached['response'],
+        'sources_info': cached['sources_info'],
+        'context': None,
+        'cached': True,
+        'sources_used': len(cached['sources_info']),
+        'retrieval': turn_retrieval(plan, snapshot, cached['sources_info']),
+    }
+
+def answer_question(question: str, plan: dict, snapshot, tenant, section: str = None,
+                    expand: str = RETRIEVAL_EXPAND, use_cache: bool = True) -> dict:
+    """Answer a question that needs Gemini: condense a follow-up, look up similar answers, retrieve and generate"""
+    if plan['condense']:
+        plan['query'] = condense_question(question, plan['turns'], plan['query'])
+    cached, query_vector = lookup_cached_answer(question, snapshot, tenant) if use_cache else (None, None)
+    if cached is not None:
+        return cached_turn(cached, plan, snapshot)
+
+    # Retrieve a pool of candidate chunks and pack the best into the token budget
+    relevant_chunks, chunk_info = retrieve_for_plan(plan, snapshot, query_vector, section, expand)
+    retrieval = turn_retrieval(plan, snapshot, chunk_info)
+    relevant_chunks, chunk_info, context_stats = pack_retrieved(plan['query'], snapshot, relevant_chunks, chunk_info)
+
+    response = generate_response(question, relevant_chunks, plan['turns'], chunk_info, tenant)
+    if (use_cache and query_vector is not None and snapshot is tenant.snapshot
+            and response != NO_CONTEXT_RESPONSE and not is_retrieval_only(response)):
+        tenant.answer_cache.put(question, query_vector, response, chunk_info)
+    return {
+        'response': response,
+        'sources_info': chunk_info,
+        'context': context_stats,
+        'cached': False,
+        'sources_used': len(relevant_chunks),
+        'retrieval': retrieval,
+    }
+
+def admission_wait() -> float:
+    """How long a question may wait for admission: ADMISSION_MAX_WAIT_SECONDS, within the request's deadline"""
+    left = upstream.remaining()
+    return ADMISSION_MAX_WAIT_SECONDS if left is None else max(0.0, min(ADMISSION_MAX_WAIT_SECONDS, left))
+
+def single_flight_key(question: str, snapshot, tenant):
+    """Questions with the same key in flight at the same time share one answer"""
+    return tenant.id, snapshot.version if snapshot is not None else None, normalize_question(question) or question
+
+def admitted_answer(question: str, plan: dict, snapshot, tenant, section: str = None,
+                    expand: str = RETRIEVAL_EXPAND, use_cache: bool = True) -> dict:
+    """answer_question once admitted; raises Rejected. Identical standalone questions share one run."""
+    def run():
+        with admission.acquire(INTERACTIVE, estimate_tokens(question), timeout=admission_wait()):
+            return answer_question(question, plan, snapshot, tenant, section, expand, use_cache)
+
+    if not (SINGLE_FLIGHT_ENABLED and use_cache):
+        return run()
+    answer, _ = single_flight.do(single_flight_key(question, snapshot, tenant), run, timeout=upstream.remaining())
+    return answer
+
+def rejection(e: Rejected):
+    """The response to a question admission control turned away"""
+    return {'error': str(e), 'retry_after': e.retry_after}, e.status, {'Retry-After': str(e.retry_after)}
+
+def wants_timing(data: dict) -> bool:
+    """Whether to return the request's per-stage timings (asked for with "timing": true)"""
+    return METRICS_RESPONSE_TIMING or bool(data.get('timing'))
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 @app.route('/')
 def index():
-    """Main page"""
-    if 'session_id' not in session:
-        session['session_id'] = str(uuid.uuid4())
-        session['chat_history'] = []
-    return render_template('index.html')
+    """Main page (`?school=<id>` for another school's handbook)"""
+    try:
+        tenant = resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    current_session_id()
+    return render_template('index.html', quick_questions=tenant.quick_questions, school=tenant.id,
+                           school_name=tenant.name)
 
 @app.route('/ask', methods=['POST'])
+@metrics.timed_request("ask")
+@upstream.with_deadline(REQUEST_DEADLINE_SECONDS)
 def ask_question():
     """Handle question asking"""
     try:
@@ -128,29 +1121,55 @@ def ask_question():
         if not question:
             return jsonify({'error': 'Please enter a question'}), 400
         
-        # Retrieve relevant chunks
-        relevant_chunks, chunk_info = retrieve_relevant_chunks(question, top_k=3)
+        session_key = current_session_id()
+        try:
+            rate_limiter.acquire(session_key)
+        except Rejected as e:
+            return rejection(e)
         
-        # Generate response
-        response = generate_response(question, relevant_chunks)
+        try:
+            tenant = resolve_tenant(data.get('school'))
+        except TenantError as e:
+            return jsonify({'error': str(e)}), e.status
         
-        # Store in session history
-        if 'chat_history' not in session:
-            session['chat_history'] = []
+        # Use one index snapshot for the whole request, even if a reload happens meanwhile
+        snapshot = tenant.snapshot
+        try:
+            section, expand = parse_retrieval_options(data, snapshot)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        chat_entry = {
-            'timestamp': datetime.now().isoformat(),
-            'question': question,
-            'response': response,
-            'sources_used': len(relevant_chunks)
-        }
+        # Resolve follow-up questions against the session's recent turns
+        session_id = history_key(session_key, tenant)
+        conversation = CONVERSATION_MODE and data.get('conversation', True)
+        plan = plan_conversation(question, recent_turns(session_id) if conversation else [], snapshot)
+        log_query(question, plan, tenant)
+        
+        # Check the answer cache before retrieving and generating (cached answers
+        # were retrieved with the default options and no conversation history).
+        # Precomputed and exactly cached answers are served without waiting for admission.
+        use_cache = section is None and expand == RETRIEVAL_EXPAND and not plan['follow_up']
+        cached = lookup_exact_answer(question, snapshot, tenant) if use_cache else None
+        if cached is not None:
+            answer = cached_turn(cached, plan, snapshot)
+        else:
+            try:
+                answer = admitted_answer(question, plan, snapshot, tenant, section, expand, use_cache)
+            except Rejected as e:
+                return rejection(e)
+        response = answer['response']
         
-        session['chat_history'].append(chat_entry)
-        session.modified = True
+        # Store in the server-side history
+        record_turn(session_id, question, response, answer['sources_used'], answer['retrieval'])
         
         return jsonify({
             'response': response,
-            'sources_info': chunk_info,
+            'sources_info': answer['sources_info'],
+            'context': answer['context'],
+            'conversation': describe_plan(plan),
+            'cached': answer['cached'],
+            'degraded': is_retrieval_only(response),
+            'timing': metrics.current_timings() if wants_timing(data) else None,
             'timestamp': datetime.now().strftime('%I:%M %p')
         })
     
@@ -158,29 +1177,265 @@ def ask_question():
         print(f"Error in ask_question: {e}")
         return jsonify({'error': 'An error occurred while processing your question'}), 500
 
+@app.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    """Handle question asking, streaming the answer as Server-Sent Events.
+
+    Events are sent in order: `sources` (the retrieved sources_info), any number
+    of `token` events with pieces of the answer, then `done` with the timestamp
+    and timings. If generation fails before the first token, the matched
+    sections are sent as the answer and `done` says `degraded`; an `error`
+    event replaces `done` if it fails midway.
+    The finished turn is added to the session's history before `done`.
+    """
+    data = request.get_json(silent=True) or {}
+    question = data.get('question', '').strip()
+    
+    if not question:
+        return jsonify({'error': 'Please enter a question'}), 400
+    session_key = current_session_id()
+    try:
+        rate_limiter.acquire(session_key)
+    except Rejected as e:
+        return rejection(e)
+    try:
+        tenant = resolve_tenant(data.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    session_id = history_key(session_key, tenant)
+    snapshot = tenant.snapshot
+    try:
+        section, expand = parse_retrieval_options(data, snapshot)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    conversation = CONVERSATION_MODE and data.get('conversation', True)
+    timing = wants_timing(data)
+
+    plan = plan_conversation(question, recent_turns(session_id) if conversation else [], snapshot)
+    log_query(question, plan, tenant)
+    use_cache = section is None and expand == RETRIEVAL_EXPAND and not plan['follow_up']
+    # Precomputed and exactly cached answers need no slot; anything else holds one until the stream ends
+    exact = lookup_exact_answer(question, snapshot, tenant) if use_cache else None
+    ticket = None
+    if exact is None:
+        try:
+            ticket = admission.acquire(INTERACTIVE, estimate_tokens(question), timeout=admission_wait())
+        except Rejected as e:
+            return rejection(e)
+
+    def generate():
+        with metrics.request_timing() as stages, upstream.deadline(REQUEST_DEADLINE_SECONDS):
+            started = time.perf_counter()
+            
+            if plan['condense']:
+                plan['query'] = condense_question(question, plan['turns'], plan['query'])
+            cached, query_vector = exact, None
+            if cached is None and use_cache:
+                cached, query_vector = lookup_cached_answer(question, snapshot, tenant)
+            context_stats = None
+            
+            if cached is not None:
+                yield sse_event('sources', {'sources_info': cached['sources_info']})
+                yield sse_event('token', {'text': cached['response']})
+                first_token_at = time.perf_counter()
+                retrieved_at = started
+                response = cached['response']
+                sources_used = len(cached['sources_info'])
+                retrieval = turn_retrieval(plan, snapshot, cached['sources_info'])
+            else:
+                relevant_chunks, chunk_info = retrieve_for_plan(plan, snapshot, query_vector, section, expand)
+                retrieval = turn_retrieval(plan, snapshot, chunk_info)
+                relevant_chunks, chunk_info, context_stats = pack_retrieved(plan['query'], snapshot, relevant_chunks, chunk_info)
+                retrieved_at = time.perf_counter()
+                yield sse_event('sources', {'sources_info': chunk_info})
+            
+                pieces = []
+                first_token_at = None
+                try:
+                    for piece in generate_response_stream(question, relevant_chunks, plan['turns'], tenant):
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        pieces.append(piece)
+                        yield sse_event('token', {'text': piece})
+                except Exception as e:
+                    print(f"Error streaming response: {e!r}")
+                    if pieces:
+                        yield sse_event('error', {'error': GENERATION_ERROR_RESPONSE, 'partial': True})
+                        metrics.record_request("ask_stream", time.perf_counter() - started)
+                        return
+                    pieces = [retrieval_only_response(relevant_chunks, chunk_info)]
+                    first_token_at = time.perf_counter()
+                    yield sse_event('token', {'text': pieces[0]})
+            
+                response = "".join(pieces)
+                sources_used = len(relevant_chunks)
+                if (use_cache and query_vector is not None and relevant_chunks and snapshot is tenant.snapshot
+                        and not is_retrieval_only(response)):
+                    tenant.answer_cache.put(question, query_vector, response, chunk_info)
+            
+            record_turn(session_id, question, response, sources_used, retrieval)
+            finished = time.perf_counter()
+            metrics.record_request("ask_stream", finished - started)
+            yield sse_event('done', {
+                'cached': cached is not None,
+                'degraded': is_retrieval_only(response),
+                'context': context_stats,
+                'conversation': describe_plan(plan),
+                'timestamp': datetime.now().strftime('%I:%M %p'),
+                'timing': {
+                    'retrieval_ms': round((retrieved_at - started) * 1000, 1),
+                    'first_token_ms': round(((first_token_at or finished) - started) * 1000, 1),
+                    'total_ms': round((finished - started) * 1000, 1),
+                    **({'stages': stages} if timing else {}),
+                }
+            })
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    body = generate() if ticket is None else ticket.hold(generate())
+    return Response(stream_with_context(body), mimetype='text/event-stream', headers=headers)
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_batch():
+    """Answer many questions, streaming a JSON line per question as it completes (requires X-Admin-Token).
+
+    The body is {"questions": [...], "school": ...} or JSON lines (application/x-ndjson); each question is a
+    string or {"id": ..., "question": ...}. The last line is {"summary": {...}}. See batch_answers.py.
+    """
+    if not is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        entries, school = read_batch_request(request.get_data(as_text=True), request.mimetype)
+        items = parse_questions(entries, BATCH_MAX_QUESTIONS)
+        tenant = resolve_tenant(request.args.get('school') or school)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    results = with_summary(answer_batch(items, tenant), unique_count(items))
+    return Response(stream_with_context(json.dumps(result) + "\n" for result in results),
+                    mimetype='application/x-ndjson')
+
 @app.route('/history')
 def get_history():
-    """Get chat history"""
-    history = session.get('chat_history', [])
-    return jsonify({'history': history})
+    """Get a page of chat history (`?offset=0&limit=20`; offset 0 is the most recent page)"""
+    try:
+        tenant = resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    offset, limit = parse_history_page(request.args)
+    return jsonify(history_page(history_key(current_session_id(), tenant), offset, limit))
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
     """Clear chat history"""
-    session['chat_history'] = []
-    session.modified = True
+    try:
+        tenant = resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    history_store.clear(history_key(current_session_id(), tenant))
     return jsonify({'success': True})
 
+def get_health_status() -> dict:
+    """Health details shared by the Flask and ASGI apps"""
+    snapshot = current_snapshot
+    upstream_stats = {'embed': embedding_client.stats(), 'generate': generation_client.stats()}
+    breakers_closed = all(stats['breaker']['state'] == 'closed' for stats in upstream_stats.values())
+    return {
+        'status': 'healthy' if snapshot and breakers_closed else 'degraded',
+        'faiss_loaded': snapshot is not None,
+        'chunks_loaded': snapshot is not None and len(snapshot.chunks) > 0,
+        'total_chunks': len(snapshot.chunks) if snapshot else 0,
+        'index': snapshot.describe() if snapshot else None,
+        'index_reloader': index_reloader.stats(),
+        'answer_cache': answer_cache.stats(),
+        'precomputed_answers': {'enabled': PRECOMPUTED_ANSWERS_ENABLED, **precomputed_answers.stats()},
+        'rerank': {'enabled': RERANK_ENABLED, **reranker.stats()},
+        'tenants': tenant_registry.stats(),
+        'history': history_store.stats(),
+        'latency': metrics.stage_duration.snapshot(),
+        'profiler': profiler.stats(),
+        'upstream': upstream_stats,
+        'admission': {
+            **admission.stats(),
+            'rate_limit': rate_limiter.stats(),
+            'single_flight': {'enabled': SINGLE_FLIGHT_ENABLED, **single_flight.stats()},
+        },
+        'query_batching': {
+            'enabled': QUERY_BATCHING_ENABLED,
+            'embedding': embedding_batcher.stats(),
+            'search': search_batcher.stats(),
+        }
+    }
+
+@app.route('/sections')
+def list_sections():
+    """Top-level handbook sections, for the `section` filter of /ask"""
+    try:
+        snapshot = resolve_tenant(request.args.get('school')).snapshot
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    if snapshot is None or not hasattr(snapshot.chunks, 'top_level_sections'):
+        return jsonify({'sections': []})
+    return jsonify({'sections': snapshot.chunks.top_level_sections()})
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
-    status = {
-        'status': 'healthy',
-        'faiss_loaded': loaded_index is not None,
-        'chunks_loaded': len(loaded_chunks) > 0,
-        'total_chunks': len(loaded_chunks)
-    }
-    return jsonify(status)
+    return jsonify(get_health_status())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics of this process in the Prometheus text format"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+def is_admin(headers) -> bool:
+    """Whether a request carries the admin token"""
+    return bool(ADMIN_TOKEN) and headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+def control_profiler(data: dict) -> dict:
+    """Start or stop the sampling profiler from an /admin/profiler body; raises ValueError"""
+    action = data.get('action')
+    if action == 'start':
+        try:
+            interval_ms = float(data.get('interval_ms') or PROFILER_INTERVAL_MS)
+        except (TypeError, ValueError):
+            raise ValueError("interval_ms must be a number")
+        if interval_ms < 1:
+            raise ValueError("interval_ms must be at least 1")
+        profiler.start(interval_ms, reset=data.get('reset', True))
+    elif action == 'stop':
+        profiler.stop()
+    else:
+        raise ValueError("action must be 'start' or 'stop'")
+    return profiler.stats()
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    """Start/stop the sampling profiler (POST) or read its results (GET, `?format=collapsed` for flame graphs)"""
+    if not is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'POST':
+        try:
+            return jsonify(control_profiler(request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    return jsonify({**profiler.stats(), 'top_functions': profiler.top_functions()})
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Reload the index artifacts (of `?school=<id>`) now instead of waiting for the watcher"""
+    if not is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        tenant = resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    if not tenant.reloader.reload():
+        return jsonify({'error': tenant.reloader.last_error}), 500
+    return jsonify({'success': True, 'index': tenant.snapshot.describe()})
 
 # Template for the main page
 def create_templates():
@@ -198,7 +1453,7 @@ def create_templates():
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Pathways Academy - Student Handbook Assistant</title>
+    <title>{{ school_name }} - Student Handbook Assistant</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
     <style>
         :root {
@@ -509,31 +1764,18 @@ def create_templates():
 <body>
     <div class="container">
         <div class="header">
-            <h1><i class="fas fa-graduation-cap"></i> Pathways Academy</h1>
+            <h1><i class="fas fa-graduation-cap"></i> {{ school_name }}</h1>
             <p>Student Handbook Assistant - Ask me anything about school policies, procedures, and guidelines</p>
         </div>
 
         <div class="quick-questions">
             <h3><i class="fas fa-lightbulb"></i> Quick Questions</h3>
             <div class="quick-question-grid">
-                <button class="quick-question-btn" onclick="askQuickQuestion('What is the school\\'s mission and vision?')">
-                    <i class="fas fa-bullseye"></i> Mission & Vision
-                </button>
-                <button class="quick-question-btn" onclick="askQuickQuestion('Tell me about the dress code policy')">
-                    <i class="fas fa-tshirt"></i> Dress Code
-                </button>
-                <button class="quick-question-btn" onclick="askQuickQuestion('What are the attendance requirements?')">
-                    <i class="fas fa-calendar-check"></i> Attendance Policy
-                </button>
-                <button class="quick-question-btn" onclick="askQuickQuestion('How do I contact the school administration?')">
-                    <i class="fas fa-phone"></i> Contact Information
-                </button>
-                <button class="quick-question-btn" onclick="askQuickQuestion('What are the emergency procedures?')">
-                    <i class="fas fa-shield-alt"></i> Emergency Procedures
-                </button>
-                <button class="quick-question-btn" onclick="askQuickQuestion('Tell me about academic policies')">
-                    <i class="fas fa-book"></i> Academic Policies
+                {% for icon, label, question in quick_questions %}
+                <button class="quick-question-btn" onclick='askQuickQuestion({{ question|tojson }})'>
+                    <i class="fas {{ icon }}"></i> {{ label }}
                 </button>
+                {% endfor %}
             </div>
         </div>
 
@@ -546,7 +1788,7 @@ def create_templates():
             <div class="chat-messages" id="chatMessages">
                 <div class="welcome-message">
                     <i class="fas fa-comments"></i>
-                    <h3>Welcome to the Pathways Academy Handbook Assistant!</h3>
+                    <h3>Welcome to the {{ school_name }} Handbook Assistant!</h3>
                     <p>I'm here to help you find information from the student handbook. You can ask me about school policies, procedures, contact information, and much more.</p>
                     <p><strong>Try asking:</strong> "What are the school hours?" or "How do I report an absence?"</p>
                 </div>
@@ -583,6 +1825,9 @@ def create_templates():
     </div>
 
     <script>
+        const SCHOOL = {{ school|tojson }};
+        const SCHOOL_QUERY = SCHOOL ? `?school=${encodeURIComponent(SCHOOL)}` : '';
+
         let isLoading = false;
 
         function handleKeyPress(event) {
@@ -613,22 +1858,40 @@ def create_templates():
             addMessage(question, 'user');
             input.value = '';
             
+            let messageDiv = null;
+            let answer = '';
+            let sources = [];
+            
             try {
-                const response = await fetch('/ask', {
+                const response = await fetch('/ask/stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
-                    body: JSON.stringify({ question: question })
+                    body: JSON.stringify({ question: question, school: SCHOOL })
                 });
                 
-                const data = await response.json();
-                
-                if (response.ok) {
-                    addMessage(data.response, 'assistant', data.sources_info, data.timestamp);
-                } else {
+                if (!response.ok) {
+                    const data = await response.json();
                     addMessage('Sorry, I encountered an error: ' + (data.error || 'Unknown error'), 'assistant');
+                    return;
                 }
+                
+                // Render the answer incrementally as Server-Sent Events arrive
+                await readEventStream(response, (event, data) => {
+                    if (event === 'sources') {
+                        sources = data.sources_info;
+                        loading.classList.remove('show');
+                        messageDiv = addMessage('', 'assistant', sources);
+                    } else if (event === 'token') {
+                        answer += data.text;
+                        updateMessage(messageDiv, answer, sources);
+                    } else if (event === 'done') {
+                        updateMessage(messageDiv, answer, sources, data.timestamp);
+                    } else if (event === 'error') {
+                        updateMessage(messageDiv, answer ? answer + '\\n\\n' + data.error : data.error, sources);
+                    }
+                });
             } catch (error) {
                 addMessage('Sorry, I\\'m having trouble connecting. Please try again.', 'assistant');
                 console.error('Error:', error);
@@ -640,6 +1903,32 @@ def create_templates():
             }
         }
 
+        async function readEventStream(response, onEvent) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                let boundary;
+                while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    
+                    let event = 'message';
+                    let data = '';
+                    rawEvent.split('\\n').forEach(line => {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    });
+                    onEvent(event, JSON.parse(data));
+                }
+            }
+        }
+
         function addMessage(text, sender, sources = null, timestamp = null) {
             const messagesContainer = document.getElementById('chatMessages');
             const welcomeMessage = messagesContainer.querySelector('.welcome-message');
@@ -653,6 +1942,20 @@ def create_templates():
             
             const currentTime = timestamp || new Date().toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
             
+            messageDiv.innerHTML = renderMessage(text, sources, currentTime);
+            
+            messagesContainer.appendChild(messageDiv);
+            scrollToBottom();
+            return messageDiv;
+        }
+
+        function updateMessage(messageDiv, text, sources = null, timestamp = null) {
+            const currentTime = timestamp || messageDiv.querySelector('.message-time').textContent;
+            messageDiv.innerHTML = renderMessage(text, sources, currentTime);
+            scrollToBottom();
+        }
+
+        function renderMessage(text, sources, currentTime) {
             let sourcesHtml = '';
             if (sources && sources.length > 0) {
                 sourcesHtml = `
@@ -660,23 +1963,20 @@ def create_templates():
                         <h4><i class="fas fa-search"></i> Sources Found (${sources.length})</h4>
                         ${sources.map((source, index) => 
                             `<div class="source-item">
-                                <strong>Source ${index + 1}:</strong> ${source.preview}
+                                <strong>Source ${index + 1}:</strong> ${source.section_path || source.preview}
                             </div>`
                         ).join('')}
                     </div>
                 `;
             }
             
-            messageDiv.innerHTML = `
+            return `
                 <div class="message-bubble">
                     ${text.replace(/\\n/g, '<br>')}
                     ${sourcesHtml}
                 </div>
                 <div class="message-time">${currentTime}</div>
             `;
-            
-            messagesContainer.appendChild(messageDiv);
-            scrollToBottom();
         }
 
         function scrollToBottom() {
@@ -687,7 +1987,7 @@ def create_templates():
         async function clearHistory() {
             if (confirm('Are you sure you want to clear the chat history?')) {
                 try {
-                    await fetch('/clear_history', { method: 'POST' });
+                    await fetch('/clear_history' + SCHOOL_QUERY, { method: 'POST' });
                     const messagesContainer = document.getElementById('chatMessages');
                     messagesContainer.innerHTML = `
                         <div class="welcome-message">
@@ -704,14 +2004,15 @@ def create_templates():
 
         async function showHistory() {
             try {
-                const response = await fetch('/history');
+                const response = await fetch('/history' + SCHOOL_QUERY);
                 const data = await response.json();
                 
                 if (data.history && data.history.length > 0) {
-                    let historyText = `Chat History (${data.history.length} conversations):\\n\\n`;
+                    const first = data.total - data.offset - data.history.length;
+                    let historyText = `Chat History (latest ${data.history.length} of ${data.total} conversations):\\n\\n`;
                     data.history.forEach((item, index) => {
                         const date = new Date(item.timestamp).toLocaleString();
-                        historyText += `${index + 1}. [${date}]\\nQ: ${item.question}\\nA: ${item.response.substring(0, 100)}...\\n\\n`;
+                        historyText += `${first + index + 1}. [${date}]\\nQ: ${item.question}\\nA: ${item.response.substring(0, 100)}...\\n\\n`;
                     });
                     alert(historyText);
                 } else {
@@ -743,6 +2044,7 @@ if __name__ == '__main__':
     
     # Load RAG data
     if load_rag_data():
+        index_reloader.start()
         print("🤖 RAG system initialized successfully")
         print("🌐 Starting Flask server...")
         app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,527 @@
+"""
+Asyncio (ASGI) serving mode for the handbook assistant.
+
+Serves the same routes and JSON contract as the Flask app in `app.py`, but
+embedding and generation calls are awaited instead of blocking a worker
+thread, so many in-flight questions can share one process:
+
+    hypercorn asgi_app:app --bind 0.0.0.0:8000
+
+Upstream calls are limited to `UPSTREAM_POOL_SIZE` concurrent requests and
+go through the app's upstream clients (see upstream.py): the same timeouts,
+retries, circuit breakers and request deadline as the Flask app.
+"""
+import asyncio
+import contextvars
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import google.generativeai as genai
+from quart import Quart, render_template, request, jsonify, session, Response
+
+import app as rag
+import metrics
+import upstream
+from admission import INTERACTIVE, Rejected
+from batch_answers import parse_questions, read_batch_request, unique_count, with_summary
+from chunk_store import estimate_tokens
+from conversation import condense_prompt, parse_condensed
+from tenants import TenantError
+
+# Configuration
+UPSTREAM_POOL_SIZE = 16             # Max concurrent calls to the Gemini API
+
+app = Quart(__name__)
+app.secret_key = rag.app.secret_key  # Share sessions with the Flask app
+
+# The embedding client is synchronous, so embedding calls run on a bounded
+# thread pool. Generation uses the SDK's native async client.
+_embed_executor = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE, thread_name_prefix="embed")
+_upstream_slots = asyncio.Semaphore(UPSTREAM_POOL_SIZE)
+_generation_model = genai.GenerativeModel(rag.GENERATION_MODEL_NAME)
+
+async def embed_query(user_prompt: str, snapshot=None):
+    """Embed a user question for retrieval without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    # Run in a copy of this context so the embed stage lands in the request's timings
+    # and the embedding client sees the request's deadline
+    context = contextvars.copy_context()
+    async with _upstream_slots:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_embed_executor, context.run, rag.embed_query, user_prompt, snapshot),
+            timeout=upstream.remaining()
+        )
+
+async def condense_question(question: str, turns: list, fallback: str) -> str:
+    """Async version of `app.condense_question`"""
+    try:
+        async with _upstream_slots:
+            with metrics.stage("condense"):
+                response = await rag.generation_client.call_async(
+                    lambda: _generation_model.generate_content_async(condense_prompt(question, turns)))
+        return parse_condensed(response.text, fallback)
+    except Exception as e:
+        print(f"⚠️ Query rewriting failed, using the heuristic rewrite: {e!r}")
+        return fallback
+
+async def plan_conversation(session_id: str, question: str, snapshot, enabled: bool = True) -> dict:
+    """`app.plan_conversation` with the session's recent turns, read on a thread"""
+    turns = await run_blocking(rag.recent_turns, session_id) if enabled else []
+    return rag.plan_conversation(question, turns, snapshot)
+
+async def retrieve_relevant_chunks(user_prompt: str, top_k: int = 3, query_vector=None, snapshot=None,
+                                   section: str = None, expand: str = rag.RETRIEVAL_EXPAND):
+    """Retrieve the most relevant chunks from the FAISS and keyword indexes"""
+    snapshot = snapshot or rag.current_snapshot
+    if snapshot is None:
+        return [], []
+
+    try:
+        if query_vector is None:
+            try:
+                query_vector = await embed_query(user_prompt, snapshot)
+            except Exception as e:
+                print(f"⚠️ Embedding failed, falling back to keyword search: {e!r}")
+        # The search waits on the query batcher, so it runs on a thread for concurrent requests to coalesce
+        return await run_blocking(rag.search_relevant_chunks, user_prompt, query_vector, top_k, snapshot,
+                                  section, expand)
+    except Exception as e:
+        metrics.errors_total.inc(stage="retrieval")
+        print(f"Error during retrieval: {e!r}")
+        return [], []
+
+async def retrieve_for_plan(plan: dict, snapshot, query_vector=None, section: str = None,
+                            expand: str = rag.RETRIEVAL_EXPAND):
+    """Async version of `app.retrieve_for_plan`"""
+    if plan['reuse'] is not None:
+        return rag.collect_chunks(snapshot, plan['reuse'], {'retrieval': ['reused'] * len(plan['reuse'])})
+    return await retrieve_relevant_chunks(plan['query'], top_k=rag.CONTEXT_CANDIDATES, query_vector=query_vector,
+                                          snapshot=snapshot, section=section, expand=expand)
+
+async def generate_response(user_question: str, relevant_chunks: list, turns: list = None, chunk_info: list = None,
+                            tenant=None):
+    """Generate a response using Gemini with the retrieved context, or list the matched sections if that fails"""
+    if not relevant_chunks:
+        return rag.NO_CONTEXT_RESPONSE
+
+    with metrics.stage("prompt"):
+        prompt = rag.build_prompt(user_question, relevant_chunks, turns, tenant)
+    metrics.tokens_total.inc(estimate_tokens(prompt), direction="in")
+
+    try:
+        async with _upstream_slots:
+            with metrics.stage("generate"):
+                response = await rag.generation_client.call_async(
+                    lambda: _generation_model.generate_content_async(prompt))
+        metrics.tokens_total.inc(estimate_tokens(response.text), direction="out")
+        return response.text
+    except Exception as e:
+        print(f"Error generating response, answering with the matched sections: {e!r}")
+        return rag.retrieval_only_response(relevant_chunks, chunk_info)
+
+async def generate_response_stream(user_question: str, relevant_chunks: list, turns: list = None, tenant=None):
+    """Yield the response text piece by piece as Gemini generates it"""
+    if not relevant_chunks:
+        yield rag.NO_CONTEXT_RESPONSE
+        return
+
+    with metrics.stage("prompt"):
+        prompt = rag.build_prompt(user_question, relevant_chunks, turns, tenant)
+    metrics.tokens_total.inc(estimate_tokens(prompt), direction="in")
+    async with _upstream_slots:
+        with metrics.stage("generate"):
+            started = time.perf_counter()
+            stream = rag.generation_client.stream_async(
+                lambda: _generation_model.generate_content_async(prompt, stream=True))
+            async for chunk in stream:
+                if chunk.text:
+                    if started is not None:
+                        metrics.observe_stage("first_token", time.perf_counter() - started)
+                        started = None
+                    metrics.tokens_total.inc(estimate_tokens(chunk.text), direction="out")
+                    yield chunk.text
+
+def current_session_id() -> str:
+    """Async-app version of `app.current_session_id` (Quart has its own session object)"""
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    if 'chat_history' in session:
+        session.pop('chat_history')
+    return session['session_id']
+
+async def run_blocking(fn, *args):
+    """Run a blocking call (history store and query log I/O, batched searches) without blocking the event loop"""
+    return await asyncio.to_thread(fn, *args)
+
+async def record_turn(session_id: str, question: str, response: str, sources_used: int, retrieval: dict = None):
+    await run_blocking(rag.record_turn, session_id, question, response, sources_used, retrieval)
+
+async def resolve_tenant(school):
+    """Async version of `app.resolve_tenant`: loading a school blocks, so it runs on a thread"""
+    if not school:
+        return rag.default_tenant
+    return await run_blocking(rag.resolve_tenant, school)
+
+async def lookup_cached_answer(question: str, snapshot=None, tenant=None):
+    """Async version of `app.lookup_cached_answer`"""
+    tenant = tenant or rag.default_tenant
+    snapshot = snapshot or tenant.snapshot
+    cached = rag.lookup_exact_answer(question, snapshot, tenant)
+    if cached is not None:
+        return cached, None
+    query_vector = None
+    try:
+        query_vector = await embed_query(question, snapshot)
+        cached = tenant.answer_cache.get_similar(query_vector)
+        result = "semantic" if cached is not None else "miss"
+    except Exception as e:
+        result = "error"
+        print(f"Error embedding question: {e!r}")
+    metrics.cache_lookups_total.inc(result=result)
+    return cached, query_vector
+
+async def answer_question(question: str, plan: dict, snapshot, tenant, section: str = None,
+                          expand: str = rag.RETRIEVAL_EXPAND, use_cache: bool = True) -> dict:
+    """Async version of `app.answer_question`"""
+    if plan['condense']:
+        plan['query'] = await condense_question(question, plan['turns'], plan['query'])
+    cached, query_vector = await lookup_cached_answer(question, snapshot, tenant) if use_cache else (None, None)
+    if cached is not None:
+        return rag.cached_turn(cached, plan, snapshot)
+
+    relevant_chunks, chunk_info = await retrieve_for_plan(plan, snapshot, query_vector, section, expand)
+    retrieval = rag.turn_retrieval(plan, snapshot, chunk_info)
+    relevant_chunks, chunk_info, context_stats = rag.pack_retrieved(plan['query'], snapshot, relevant_chunks, chunk_info)
+
+    response = await generate_response(question, relevant_chunks, plan['turns'], chunk_info, tenant)
+    if (use_cache and query_vector is not None and snapshot is tenant.snapshot
+            and response != rag.NO_CONTEXT_RESPONSE and not rag.is_retrieval_only(response)):
+        tenant.answer_cache.put(question, query_vector, response, chunk_info)
+    return {
+        'response': response,
+        'sources_info': chunk_info,
+        'context': context_stats,
+        'cached': False,
+        'sources_used': len(relevant_chunks),
+        'retrieval': retrieval,
+    }
+
+async def admitted_answer(question: str, plan: dict, snapshot, tenant, section: str = None,
+                          expand: str = rag.RETRIEVAL_EXPAND, use_cache: bool = True) -> dict:
+    """Async version of `app.admitted_answer`: waits for admission on the event loop"""
+    async def run():
+        ticket = await rag.admission.acquire_async(INTERACTIVE, estimate_tokens(question), timeout=rag.admission_wait())
+        with ticket:
+            return await answer_question(question, plan, snapshot, tenant, section, expand, use_cache)
+
+    if not (rag.SINGLE_FLIGHT_ENABLED and use_cache):
+        return await run()
+    answer, _ = await rag.single_flight.do_async(rag.single_flight_key(question, snapshot, tenant), run,
+                                                 timeout=upstream.remaining())
+    return answer
+
+@app.before_serving
+async def startup():
+    """Load the RAG data once per process"""
+    if rag.current_snapshot is None and not rag.load_rag_data():
+        print("❌ Failed to load RAG data. Please ensure FAISS index and chunks files exist.")
+    rag.index_reloader.start()
+
+@app.route('/')
+async def index():
+    """Main page (`?school=<id>` for another school's handbook)"""
+    try:
+        tenant = await resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    current_session_id()
+    return await render_template('index.html', quick_questions=tenant.quick_questions, school=tenant.id,
+                                 school_name=tenant.name)
+
+@app.route('/ask', methods=['POST'])
+@metrics.timed_request("ask")
+@upstream.with_deadline(rag.REQUEST_DEADLINE_SECONDS)
+async def ask_question():
+    """Handle question asking"""
+    try:
+        data = await request.get_json()
+        question = data.get('question', '').strip()
+
+        if not question:
+            return jsonify({'error': 'Please enter a question'}), 400
+
+        session_key = current_session_id()
+        try:
+            rag.rate_limiter.acquire(session_key)
+        except Rejected as e:
+            return rag.rejection(e)
+
+        try:
+            tenant = await resolve_tenant(data.get('school'))
+        except TenantError as e:
+            return jsonify({'error': str(e)}), e.status
+
+        snapshot = tenant.snapshot
+        try:
+            section, expand = rag.parse_retrieval_options(data, snapshot)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        session_id = rag.history_key(session_key, tenant)
+        plan = await plan_conversation(session_id, question, snapshot,
+                                       rag.CONVERSATION_MODE and data.get('conversation', True))
+        await run_blocking(rag.log_query, question, plan, tenant)
+
+        use_cache = section is None and expand == rag.RETRIEVAL_EXPAND and not plan['follow_up']
+        cached = rag.lookup_exact_answer(question, snapshot, tenant) if use_cache else None
+        if cached is not None:
+            answer = rag.cached_turn(cached, plan, snapshot)
+        else:
+            try:
+                answer = await admitted_answer(question, plan, snapshot, tenant, section, expand, use_cache)
+            except Rejected as e:
+                return rag.rejection(e)
+        response = answer['response']
+
+        await record_turn(session_id, question, response, answer['sources_used'], answer['retrieval'])
+
+        return jsonify({
+            'response': response,
+            'sources_info': answer['sources_info'],
+            'context': answer['context'],
+            'conversation': rag.describe_plan(plan),
+            'cached': answer['cached'],
+            'degraded': rag.is_retrieval_only(response),
+            'timing': metrics.current_timings() if rag.wants_timing(data) else None,
+            'timestamp': datetime.now().strftime('%I:%M %p')
+        })
+
+    except Exception as e:
+        print(f"Error in ask_question: {e!r}")
+        return jsonify({'error': 'An error occurred while processing your question'}), 500
+
+@app.route('/ask/stream', methods=['POST'])
+async def ask_question_stream():
+    """Handle question asking, streaming the answer as Server-Sent Events"""
+    data = await request.get_json(silent=True) or {}
+    question = data.get('question', '').strip()
+
+    if not question:
+        return jsonify({'error': 'Please enter a question'}), 400
+    session_key = current_session_id()
+    try:
+        rag.rate_limiter.acquire(session_key)
+    except Rejected as e:
+        return rag.rejection(e)
+    try:
+        tenant = await resolve_tenant(data.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    session_id = rag.history_key(session_key, tenant)
+    snapshot = tenant.snapshot
+    try:
+        section, expand = rag.parse_retrieval_options(data, snapshot)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    conversation = rag.CONVERSATION_MODE and data.get('conversation', True)
+    timing = rag.wants_timing(data)
+
+    plan = await plan_conversation(session_id, question, snapshot, conversation)
+    await run_blocking(rag.log_query, question, plan, tenant)
+    use_cache = section is None and expand == rag.RETRIEVAL_EXPAND and not plan['follow_up']
+    # Precomputed and exactly cached answers need no slot; anything else holds one until the stream ends
+    exact = rag.lookup_exact_answer(question, snapshot, tenant) if use_cache else None
+    ticket = None
+    if exact is None:
+        try:
+            ticket = await rag.admission.acquire_async(INTERACTIVE, estimate_tokens(question),
+                                                       timeout=rag.admission_wait())
+        except Rejected as e:
+            return rag.rejection(e)
+
+    async def generate():
+        with metrics.request_timing() as stages, upstream.deadline(rag.REQUEST_DEADLINE_SECONDS):
+            started = time.perf_counter()
+
+            if plan['condense']:
+                plan['query'] = await condense_question(question, plan['turns'], plan['query'])
+            cached, query_vector = exact, None
+            if cached is None and use_cache:
+                cached, query_vector = await lookup_cached_answer(question, snapshot, tenant)
+            context_stats = None
+
+            if cached is not None:
+                yield rag.sse_event('sources', {'sources_info': cached['sources_info']})
+                yield rag.sse_event('token', {'text': cached['response']})
+                first_token_at = time.perf_counter()
+                retrieved_at = started
+                response = cached['response']
+                sources_used = len(cached['sources_info'])
+                retrieval = rag.turn_retrieval(plan, snapshot, cached['sources_info'])
+            else:
+                relevant_chunks, chunk_info = await retrieve_for_plan(plan, snapshot, query_vector, section, expand)
+                retrieval = rag.turn_retrieval(plan, snapshot, chunk_info)
+                relevant_chunks, chunk_info, context_stats = rag.pack_retrieved(plan['query'], snapshot, relevant_chunks, chunk_info)
+                retrieved_at = time.perf_counter()
+                yield rag.sse_event('sources', {'sources_info': chunk_info})
+
+                pieces = []
+                first_token_at = None
+                try:
+                    async for piece in generate_response_stream(question, relevant_chunks, plan['turns'], tenant):
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        pieces.append(piece)
+                        yield rag.sse_event('token', {'text': piece})
+                except Exception as e:
+                    print(f"Error streaming response: {e!r}")
+                    if pieces:
+                        yield rag.sse_event('error', {'error': rag.GENERATION_ERROR_RESPONSE, 'partial': True})
+                        metrics.record_request("ask_stream", time.perf_counter() - started)
+                        return
+                    pieces = [rag.retrieval_only_response(relevant_chunks, chunk_info)]
+                    first_token_at = time.perf_counter()
+                    yield rag.sse_event('token', {'text': pieces[0]})
+
+                response = "".join(pieces)
+                sources_used = len(relevant_chunks)
+                if (use_cache and query_vector is not None and relevant_chunks and snapshot is tenant.snapshot
+                        and not rag.is_retrieval_only(response)):
+                    tenant.answer_cache.put(question, query_vector, response, chunk_info)
+
+            await record_turn(session_id, question, response, sources_used, retrieval)
+            finished = time.perf_counter()
+            metrics.record_request("ask_stream", finished - started)
+            yield rag.sse_event('done', {
+                'cached': cached is not None,
+                'degraded': rag.is_retrieval_only(response),
+                'context': context_stats,
+                'conversation': rag.describe_plan(plan),
+                'timestamp': datetime.now().strftime('%I:%M %p'),
+                'timing': {
+                    'retrieval_ms': round((retrieved_at - started) * 1000, 1),
+                    'first_token_ms': round(((first_token_at or finished) - started) * 1000, 1),
+                    'total_ms': round((finished - started) * 1000, 1),
+                    **({'stages': stages} if timing else {}),
+                }
+            })
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    body = generate() if ticket is None else ticket.hold(generate())
+    return Response(body, mimetype='text/event-stream', headers=headers)
+
+@app.route('/ask/batch', methods=['POST'])
+async def ask_batch():
+    """Async version of `app.ask_batch`: the batch is answered on threads and its lines streamed as they complete"""
+    if not rag.is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        entries, school = read_batch_request(await request.get_data(as_text=True), request.mimetype)
+        items = parse_questions(entries, rag.BATCH_MAX_QUESTIONS)
+        tenant = await resolve_tenant(request.args.get('school') or school)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    results = with_summary(rag.answer_batch(items, tenant), unique_count(items))
+    # Closing the batch waits for a `next` still running on its thread
+    stepping = threading.Lock()
+
+    def step():
+        with stepping:
+            return next(results, None)
+
+    def close():
+        with stepping:
+            results.close()
+
+    async def generate():
+        try:
+            while (result := await run_blocking(step)) is not None:
+                yield json.dumps(result) + "\n"
+        finally:
+            # A client that went away stops the questions not started yet, as in the Flask app
+            await run_blocking(close)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/history')
+async def get_history():
+    """Get a page of chat history (`?offset=0&limit=20`; offset 0 is the most recent page)"""
+    try:
+        tenant = await resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    offset, limit = rag.parse_history_page(request.args)
+    return jsonify(await run_blocking(rag.history_page, rag.history_key(current_session_id(), tenant), offset, limit))
+
+@app.route('/clear_history', methods=['POST'])
+async def clear_history():
+    """Clear chat history"""
+    try:
+        tenant = await resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    await run_blocking(rag.history_store.clear, rag.history_key(current_session_id(), tenant))
+    return jsonify({'success': True})
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    """Metrics of this process in the Prometheus text format"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+async def admin_profiler():
+    """Start/stop the sampling profiler (POST) or read its results (GET, `?format=collapsed` for flame graphs)"""
+    if not rag.is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'POST':
+        try:
+            return jsonify(rag.control_profiler(await request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    if request.args.get('format') == 'collapsed':
+        return Response(rag.profiler.collapsed(), mimetype='text/plain')
+    return jsonify({**rag.profiler.stats(), 'top_functions': rag.profiler.top_functions()})
+
+@app.route('/admin/reload', methods=['POST'])
+async def admin_reload():
+    """Reload the index artifacts (of `?school=<id>`) now instead of waiting for the watcher"""
+    if not rag.is_admin(request.headers):
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        tenant = await resolve_tenant(request.args.get('school'))
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, tenant.reloader.reload):
+        return jsonify({'error': tenant.reloader.last_error}), 500
+    return jsonify({'success': True, 'index': tenant.snapshot.describe()})
+
+@app.route('/sections')
+async def list_sections():
+    """Top-level handbook sections, for the `section` filter of /ask"""
+    try:
+        snapshot = (await resolve_tenant(request.args.get('school'))).snapshot
+    except TenantError as e:
+        return jsonify({'error': str(e)}), e.status
+    if snapshot is None or not hasattr(snapshot.chunks, 'top_level_sections'):
+        return jsonify({'sections': []})
+    return jsonify({'sections': snapshot.chunks.top_level_sections()})
+
+@app.route('/health')
+async def health_check():
+    """Health check endpoint"""
+    status = rag.get_health_status()
+    status['serving_mode'] = 'asgi'
+    return jsonify(status)
+
+if __name__ == '__main__':
+    print("🚀 Starting Pathways Academy Handbook Assistant (async)...")
+    rag.create_templates()
+    app.run(host='0.0.0.0', port=5000)
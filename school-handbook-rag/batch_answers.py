@@ -0,0 +1,200 @@
+"""
+Answering many questions at once, for FAQ pages and answer reviews.
+
+    python batch_answers.py questions.txt --output answers.jsonl
+    python batch_answers.py questions.jsonl --output answers.jsonl --resume     # continue an interrupted run
+    python batch_answers.py questions.txt --school riverside --concurrency 8
+    python batch_answers.py questions.txt --url http://localhost:5000 --admin-token "$ADMIN_TOKEN"
+
+Questions are read from a text file (one per line, "#" starts a comment) or
+from JSON lines (.jsonl), each a string or {"id": ..., "question": ...};
+questions without an id are numbered by their position. The same pipeline
+(app.answer_batch) serves POST /ask/batch, which is what --url calls:
+
+    - questions with the same normalized text are answered once
+    - precomputed and cached answers are returned first
+    - the rest are embedded BATCH_EMBED_SIZE per call and searched with one
+      FAISS query for the whole batch
+    - answers are generated BATCH_CONCURRENCY at a time as batch-priority
+      upstream calls, which only use spare capacity (see upstream.py) and
+      share the interactive calls' retries and circuit breakers
+
+Results are JSON lines in completion order, followed by a {"summary": ...}
+line. Nothing is written to chat history or the query log. The output file
+is appended to and flushed line by line, so --resume skips the ids it
+already holds an answer for (errors and retrieval-only answers are asked
+again). Generated answers also go to the answer cache, so re-sending an
+interrupted /ask/batch request answers its finished questions from it.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from answer_cache import normalize_question
+
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/json-lines")
+
+
+def parse_questions(entries: list, max_questions: int = None) -> list:
+    """Validated [{'id', 'question'}] from strings or {"id", "question"} objects; raises ValueError"""
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Please send a non-empty list of questions")
+    if max_questions and len(entries) > max_questions:
+        raise ValueError(f"At most {max_questions} questions can be answered in one batch")
+    items, ids = [], set()
+    for position, entry in enumerate(entries, 1):
+        if isinstance(entry, str):
+            entry = {'question': entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get('question'), str) or not entry['question'].strip():
+            raise ValueError(f"Question {position} needs a non-empty 'question'")
+        item_id = str(entry.get('id', position))
+        if item_id in ids:
+            raise ValueError(f"Duplicate question id: {item_id}")
+        ids.add(item_id)
+        items.append({'id': item_id, 'question': entry['question'].strip()})
+    return items
+
+
+def read_batch_request(body: str, mimetype: str) -> tuple:
+    """(question entries, school) of an /ask/batch body: JSON lines, a JSON list, or {"questions", "school"}"""
+    try:
+        if mimetype in NDJSON_MIMETYPES:
+            return [json.loads(line) for line in body.splitlines() if line.strip()], None
+        data = json.loads(body or "null")
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if isinstance(data, dict):
+        return data.get('questions'), data.get('school')
+    return data, None
+
+
+def read_question_file(path: str) -> list:
+    """Question entries of a text file (one per line) or a .jsonl file"""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                try:
+                    entries.append(json.loads(line))
+                except ValueError as e:
+                    raise ValueError(f"{path}:{line_number}: {e}")
+            else:
+                entries.append(line)
+    return entries
+
+
+def read_answered_ids(path: str) -> set:
+    """Ids that already have a generated answer (not an error or the retrieval-only fallback) in an output file"""
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by the interruption
+            if isinstance(result, dict) and 'id' in result and 'response' in result and not result.get('degraded'):
+                answered.add(str(result['id']))
+    return answered
+
+
+def with_summary(results, unique_questions: int = None):
+    """Pass results through, then yield a {"summary": ...} line counting them; closing it closes `results`"""
+    started = time.perf_counter()
+    counts = {'answered': 0, 'cached': 0, 'degraded': 0, 'errors': 0}
+    try:
+        for result in results:
+            if result.get('error'):
+                counts['errors'] += 1
+            else:
+                counts['answered'] += 1
+                counts['cached'] += bool(result.get('cached'))
+                counts['degraded'] += bool(result.get('degraded'))
+            yield result
+    finally:
+        if hasattr(results, 'close'):
+            results.close()
+    yield {'summary': {**counts, 'unique_questions': unique_questions,
+                       'seconds': round(time.perf_counter() - started, 3)}}
+
+
+def unique_count(items: list) -> int:
+    """Questions left after answering duplicates once"""
+    return len({normalize_question(item['question']) or item['question'] for item in items})
+
+
+def answer_locally(items: list, school: str = None, concurrency: int = None):
+    """Results of answering the items in this process"""
+    import app as rag
+    if not school and not rag.load_rag_data():
+        raise SystemExit("Failed to load RAG data")
+    tenant = rag.resolve_tenant(school)
+    return with_summary(rag.answer_batch(items, tenant, concurrency or rag.BATCH_CONCURRENCY), unique_count(items))
+
+
+def answer_remotely(items: list, url: str, admin_token: str = None, school: str = None):
+    """Results streamed back from POST /ask/batch of a running app"""
+    endpoint = url.rstrip("/") + "/ask/batch"
+    body = json.dumps({'questions': items, 'school': school}).encode("utf-8")
+    request = urllib.request.Request(endpoint, data=body, method="POST", headers={
+        'Content-Type': 'application/json', 'X-Admin-Token': admin_token or ''})
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="text file with one question per line, or a .jsonl file")
+    parser.add_argument("--output", help="JSON lines file to append results to (default: stdout)")
+    parser.add_argument("--resume", action="store_true", help="skip questions whose id already has an answer in --output")
+    parser.add_argument("--school", help="a school's handbook (see tenants.py) instead of the default one")
+    parser.add_argument("--concurrency", type=int, help="answers generated at once (default: BATCH_CONCURRENCY)")
+    parser.add_argument("--url", help="send the batch to a running app's /ask/batch instead of answering in-process")
+    parser.add_argument("--admin-token", default=os.environ.get("ADMIN_TOKEN"), help="X-Admin-Token for --url")
+    args = parser.parse_args()
+    if args.resume and not args.output:
+        parser.error("--resume needs --output")
+
+    try:
+        items = parse_questions(read_question_file(args.questions))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.resume:
+        answered = read_answered_ids(args.output)
+        items = [item for item in items if item['id'] not in answered]
+        print(f"Resuming: {len(answered)} answered, {len(items)} to go", file=sys.stderr)
+        if not items:
+            return
+
+    if args.url:
+        results = answer_remotely(items, args.url, args.admin_token, args.school)
+    else:
+        results = answer_locally(items, args.school, args.concurrency)
+    output = open(args.output, "a+", encoding="utf-8") if args.output else sys.stdout
+    try:
+        if output is not sys.stdout and output.tell() > 0:
+            output.seek(output.tell() - 1)
+            if output.read(1) != "\n":
+                output.write("\n")  # End a line cut short by an interruption
+        for result in results:
+            if 'summary' in result:
+                print(f"✅ {json.dumps(result['summary'])}", file=sys.stderr)
+                continue
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
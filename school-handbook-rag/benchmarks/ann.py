@@ -0,0 +1,147 @@
+"""
+Benchmark approximate FAISS index types against exact search.
+
+    python -m benchmarks.ann                                  # synthetic corpora of 1k, 10k, 100k vectors
+    python -m benchmarks.ann --sizes 5000 50000 --metric ip --json
+    python -m benchmarks.ann --index school_handbook.faiss    # vectors of a built flat index
+
+For each corpus size and index type (see ann_index.py), builds the index and,
+for each value of its search knob (`nprobe` for IVF, `efSearch` for HNSW),
+reports recall@k against exact search with the same metric and the p50/p99
+latency of single-query searches, plus build time and index size. Use it to
+choose FAISS_INDEX_TYPE, FAISS_NPROBE and FAISS_EF_SEARCH in app.py.
+
+Synthetic corpora are drawn from a Gaussian mixture: embeddings are
+clustered, and uniform random vectors would understate the recall of
+clustering-based indexes. Queries are corpus vectors with added noise.
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from ann_index import INDEX_TYPES, METRICS, create_index, prepare_queries, set_search_params
+
+NPROBE_VALUES = [1, 4, 16, 64]
+EF_SEARCH_VALUES = [16, 64, 256]
+
+
+def make_synthetic_vectors(count: int, dimension: int, clusters: int = 100, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension)).astype('float32')
+    labels = rng.integers(0, clusters, size=count)
+    return centers[labels] + 0.5 * rng.normal(size=(count, dimension)).astype('float32')
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picks = vectors[rng.integers(0, len(vectors), size=count)]
+    noise = rng.normal(size=picks.shape).astype('float32') * picks.std() * 0.1
+    return (picks + noise).astype('float32')
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours that the index returned"""
+    hits = sum(len(np.intersect1d(row, true_row)) for row, true_row in zip(found, truth))
+    return hits / truth.size
+
+
+def index_size_bytes(index) -> int:
+    return int(faiss.serialize_index(index).size)
+
+
+def measure(index, queries: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    latencies = []
+    found = np.empty_like(truth)
+    for row, query in enumerate(queries):
+        started = time.perf_counter()
+        _, indices = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        found[row] = indices[0]
+    return {
+        'recall': round(recall_at_k(found, truth), 4),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 4),
+    }
+
+
+def search_knobs(index_type: str) -> list:
+    """(label, nprobe, ef_search) settings to sweep for an index type"""
+    if index_type.startswith("ivf"):
+        return [(f"nprobe={n}", n, None) for n in NPROBE_VALUES]
+    if index_type == "hnsw":
+        return [(f"efSearch={ef}", None, ef) for ef in EF_SEARCH_VALUES]
+    return [("exact", None, None)]
+
+
+def benchmark_corpus(vectors: np.ndarray, queries: np.ndarray, index_types: list, metric: str, k: int) -> list:
+    # Ground truth: exact search with the same metric
+    exact, _ = create_index(vectors, "flat", metric)
+    prepared = prepare_queries(queries, metric)
+    _, truth = exact.search(prepared, k)
+
+    results = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        index, description = create_index(vectors, index_type, metric)
+        build_seconds = time.perf_counter() - started
+        if description == "Flat" and index_type != "flat":
+            continue  # Corpus too small to train it; create_index fell back to exact search
+        size = index_size_bytes(index)
+        for label, nprobe, ef_search in search_knobs(index_type):
+            set_search_params(index, nprobe, ef_search)
+            results.append({
+                'vectors': len(vectors),
+                'index_type': index_type,
+                'factory': description,
+                'search': label,
+                'build_seconds': round(build_seconds, 3),
+                'index_mb': round(size / 1024 / 1024, 2),
+                **measure(index, prepared, truth, k),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", help="benchmark the vectors of this flat FAISS index instead of synthetic ones")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="synthetic corpus sizes")
+    parser.add_argument("--dimension", type=int, default=768, help="dimension of the synthetic vectors")
+    parser.add_argument("--index-types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--metric", default="l2", choices=METRICS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=3, help="neighbours per query (the app uses top_k=3)")
+    parser.add_argument("--threads", type=int, default=1, help="FAISS threads (1 matches one request at a time)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    if args.index:
+        source = faiss.read_index(args.index)
+        corpora = [source.reconstruct_n(0, source.ntotal)]
+    else:
+        corpora = [make_synthetic_vectors(size, args.dimension) for size in args.sizes]
+
+    results = []
+    for vectors in corpora:
+        queries = make_queries(vectors, args.queries)
+        results.extend(benchmark_corpus(vectors, queries, args.index_types, args.metric, args.k))
+
+    if args.json:
+        print(json.dumps({'metric': args.metric, 'k': args.k, 'queries': args.queries, 'threads': args.threads,
+                          'faiss_version': faiss.__version__, 'results': results}, indent=2))
+        return
+
+    print(f"metric {args.metric}, recall@{args.k} over {args.queries} queries, {args.threads} thread(s), "
+          f"faiss {faiss.__version__}")
+    print(f"{'vectors':>8} {'index':<9} {'factory':<18} {'search':<13} {'build s':>8} {'MB':>8} "
+          f"{'recall':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        print(f"{r['vectors']:>8} {r['index_type']:<9} {r['factory']:<18} {r['search']:<13} {r['build_seconds']:>8.2f} "
+              f"{r['index_mb']:>8.2f} {r['recall']:>7.3f} {r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
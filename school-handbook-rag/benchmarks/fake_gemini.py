@@ -0,0 +1,212 @@
+"""
+Local stand-in for the Gemini REST API, for load tests and offline development.
+
+    python -m benchmarks.fake_gemini --port 8765 --embed-latency-ms 40 --first-token-ms 400
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8765 python app.py
+
+Serves the v1beta endpoints the app uses (embedContent, batchEmbedContents,
+generateContent, streamGenerateContent, countTokens) with configurable
+latency, jitter and error rate. Setting GEMINI_API_ENDPOINT makes app.py
+switch the client to the REST transport and send requests here.
+
+Embeddings are deterministic hashed bag-of-words vectors, so questions
+retrieve chunks that share their words once the index is built against
+this server. Generated answers are filler text of `--answer-tokens` words
+streamed in `--stream-chunks` pieces. GET /stats returns call counts.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from lexical_index import tokenize
+
+DIMENSION = 768
+_path_pattern = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):(?P<method>\w+)")
+
+
+class FakeGeminiConfig:
+    """Latency and failure model of the fake server"""
+
+    def __init__(self, embed_latency_ms: float = 30, first_token_ms: float = 300, chunk_interval_ms: float = 30,
+                 jitter: float = 0.2, error_rate: float = 0.0, error_status: int = 503,
+                 answer_tokens: int = 150, stream_chunks: int = 10, dimension: int = DIMENSION, seed: int = None):
+        self.embed_latency_ms = embed_latency_ms
+        self.first_token_ms = first_token_ms
+        self.chunk_interval_ms = chunk_interval_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.answer_tokens = answer_tokens
+        self.stream_chunks = max(1, stream_chunks)
+        self.dimension = dimension
+        self.random = random.Random(seed)
+
+    def delay(self, milliseconds: float):
+        """Sleep for about `milliseconds`, +/- `jitter` as a fraction"""
+        if milliseconds > 0:
+            factor = 1 + self.random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0.0, milliseconds * factor) / 1000)
+
+    def fails(self) -> bool:
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def describe(self) -> dict:
+        return {key: value for key, value in vars(self).items() if key != 'random'}
+
+
+def fake_embedding(text: str, dimension: int = DIMENSION) -> list:
+    """Normalized hashed bag of words: texts sharing words get similar vectors"""
+    vector = np.zeros(dimension, dtype='float32')
+    for token in tokenize(text):
+        hashed = zlib.crc32(token.encode("utf-8"))
+        vector[hashed % dimension] += 1.0 if hashed & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def _content_text(content: dict) -> str:
+    return " ".join(part.get('text', '') for part in (content or {}).get('parts', []))
+
+
+def _answer_pieces(config: FakeGeminiConfig, prompt: str) -> list:
+    words = ["Simulated"] + ["answer"] * (config.answer_tokens - 1)
+    words[-1] = f"({len(prompt)} prompt chars)."
+    size = max(1, -(-len(words) // config.stream_chunks))
+    return [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+
+
+def _candidate(text: str) -> dict:
+    return {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'},
+                            'finishReason': 'STOP', 'index': 0}]}
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are separate writes; avoid delayed-ACK stalls
+    config = FakeGeminiConfig()
+    calls = {}
+    calls_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass  # One line per request would dominate a load test's output
+
+    def _count(self, name: str):
+        with self.calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.startswith("/stats"):
+            with self.calls_lock:
+                calls = dict(self.calls)
+            return self._send_json(200, {'calls': calls, 'config': self.config.describe()})
+        self._send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        match = _path_pattern.match(self.path)
+        method = match.group("method") if match else None
+        self._count(method or "unknown")
+
+        if method in ("embedContent", "batchEmbedContents"):
+            self.config.delay(self.config.embed_latency_ms)
+        if self.config.fails():
+            self._count("injected_errors")
+            return self._send_json(self.config.error_status, {'error': {
+                'code': self.config.error_status, 'message': 'Injected failure', 'status': 'UNAVAILABLE'}})
+
+        if method == "embedContent":
+            text = _content_text(body.get('content'))
+            return self._send_json(200, {'embedding': {'values': fake_embedding(text, self.config.dimension)}})
+        if method == "batchEmbedContents":
+            return self._send_json(200, {'embeddings': [
+                {'values': fake_embedding(_content_text(item.get('content')), self.config.dimension)}
+                for item in body.get('requests', [])]})
+        if method == "countTokens":
+            text = " ".join(_content_text(content) for content in body.get('contents', []))
+            return self._send_json(200, {'totalTokens': len(tokenize(text))})
+        if method in ("generateContent", "streamGenerateContent"):
+            prompt = " ".join(_content_text(content) for content in body.get('contents', []))
+            pieces = _answer_pieces(self.config, prompt)
+            self.config.delay(self.config.first_token_ms)
+            if method == "generateContent":
+                self.config.delay(self.config.chunk_interval_ms * (len(pieces) - 1))
+                return self._send_json(200, _candidate("".join(pieces)))
+            return self._stream(pieces)
+        self._send_json(404, {'error': {'code': 404, 'message': f'Unknown method {self.path}', 'status': 'NOT_FOUND'}})
+
+    def _stream(self, pieces: list):
+        """streamGenerateContent over REST: a JSON array, one response per element, sent as it is generated"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, piece in enumerate(pieces):
+            if i:
+                self.config.delay(self.config.chunk_interval_ms)
+            self._send_chunk((b"[" if i == 0 else b",") + json.dumps(_candidate(piece)).encode("utf-8"))
+        self._send_chunk(b"]")
+        self._send_chunk(b"")
+
+
+def start_server(config: FakeGeminiConfig, host: str = "127.0.0.1", port: int = 0):
+    """Serve in a background thread; returns (server, base URL)"""
+    handler = type("ConfiguredFakeGeminiHandler", (FakeGeminiHandler,), {'config': config, 'calls': {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--embed-latency-ms", type=float, default=30, help="latency of each embedding request")
+    parser.add_argument("--first-token-ms", type=float, default=300, help="generation latency before the first chunk")
+    parser.add_argument("--chunk-interval-ms", type=float, default=30, help="delay between streamed chunks")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency varies by +/- this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected failures")
+    parser.add_argument("--answer-tokens", type=int, default=150, help="words per generated answer")
+    parser.add_argument("--stream-chunks", type=int, default=10, help="pieces per streamed answer")
+
+
+def config_from_args(args) -> FakeGeminiConfig:
+    return FakeGeminiConfig(args.embed_latency_ms, args.first_token_ms, args.chunk_interval_ms, args.jitter,
+                            args.error_rate, args.error_status, args.answer_tokens, args.stream_chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_server(config_from_args(args), args.host, args.port)
+    print(f"Fake Gemini API listening on {url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmark FAISS index loading across pre-forked worker processes.
+
+    python -m benchmarks.index_load --workers 4
+    python -m benchmarks.index_load --synthetic 200000 --json
+
+For each loading strategy, forks `--workers` processes the way gunicorn does
+and reports per-worker RSS and PSS (proportional set size: shared pages are
+split between the processes sharing them, so the PSS sum is the real memory
+cost) plus cold and warm load times. Strategies:
+
+    heap           each worker reads the index onto its own heap
+    mmap           each worker memory-maps the index file
+    preload-heap   the master reads the index once before forking
+    preload-mmap   the master memory-maps the index once before forking
+
+Linux only (reads /proc/self/smaps_rollup).
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from app import FAISS_INDEX_PATH
+from index_snapshot import read_faiss_index
+
+STRATEGIES = ["heap", "mmap", "preload-heap", "preload-mmap"]
+
+
+def memory_usage_kb() -> dict:
+    """RSS and PSS of the current process in kB"""
+    usage = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                usage[key.lower()] = int(value.split()[0])
+    return usage
+
+
+def touch_index(index, searches: int = 20):
+    """Run a few searches so the index pages are actually resident"""
+    queries = np.random.default_rng(0).random((searches, index.d), dtype='float32')
+    index.search(queries, 3)
+
+
+def run_worker(index_path: str, use_mmap: bool, preloaded, write_fd: int):
+    result = {'cold_load_ms': 0.0, 'warm_load_ms': 0.0}
+    index = preloaded
+    if index is None:
+        started = time.perf_counter()
+        index = read_faiss_index(index_path, use_mmap)
+        result['cold_load_ms'] = (time.perf_counter() - started) * 1000
+
+    touch_index(index)
+    result.update(memory_usage_kb())
+
+    # Measured after memory, so the second copy does not inflate RSS
+    if preloaded is None:
+        started = time.perf_counter()
+        read_faiss_index(index_path, use_mmap)
+        result['warm_load_ms'] = (time.perf_counter() - started) * 1000
+    os.write(write_fd, (json.dumps(result) + "\n").encode())
+
+
+def run_strategy(strategy: str, index_path: str, workers: int) -> dict:
+    use_mmap = strategy.endswith("mmap")
+    preloaded = None
+    master_load_ms = 0.0
+    if strategy.startswith("preload"):
+        started = time.perf_counter()
+        preloaded = read_faiss_index(index_path, use_mmap)
+        touch_index(preloaded)
+        master_load_ms = (time.perf_counter() - started) * 1000
+
+    read_fd, write_fd = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                run_worker(index_path, use_mmap, preloaded, write_fd)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    # Keep workers alive until all have measured, so shared pages are counted as shared
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        results = [json.loads(line) for line in f]
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    return {
+        'strategy': strategy,
+        'workers': len(results),
+        'master_load_ms': round(master_load_ms, 2),
+        'cold_load_ms': round(float(np.mean([r['cold_load_ms'] for r in results])), 2),
+        'warm_load_ms': round(float(np.mean([r['warm_load_ms'] for r in results])), 2),
+        'rss_kb_per_worker': int(np.mean([r['rss'] for r in results])),
+        'pss_kb_per_worker': int(np.mean([r['pss'] for r in results])),
+        'pss_kb_total': int(sum(r['pss'] for r in results)),
+    }
+
+
+def make_synthetic_index(vectors: int, dimension: int) -> str:
+    """Write a random IndexFlatL2 so the benchmark can be run at larger corpus sizes"""
+    data = np.random.default_rng(0).random((vectors, dimension), dtype='float32')
+    index = faiss.IndexFlatL2(dimension)
+    index.add(data)
+    path = os.path.join(tempfile.mkdtemp(), "synthetic.faiss")
+    faiss.write_index(index, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default=FAISS_INDEX_PATH, help="FAISS index file to load")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="benchmark a random index with N vectors instead")
+    parser.add_argument("--dimension", type=int, default=768, help="dimension of the synthetic index")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES, choices=STRATEGIES)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    index_path = make_synthetic_index(args.synthetic, args.dimension) if args.synthetic else args.index
+    size_mb = os.path.getsize(index_path) / 1024 / 1024
+    results = [run_strategy(strategy, index_path, args.workers) for strategy in args.strategies]
+
+    if args.json:
+        print(json.dumps({'index': index_path, 'index_mb': round(size_mb, 2), 'faiss_version': faiss.__version__,
+                          'results': results}, indent=2))
+        return
+
+    print(f"Index {index_path} ({size_mb:.1f} MB), {args.workers} workers, faiss {faiss.__version__}")
+    print(f"{'strategy':<14} {'master ms':>10} {'cold ms':>9} {'warm ms':>9} {'RSS/worker':>11} {'PSS/worker':>11} {'PSS total':>10}")
+    for r in results:
+        print(f"{r['strategy']:<14} {r['master_load_ms']:>10.1f} {r['cold_load_ms']:>9.1f} {r['warm_load_ms']:>9.1f} "
+              f"{r['rss_kb_per_worker'] / 1024:>9.1f}MB {r['pss_kb_per_worker'] / 1024:>9.1f}MB "
+              f"{r['pss_kb_total'] / 1024:>8.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+"""
+End-to-end load test of the app against a local stand-in for the Gemini API.
+
+    python -m benchmarks.load_test                                   # every scenario at concurrency 1, 4, 16
+    python -m benchmarks.load_test --scenarios ask stream --concurrency 8 32 --requests 400
+    python -m benchmarks.load_test --first-token-ms 800 --error-rate 0.02 --output results.json
+    python -m benchmarks.load_test --baseline results/main.json --max-regression 0.15
+
+Starts benchmarks/fake_gemini.py with the given latency model, then runs:
+
+    build      build_index.py into a scratch directory, cold and again with the
+               embedding cache warm: wall time, chunks/s and peak RSS
+    ask        the app (werkzeug threaded server, or --server gunicorn) serving
+               that index, POST /ask with the question mix at each concurrency
+    stream     the same with POST /ask/stream, also timing the first token
+    retrieval  embed + search + pack in this process (no generation)
+
+The question mix (benchmarks/questions.txt) is replayed with Zipf-distributed
+frequencies, so popular questions repeat and hit the answer cache as in real
+traffic. Each level reports throughput, latency p50/p90/p95/p99, errors, the
+answer cache hit rate, upstream calls per request and memory (server RSS for
+ask/stream, this process's RSS for retrieval).
+
+Results are printed as a table, or as JSON with --json / --output. With
+--baseline, results are compared to an earlier JSON file and the exit status
+is 1 if throughput dropped or p95 latency (build time) grew by more than
+--max-regression.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import requests
+
+from benchmarks.fake_gemini import add_config_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_QUESTIONS_PATH = os.path.join(REPO_DIR, "benchmarks", "questions.txt")
+DEFAULT_SOURCE_PATH = os.path.join(REPO_DIR, "school_handbook.md")
+SCENARIOS = ("build", "ask", "stream", "retrieval")
+RESULTS_FORMAT_VERSION = 1
+# Each client thread replays many users' questions; each user stays within the app's per-session burst
+QUESTIONS_PER_USER = 4
+
+# Server started in the scratch directory, so the app loads the index built there
+WERKZEUG_BOOT = """
+import app
+from werkzeug.serving import run_simple
+if not app.load_rag_data():
+    raise SystemExit("Failed to load RAG data")
+run_simple("127.0.0.1", {port}, app.app, threaded=True)
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def stop(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def rss_mb(pid) -> float:
+    """Resident memory of a process and all its descendants (Linux /proc)"""
+    total_kb, pending = 0, [str(pid)]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                total_kb += next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(f.read().split())
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1)
+
+
+def load_questions(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def sample_questions(questions: list, count: int, zipf: float = 1.0, seed: int = 0) -> list:
+    """`count` questions drawn with frequency proportional to 1 / rank ** zipf"""
+    weights = [1 / (rank ** zipf) for rank in range(1, len(questions) + 1)]
+    return random.Random(seed).choices(questions, weights=weights, k=count)
+
+
+def percentile_ms(latencies: list, q: float) -> float:
+    return round(float(np.percentile(latencies, q)) * 1000, 2) if latencies else None
+
+
+def summarize(outcomes: list, elapsed: float, concurrency: int) -> dict:
+    """Aggregate (seconds, ok, cached, first_token_seconds) tuples of one level"""
+    latencies = [seconds for seconds, ok, _, _ in outcomes if ok]
+    first_tokens = [first for _, ok, _, first in outcomes if ok and first is not None]
+    summary = {
+        'concurrency': concurrency,
+        'requests': len(outcomes),
+        'errors': sum(1 for _, ok, _, _ in outcomes if not ok),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(float(np.mean(latencies)) * 1000, 2) if latencies else None,
+        'p50_ms': percentile_ms(latencies, 50),
+        'p90_ms': percentile_ms(latencies, 90),
+        'p95_ms': percentile_ms(latencies, 95),
+        'p99_ms': percentile_ms(latencies, 99),
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+        'cache_hit_rate': round(sum(1 for _, ok, cached, _ in outcomes if ok and cached) / len(latencies), 4)
+                          if latencies else 0.0,
+    }
+    if first_tokens:
+        summary['first_token_p50_ms'] = percentile_ms(first_tokens, 50)
+        summary['first_token_p95_ms'] = percentile_ms(first_tokens, 95)
+    return summary
+
+
+def run_level(call, questions: list, concurrency: int) -> dict:
+    """Run `call(question)` for every question with `concurrency` threads"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(call, questions))
+    return summarize(outcomes, time.perf_counter() - started, concurrency)
+
+
+def upstream_calls(fake_url: str) -> int:
+    calls = requests.get(f"{fake_url}/stats", timeout=5).json()['calls']
+    return sum(count for name, count in calls.items() if name != "injected_errors")
+
+
+def run_build(workdir: str, env: dict, args) -> dict:
+    """Build the index twice, cold and with the embedding cache warm"""
+    shutil.copy(args.source, os.path.join(workdir, "school_handbook.md"))
+    command = [sys.executable, os.path.join(REPO_DIR, "build_index.py"), "--source", "school_handbook.md",
+               "--backend", "gemini", "--index-type", args.index_type, "--workers", str(args.build_workers)]
+    result = {}
+    for run in ("cold", "warm"):
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True)
+        output = process.stdout.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.perf_counter() - started
+        if process.returncode != 0:
+            raise RuntimeError(f"build_index.py failed:\n{output}")
+        with open(os.path.join(workdir, "school_handbook.meta.json")) as f:
+            chunks = json.load(f)['vectors']
+        result[run] = {
+            'seconds': round(seconds, 3),
+            'chunks': chunks,
+            'chunks_per_second': round(chunks / seconds, 1),
+            'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        }
+    return result
+
+
+def start_app(workdir: str, env: dict, args):
+    """Start the app on the scratch index; returns (process, base URL)"""
+    port = free_port()
+    if args.server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO_DIR, "gunicorn.conf.py"),
+                   "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers), "app:app"]
+    else:
+        command = [sys.executable, "-c", WERKZEUG_BOOT.format(port=port)]
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    wait_until_up(f"{url}/health", process)
+    return process, url
+
+
+def ask_caller(url: str, stream: bool, conversation: bool):
+    """A per-thread client for /ask or /ask/stream returning (seconds, ok, cached, first_token)"""
+    local = threading.local()
+    endpoint = f"{url}/ask/stream" if stream else f"{url}/ask"
+
+    def call(question: str):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.asked = 0
+        if local.asked % QUESTIONS_PER_USER == 0:
+            local.session.cookies.clear()  # The next user: a new app session on the same connection
+        local.asked += 1
+        body = {'question': question, 'conversation': conversation}
+        started = time.perf_counter()
+        try:
+            if not stream:
+                response = local.session.post(endpoint, json=body, timeout=120)
+                ok = response.status_code == 200
+                return time.perf_counter() - started, ok, ok and response.json().get('cached', False), None
+
+            first_token = None
+            ok = cached = False
+            with local.session.post(endpoint, json=body, stream=True, timeout=120) as response:
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event: "):
+                        event = line[7:]
+                        if event == "token" and first_token is None:
+                            first_token = time.perf_counter() - started
+                    elif line.startswith("data: ") and event == "done":
+                        ok, cached = True, json.loads(line[6:]).get('cached', False)
+            return time.perf_counter() - started, ok and response.status_code == 200, cached, first_token
+        except requests.RequestException:
+            return time.perf_counter() - started, False, False, None
+
+    return call
+
+
+def run_http_scenario(name: str, url: str, fake_url: str, server, args, question_mix: list) -> list:
+    call = ask_caller(url, stream=name == "stream", conversation=args.conversation)
+    for question in question_mix[:args.warmup]:
+        call(question)
+    levels = []
+    for concurrency in args.concurrency:
+        before = upstream_calls(fake_url)
+        level = run_level(call, question_mix, concurrency)
+        level['upstream_calls_per_request'] = round((upstream_calls(fake_url) - before) / len(question_mix), 3)
+        level['server_rss_mb'] = rss_mb(server.pid)
+        levels.append(level)
+        print(f"  {name} c={concurrency}: {level['throughput_rps']} req/s, p95 {level['p95_ms']} ms", file=sys.stderr)
+    return levels
+
+
+def run_retrieval(workdir: str, fake_url: str, args, question_mix: list) -> list:
+    """Retrieval (embed, search, pack) in this process against the scratch index"""
+    os.environ["GEMINI_API_ENDPOINT"] = fake_url
+    os.chdir(workdir)
+    # Imported here: app configures the Gemini client from the environment at import time
+    import app
+
+    if not app.load_rag_data():
+        raise RuntimeError("Failed to load the scratch index")
+
+    def call(question: str):
+        started = time.perf_counter()
+        chunks, info = app.retrieve_relevant_chunks(question, top_k=app.CONTEXT_CANDIDATES)
+        app.pack_retrieved(question, app.current_snapshot, chunks, info)
+        return time.perf_counter() - started, bool(chunks), False, None
+
+    for question in question_mix[:args.warmup]:
+        call(question)
+    levels = []
+    for concurrency in args.concurrency:
+        level = run_level(call, question_mix, concurrency)
+        level['process_rss_mb'] = rss_mb(os.getpid())
+        levels.append(level)
+        print(f"  retrieval c={concurrency}: {level['throughput_rps']} req/s, p95 {level['p95_ms']} ms", file=sys.stderr)
+    return levels
+
+
+def compare_to_baseline(results: dict, baseline: dict, max_regression: float) -> list:
+    """Regressions of more than `max_regression` (a fraction) against a baseline result"""
+    regressions = []
+    for run, current in results.get('build', {}).items():
+        previous = baseline.get('results', {}).get('build', {}).get(run)
+        if previous and current['seconds'] > previous['seconds'] * (1 + max_regression):
+            regressions.append(f"build ({run}): {previous['seconds']}s -> {current['seconds']}s")
+    for scenario in ("ask", "stream", "retrieval"):
+        previous_levels = {level['concurrency']: level for level in baseline.get('results', {}).get(scenario, [])}
+        for level in results.get(scenario, []):
+            previous = previous_levels.get(level['concurrency'])
+            if not previous:
+                continue
+            label = f"{scenario} c={level['concurrency']}"
+            if level['throughput_rps'] < previous['throughput_rps'] * (1 - max_regression):
+                regressions.append(f"{label} throughput: {previous['throughput_rps']} -> {level['throughput_rps']} req/s")
+            if previous['p95_ms'] and level['p95_ms'] and level['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+                regressions.append(f"{label} p95: {previous['p95_ms']} -> {level['p95_ms']} ms")
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(report: dict):
+    results = report['results']
+    for run, build in results.get('build', {}).items():
+        print(f"build ({run}): {build['seconds']:.2f}s, {build['chunks']} chunks, "
+              f"{build['chunks_per_second']} chunks/s, peak RSS {build['peak_rss_mb']} MB")
+    print(f"{'scenario':<10} {'conc':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'errors':>6} {'cached':>7} {'RSS MB':>8}")
+    for scenario in ("ask", "stream", "retrieval"):
+        for level in results.get(scenario, []):
+            memory = level.get('server_rss_mb', level.get('process_rss_mb'))
+            print(f"{scenario:<10} {level['concurrency']:>5} {level['throughput_rps']:>8.2f} {level['p50_ms'] or 0:>9.1f} "
+                  f"{level['p95_ms'] or 0:>9.1f} {level['p99_ms'] or 0:>9.1f} {level['errors']:>6} "
+                  f"{level['cache_hit_rate']:>7.2%} {memory:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests before the first level")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH, help="question mix, most frequent first")
+    parser.add_argument("--zipf", type=float, default=1.0, help="skew of the question frequencies (0 = uniform)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--conversation", action="store_true", help="let questions be treated as follow-ups")
+    parser.add_argument("--source", default=DEFAULT_SOURCE_PATH, help="handbook to index")
+    parser.add_argument("--index-type", default="flat", help="index type passed to build_index.py")
+    parser.add_argument("--build-workers", type=int, default=4, help="parallel embedding requests while building")
+    parser.add_argument("--server", default="werkzeug", choices=["werkzeug", "gunicorn"])
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    add_config_arguments(parser)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--json", action="store_true", help="print the JSON results instead of a table")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed throughput drop / latency growth against the baseline, as a fraction")
+    args = parser.parse_args()
+    # The retrieval scenario changes directory, so resolve the result paths first
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    question_mix = sample_questions(load_questions(args.questions), args.requests, args.zipf, args.seed)
+    fake_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake_args = [f"--{name.replace('_', '-')}={getattr(args, name)}" for name in (
+        "embed_latency_ms", "first_token_ms", "chunk_interval_ms", "jitter", "error_rate", "error_status",
+        "answer_tokens", "stream_chunks")]
+    fake = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_gemini", "--port", str(fake_port), *fake_args],
+                            cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    env = {**os.environ, "GEMINI_API_ENDPOINT": fake_url,
+           "PYTHONPATH": os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")]))}
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="rag-load-test-")
+    server = None
+    try:
+        wait_until_up(f"{fake_url}/stats", fake)
+        # Always build: the app and the retrieval scenario need an index built with the fake embeddings
+        print("Building the index against the fake API...", file=sys.stderr)
+        build = run_build(workdir, env, args)
+        if "build" in args.scenarios:
+            results['build'] = build
+        for scenario in ("ask", "stream"):
+            if scenario in args.scenarios:
+                if server is None:
+                    server, url = start_app(workdir, env, args)
+                results[scenario] = run_http_scenario(scenario, url, fake_url, server, args, question_mix)
+        if "retrieval" in args.scenarios:
+            results['retrieval'] = run_retrieval(workdir, fake_url, args, question_mix)
+    finally:
+        if server is not None:
+            stop(server)
+        stop(fake)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ("output", "json", "baseline")},
+        'results': results,
+    }
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_table(report)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
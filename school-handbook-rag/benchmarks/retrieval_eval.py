@@ -0,0 +1,264 @@
+"""
+Evaluate retrieval quality and speed over a labeled question set.
+
+    python -m benchmarks.retrieval_eval                                # the app's index, every retrieval mode
+    python -m benchmarks.retrieval_eval --modes vector hybrid -k 1 3 5 10 --show-misses
+    python -m benchmarks.retrieval_eval --index hnsw.faiss --metadata hnsw.meta.json --output hnsw.json
+    python -m benchmarks.retrieval_eval --baseline flat.json           # deltas against an earlier run
+    python -m benchmarks.retrieval_eval --modes hybrid rerank          # the reranking stage against its input
+
+Each line of the question set (benchmarks/eval_questions.jsonl) is a question
+and the handbook sections that answer it:
+
+    {"question": "Are hats allowed inside?", "sections": ["4.4"]}
+
+A retrieved chunk is relevant if it belongs to one of those sections or a
+subsection ("3.4" covers "3.4.2"); chunks without a section header belong to
+the section of the header before them, so indexes built with other chunking
+settings are judged the same way. For each mode (vector, keyword, hybrid,
+and rerank: a pool of RERANK_CANDIDATES hybrid results reranked as in
+reranker.py) it reports recall@k (share of the expected sections found in the top k),
+MRR within the largest k, nDCG@k with binary gains and the p50/p95/max latency of each query's
+search, measured one query at a time the way the app serves them.
+
+The embedder is the one recorded in the index metadata. Question embeddings
+are embedded in one batch and cached in the embedding cache under the
+RETRIEVAL_QUERY task type, so re-running against the same embedder makes
+no embedding calls.
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+import app as rag
+from build_index import EMBEDDING_CACHE_PATH
+from chunk_store import parse_section_header
+from embedders import get_embedder, read_index_metadata
+from embedding_cache import EmbeddingCache, content_hash
+from index_snapshot import load_snapshot
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_questions.jsonl")
+QUERY_TASK_TYPE = "RETRIEVAL_QUERY"
+MODES = ("vector", "keyword", "hybrid", "rerank")
+K_VALUES = [1, 3, 5, 10]
+
+
+def load_questions(path: str) -> list:
+    """Labeled questions: dicts with 'question' and a list of expected 'sections'"""
+    questions = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            if not item.get('question') or not item.get('sections'):
+                raise ValueError(f"{path}:{line_number}: needs a 'question' and a list of 'sections'")
+            questions.append({'question': item['question'], 'sections': [str(s) for s in item['sections']]})
+    return questions
+
+
+def chunk_sections(chunks) -> list:
+    """Section number of every chunk; chunks without a header continue the previous chunk's section"""
+    if hasattr(chunks, 'section'):
+        headers = [chunks.section(i) for i in range(len(chunks))]
+    else:
+        headers = [parse_section_header(chunk)[0] for chunk in chunks]
+    sections, current = [], ""
+    for header in headers:
+        current = header or current
+        sections.append(current)
+    return sections
+
+
+def matching_label(section: str, labels: list):
+    """The expected label a chunk's section falls under, or None"""
+    for label in labels:
+        if section == label or section.startswith(label + "."):
+            return label
+    return None
+
+
+def embed_questions(embedder, questions: list, cache_path: str) -> tuple:
+    """Question vectors, embedding only the ones missing from the cache; returns (vectors, stats)"""
+    model = embedder.describe()['model']
+    texts = [item['question'] for item in questions]
+    hashes = [content_hash(text) for text in texts]
+    cache = EmbeddingCache(cache_path) if cache_path else None
+    try:
+        vectors = cache.get_many(hashes, model, QUERY_TASK_TYPE) if cache else {}
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        started = time.perf_counter()
+        if missing:
+            new_vectors = embedder.embed_queries(list(missing.values()))
+            vectors.update(zip(missing, new_vectors))
+            if cache:
+                cache.put_many(list(missing), new_vectors, model, QUERY_TASK_TYPE)
+        elapsed = time.perf_counter() - started
+    finally:
+        if cache:
+            cache.close()
+    stats = {'cached': len(set(hashes)) - len(missing), 'embedded': len(missing),
+             'embed_seconds': round(elapsed, 3)}
+    return [np.asarray(vectors[key], dtype='float32') for key in hashes], stats
+
+
+def retrieve(mode: str, question: str, vector, top_k: int, snapshot) -> list:
+    """Ranked chunk ids from one retrieval mode of the app"""
+    if mode == "vector":
+        _, infos = rag.search_chunks(vector, top_k, snapshot)
+    elif mode == "keyword":
+        _, infos = rag.keyword_search_chunks(question, top_k, snapshot)
+    elif mode == "hybrid":
+        _, infos = rag.hybrid_search_chunks(question, vector, top_k, snapshot)
+    else:
+        results = rag.hybrid_search_chunks(question, vector, max(top_k, rag.RERANK_CANDIDATES), snapshot)
+        _, infos = rag.rerank_chunks(question, snapshot, *results, top_k)
+    return [info['index'] for info in infos]
+
+
+def score_ranking(ranked: list, labels: list, sections: list, k_values: list) -> dict:
+    """recall@k, reciprocal rank and nDCG@k of one ranked list of chunk ids"""
+    matches = [matching_label(sections[i], labels) for i in ranked]
+    relevant_total = sum(1 for section in sections if matching_label(section, labels))
+    first = next((rank for rank, label in enumerate(matches, 1) if label), None)
+    scores = {'first_relevant_rank': first, 'reciprocal_rank': 1.0 / first if first else 0.0}
+    for k in k_values:
+        top = matches[:k]
+        scores[f'recall@{k}'] = len({label for label in top if label}) / len(labels)
+        dcg = sum(1.0 / math.log2(rank + 1) for rank, label in enumerate(top, 1) if label)
+        ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(k, relevant_total) + 1))
+        scores[f'ndcg@{k}'] = dcg / ideal if ideal else 0.0
+    return scores
+
+
+def evaluate_mode(mode: str, questions: list, vectors: list, snapshot, sections: list, k_values: list) -> dict:
+    """Run every question through one retrieval mode; returns the summary and per-question results"""
+    top_k = max(k_values)
+    retrieve(mode, questions[0]['question'], vectors[0], top_k, snapshot)  # Warm up before timing
+    per_query = []
+    for item, vector in zip(questions, vectors):
+        started = time.perf_counter()
+        ranked = retrieve(mode, item['question'], vector, top_k, snapshot)
+        latency_ms = (time.perf_counter() - started) * 1000
+        scores = score_ranking(ranked, item['sections'], sections, k_values)
+        per_query.append({'question': item['question'], 'expected': item['sections'],
+                          'retrieved': [sections[i] for i in ranked], 'latency_ms': round(latency_ms, 3), **scores})
+
+    latencies = [result['latency_ms'] for result in per_query]
+    summary = {'mode': mode, 'questions': len(per_query),
+               'mrr': round(float(np.mean([r['reciprocal_rank'] for r in per_query])), 4)}
+    for k in k_values:
+        summary[f'recall@{k}'] = round(float(np.mean([r[f'recall@{k}'] for r in per_query])), 4)
+        summary[f'ndcg@{k}'] = round(float(np.mean([r[f'ndcg@{k}'] for r in per_query])), 4)
+    summary.update({
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'max_ms': round(float(max(latencies)), 3),
+    })
+    return {'summary': summary, 'queries': per_query}
+
+
+def make_embedder_factory(metadata_path: str, backend: str, local_embedder_path: str):
+    """Build the embedder named in the index metadata unless a backend is given"""
+    built_with = read_index_metadata(metadata_path)['embedder']
+    backend = backend or built_with['backend']
+    model_name = built_with.get('model') if backend == 'gemini' else rag.EMBEDDING_MODEL_NAME
+    return lambda: get_embedder(backend, model_name or rag.EMBEDDING_MODEL_NAME, local_embedder_path)
+
+
+def print_report(report: dict, baseline: dict = None):
+    config = report['config']
+    print(f"{config['questions']} questions, {config['index_type']} index ({config['metric']}), "
+          f"{config['chunks']} chunks, embedder {config['embedder']['model']}")
+    embedding = report['embedding']
+    print(f"Question embeddings: {embedding['cached']} cached, {embedding['embedded']} embedded "
+          f"in {embedding['embed_seconds']:.2f}s")
+    columns = [name for name in report['results'][0]['summary'] if name not in ('mode', 'questions')]
+    print(f"{'mode':<8} " + " ".join(f"{name:>9}" for name in columns))
+    previous = {result['summary']['mode']: result['summary'] for result in (baseline or {}).get('results', [])}
+    for result in report['results']:
+        summary = result['summary']
+        print(f"{summary['mode']:<8} " + " ".join(f"{summary[name]:>9.3f}" for name in columns))
+        before = previous.get(summary['mode'])
+        if before:
+            print(f"{'  delta':<8} " + " ".join(
+                f"{summary[name] - before[name]:>+9.3f}" if name in before else f"{'':>9}" for name in columns))
+
+
+def print_misses(report: dict, k: int):
+    for result in report['results']:
+        misses = [query for query in result['queries'] if query[f'recall@{k}'] < 1.0]
+        print(f"\n{result['summary']['mode']}: {len(misses)} question(s) missing an expected section in the top {k}")
+        for query in misses:
+            print(f"  {query['question']!r} expected {', '.join(query['expected'])}, "
+                  f"got {', '.join(s or '-' for s in query['retrieved'][:k])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="labeled question set (JSON lines)")
+    parser.add_argument("--index", default=rag.FAISS_INDEX_PATH)
+    parser.add_argument("--chunks", default=rag.CHUNKS_DATA_PATH)
+    parser.add_argument("--metadata", default=rag.INDEX_METADATA_PATH)
+    parser.add_argument("--lexical", default=rag.LEXICAL_INDEX_PATH, help="BM25 index (keyword and hybrid modes)")
+    parser.add_argument("--backend", help="embedding backend (default: the one recorded in the index metadata)")
+    parser.add_argument("--local-embedder", default=rag.LOCAL_EMBEDDER_PATH, help="fitted local-hashing embedder")
+    parser.add_argument("--nprobe", type=int, default=rag.FAISS_NPROBE, help="IVF clusters searched per query")
+    parser.add_argument("--ef-search", type=int, default=rag.FAISS_EF_SEARCH, help="HNSW candidate list size")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("-k", type=int, nargs="+", default=K_VALUES, help="cutoffs for recall@k and nDCG@k")
+    parser.add_argument("--cache", default=EMBEDDING_CACHE_PATH, help="embedding cache for the questions ('' disables)")
+    parser.add_argument("--show-misses", action="store_true", help="list questions missing a section in the top k")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    k_values = sorted(set(args.k))
+    questions = load_questions(args.questions)
+    snapshot = load_snapshot(args.index, args.chunks, args.metadata,
+                             make_embedder_factory(args.metadata, args.backend, args.local_embedder),
+                             lexical_path=args.lexical, mmap_index=rag.FAISS_MMAP,
+                             nprobe=args.nprobe, ef_search=args.ef_search, reconstruct="rerank" in args.modes)
+    modes = [mode for mode in args.modes if mode == "vector" or snapshot.lexical is not None]
+    if len(modes) < len(args.modes):
+        print(f"⚠️ No keyword index at {args.lexical}, evaluating {', '.join(modes)} only")
+
+    # Time each search on its own, as one request would run it
+    rag.QUERY_BATCHING_ENABLED = False
+    vectors, embedding = embed_questions(snapshot.embedder, questions, args.cache)
+    sections = chunk_sections(snapshot.chunks)
+
+    results = [evaluate_mode(mode, questions, vectors, snapshot, sections, k_values) for mode in modes]
+    report = {
+        'config': {'questions': len(questions), 'question_set': args.questions, 'k': k_values,
+                   'nprobe': args.nprobe, 'ef_search': args.ef_search, **snapshot.describe()},
+        'embedding': embedding,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.show_misses:
+        print_misses(report, k_values[min(1, len(k_values) - 1)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Build the FAISS index from the handbook source.
+
+    python build_index.py                          # school_handbook.md with EMBEDDING_BACKEND from app.py
+    python build_index.py --source handbook.md --backend local-hashing
+    python build_index.py --index-type hnsw --metric ip
+    python build_index.py --tenant riverside       # tenants/riverside/school_handbook.md into tenants/riverside/
+    python build_index.py --source handbooks/      # every Markdown, text and HTML document in a directory
+
+Documents are chunked by chunking.py within the CHUNK_MAX_TOKENS and
+CHUNK_OVERLAP_TOKENS limits; a directory source is ingested in parallel
+(see ingest.py). Each chunk is hashed and its embedding looked up in an on-disk cache keyed by
+(content hash, model, task_type), so only new or changed chunks are embedded.
+Missing embeddings are computed in parallel batches with retries, and the
+cache is committed after every batch: an interrupted build resumes where it
+stopped. The new index, chunks and metadata are written to temporary files
+and swapped in with os.replace.
+
+A BM25 keyword index (lexical_index.py) is built from the same chunks.
+The index type and metric (see ann_index.py) are recorded in the metadata
+so the app searches the index the way it was built. With
+--precompute-answers the precomputed answers (precomputed_answers.py) are
+generated for the new index before the running app picks it up.
+"""
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import faiss
+import numpy as np
+
+from ann_index import INDEX_TYPES, METRICS, create_index
+from app import (CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNKS_DATA_PATH, EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME,
+                 FAISS_INDEX_PATH, FAISS_INDEX_TYPE, FAISS_METRIC, GENERATION_MODEL_NAME, INDEX_METADATA_PATH,
+                 INGEST_WORKERS, LEXICAL_INDEX_PATH, LOCAL_EMBEDDER_PATH, TENANTS_DIR)
+from chunk_store import write_chunk_store
+from chunking import get_school_handbook_chunks
+from ingest import HTML_SUFFIXES, IngestStats, chunk_path, ingest
+from embedders import HashingEmbedder, get_embedder, write_index_metadata
+from embedding_cache import EmbeddingCache, content_hash
+from lexical_index import LexicalIndex
+
+DEFAULT_SOURCE_PATH = "school_handbook.md"
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+DOCUMENT_TASK_TYPE = "RETRIEVAL_DOCUMENT"
+
+
+def with_retries(fn, *args, attempts: int = 5, base_delay: float = 1.0, max_delay: float = 30.0):
+    """Call fn(*args), retrying with exponential backoff and jitter"""
+    for attempt in range(attempts):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+            print(f"  Retrying in {delay:.1f}s after error: {e}")
+            time.sleep(delay)
+
+
+def atomic_write(path: str, write):
+    """Write a file through `write(tmp_path)`, then atomically move it into place"""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def embed_chunks(chunks: list, embedder, cache: EmbeddingCache, batch_size: int, workers: int) -> np.ndarray:
+    """Embed chunks, reusing cached embeddings and embedding the rest in parallel batches"""
+    model = embedder.describe()['model']
+    hashes = [content_hash(chunk) for chunk in chunks]
+    vectors = cache.get_many(hashes, model, DOCUMENT_TASK_TYPE)
+
+    # Identical chunks only need to be embedded once
+    missing = {}
+    for key, chunk in zip(hashes, chunks):
+        if key not in vectors:
+            missing.setdefault(key, chunk)
+    print(f"{len(chunks) - len(missing)} chunks cached, {len(missing)} to embed")
+
+    def embed_batch(batch):
+        batch_vectors = with_retries(embedder.embed_documents, [chunk for _, chunk in batch])
+        cache.put_many([key for key, _ in batch], batch_vectors, model, DOCUMENT_TASK_TYPE)
+        return batch, batch_vectors
+
+    items = list(missing.items())
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in as_completed([executor.submit(embed_batch, batch) for batch in batches]):
+            batch, batch_vectors = future.result()
+            for (key, _), vector in zip(batch, batch_vectors):
+                vectors[key] = vector
+            done += len(batch)
+            print(f"  Embedded {done}/{len(items)} chunks")
+
+    return np.vstack([vectors[key] for key in hashes]).astype('float32')
+
+
+def count_chunk_tokens(chunks: list, cache: EmbeddingCache, workers: int) -> list:
+    """Count tokens per chunk with the generation model, in parallel and cached"""
+    import google.generativeai as genai
+
+    model = genai.GenerativeModel(GENERATION_MODEL_NAME)
+    hashes = [content_hash(chunk) for chunk in chunks]
+    counts = cache.get_token_counts(hashes, GENERATION_MODEL_NAME)
+    missing = {key: chunk for key, chunk in zip(hashes, chunks) if key not in counts}
+
+    def count(item):
+        key, chunk = item
+        return key, with_retries(model.count_tokens, chunk).total_tokens
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        new_counts = dict(executor.map(count, missing.items()))
+    cache.put_token_counts(new_counts, GENERATION_MODEL_NAME)
+    counts.update(new_counts)
+    return [counts[key] for key in hashes]
+
+
+def build_index(chunks: list, backend: str, cache_path: str = EMBEDDING_CACHE_PATH,
+                batch_size: int = 100, workers: int = 4, count_tokens: bool = False,
+                index_type: str = FAISS_INDEX_TYPE, metric: str = FAISS_METRIC, nlist: int = None,
+                source: str = None, output_dir: str = ""):
+    """Embed the chunks and atomically replace the FAISS index, chunks and metadata in `output_dir`.
+
+    `source` is the document the chunks were split from; the chunk store records their offsets in it.
+    """
+    if backend == HashingEmbedder.backend:
+        # The local embedder learns its IDF weights from the indexed chunks
+        embedder = HashingEmbedder().fit(chunks)
+    else:
+        embedder = get_embedder(backend, EMBEDDING_MODEL_NAME)
+
+    cache = EmbeddingCache(cache_path)
+    try:
+        embeddings_np = embed_chunks(chunks, embedder, cache, batch_size, workers)
+        print(f"Embedded {embeddings_np.shape[0]} chunks (dimension {embeddings_np.shape[1]})")
+
+        extra = {}
+        token_counts = None
+        if count_tokens:
+            token_counts = count_chunk_tokens(chunks, cache, workers)
+            extra['total_tokens'] = sum(token_counts)
+            print(f"Total tokens in all chunks: {extra['total_tokens']}")
+    finally:
+        cache.close()
+
+    started = time.perf_counter()
+    index, description = create_index(embeddings_np, index_type, metric, nlist)
+    print(f"Built {description} index ({metric}) in {time.perf_counter() - started:.1f}s")
+    if description == "Flat" and index_type != "flat":
+        print(f"⚠️ Too few chunks to train a {index_type} index, using exact search")
+        index_type = "flat"
+    extra['index'] = {'type': index_type, 'metric': metric, 'factory': description}
+    lexical = LexicalIndex.build(chunks)
+
+    # Metadata is written last: it names the embedder the other files belong to
+    index_path, chunks_path, lexical_path, metadata_path = (os.path.join(output_dir, path) for path in (
+        FAISS_INDEX_PATH, CHUNKS_DATA_PATH, LEXICAL_INDEX_PATH, INDEX_METADATA_PATH))
+    if backend == HashingEmbedder.backend:
+        atomic_write(os.path.join(output_dir, LOCAL_EMBEDDER_PATH), embedder.save)
+    atomic_write(index_path, lambda path: faiss.write_index(index, path))
+    atomic_write(chunks_path, lambda path: write_chunk_store(path, chunks, token_counts, source))
+    atomic_write(lexical_path, lexical.save)
+    atomic_write(metadata_path, lambda path: write_index_metadata(path, embedder, index.ntotal, **extra))
+    print(f"Saved {index_path}, {chunks_path}, {lexical_path} and {metadata_path}")
+    return index
+
+
+def precompute_answers(tenant_id: str = None):
+    """Generate the precomputed answers for the index just written, as the app will load it"""
+    import app as rag
+    if tenant_id is None and not rag.load_rag_data():
+        raise SystemExit("Failed to load the new index")
+    tenant = rag.resolve_tenant(tenant_id)
+    if not tenant.precomputed.regenerate_now(tenant.snapshot.version):
+        print(f"⚠️ Answers not precomputed: {tenant.precomputed.last_error or 'locked by another process'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="build-index", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="handbook file (Markdown, text or HTML) or a directory of them "
+                                         f"(default: {DEFAULT_SOURCE_PATH} of the tenant)")
+    parser.add_argument("--tenant", help=f"build a school's handbook in {TENANTS_DIR}/<tenant>/ (see tenants.py)")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=["gemini", HashingEmbedder.backend],
+                        help="embedding backend (default: EMBEDDING_BACKEND in app.py)")
+    parser.add_argument("--cache", default=EMBEDDING_CACHE_PATH, help="embedding cache database")
+    parser.add_argument("--batch-size", type=int, default=100, help="chunks per embedding request")
+    parser.add_argument("--workers", type=int, default=4, help="parallel embedding requests")
+    parser.add_argument("--count-tokens", action="store_true", help="count tokens per chunk with the generation model")
+    parser.add_argument("--index-type", default=FAISS_INDEX_TYPE, choices=INDEX_TYPES,
+                        help="FAISS index type (default: FAISS_INDEX_TYPE in app.py)")
+    parser.add_argument("--metric", default=FAISS_METRIC, choices=METRICS,
+                        help="l2 distance, or ip (cosine similarity on normalized vectors)")
+    parser.add_argument("--nlist", type=int, help="IVF clusters (default: about 4 * sqrt(chunks))")
+    parser.add_argument("--max-chunk-tokens", type=int, default=CHUNK_MAX_TOKENS,
+                        help="split longer chunks (default: CHUNK_MAX_TOKENS, 0 for no limit)")
+    parser.add_argument("--chunk-overlap-tokens", type=int, default=CHUNK_OVERLAP_TOKENS,
+                        help="overlap between the pieces of a split chunk (default: CHUNK_OVERLAP_TOKENS)")
+    parser.add_argument("--ingest-workers", type=int, default=INGEST_WORKERS,
+                        help="processes chunking a directory source (default: INGEST_WORKERS)")
+    parser.add_argument("--precompute-answers", action="store_true",
+                        help="answer the quick questions and top logged questions for the new index")
+    args = parser.parse_args()
+
+    output_dir = os.path.join(TENANTS_DIR, args.tenant) if args.tenant else ""
+    if args.tenant and not os.path.isdir(output_dir):
+        parser.error(f"No directory {output_dir} for tenant {args.tenant}")
+    args.source = args.source or os.path.join(output_dir, DEFAULT_SOURCE_PATH)
+
+    started = time.perf_counter()
+    limits = (args.max_chunk_tokens, args.chunk_overlap_tokens)
+    source = None  # Chunk offsets are recorded for a single Markdown or text document
+    if os.path.isdir(args.source):
+        stats = IngestStats()
+        chunks = [chunk for _, document_chunks in ingest(args.source, args.ingest_workers, *limits, stats)
+                  for chunk in document_chunks]
+        stats.print_report()
+    elif args.source.lower().endswith(HTML_SUFFIXES):
+        chunks = chunk_path(args.source, *limits)
+    else:
+        with open(args.source, encoding="utf-8") as f:
+            source = f.read()
+        chunks = get_school_handbook_chunks(source, *limits)
+    if not chunks:
+        parser.error(f"No chunks were generated from {args.source}")
+    print(f"Split {args.source} into {len(chunks)} chunks")
+
+    build_index(chunks, args.backend, args.cache, args.batch_size, args.workers, args.count_tokens,
+                args.index_type, args.metric, args.nlist, source, output_dir)
+    if args.precompute_answers:
+        precompute_answers(args.tenant)
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Memory-mapped chunk store.
+
+Replaces the pickled list of chunk strings with a single file that is opened
+with mmap, so opening it takes constant time regardless of corpus size and
+pre-forked workers share its pages through the OS page cache. Layout:
+
+    magic (8 bytes) | header length (uint32) | JSON header | padding
+    offsets  uint64[count + 1]   byte offsets of each chunk in the text blob
+    metadata fixed-width records, one per chunk (see METADATA_DTYPE)
+    text     UTF-8 text of all chunks, concatenated
+
+The metadata records each chunk's numbered section, title, parent section
+chunk and byte range in the source document, so retrieval can cite section
+paths, expand a hit to its parent or sibling sections and filter by
+top-level section without re-embedding. The header stores the metadata
+dtype, so stores written before a field existed can still be read.
+
+Migrate an existing pickle with:
+
+    python chunk_store.py school_handbook_chunks.pkl school_handbook.chunks
+"""
+import json
+import mmap
+import os
+import pickle
+import re
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"HBCHUNK1"
+METADATA_DTYPE = np.dtype([
+    ('section', 'S16'),      # e.g. b"3.4.1", empty for unnumbered chunks
+    ('title', 'S96'),        # UTF-8, truncated to fit
+    ('token_count', '<i4'),
+    ('parent', '<i4'),       # chunk index of the enclosing section, -1 if none
+    ('source_start', '<i8'), # byte range of the chunk in the source document, -1 if unknown
+    ('source_end', '<i8'),
+])
+SECTION_PATH_SEPARATOR = " › "
+
+# **3.4. Title** (closing ** optional), or a Markdown heading "## 3.4 Title" / "## 3. Title"
+_section_header_pattern = re.compile(r"^\s*(?:\*\*(\d+(?:\.\d+){0,2})\.|#{1,6}\s+(\d+(?:\.\d+){1,2}\.?|\d+\.))\s+(.+?)(?:\*\*|$)")
+
+
+def parse_section_header(chunk: str):
+    """Return (section number, title) from a chunk's first line, or ("", "")"""
+    first_line = chunk.split("\n", 1)[0].strip()
+    match = _section_header_pattern.match(first_line)
+    if not match:
+        return "", ""
+    section = (match.group(1) or match.group(2)).rstrip(".")
+    return section, match.group(3).strip().rstrip("*:#").strip()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) when no exact count is available"""
+    return max(1, len(text) // 4)
+
+
+def section_parents(sections: list) -> np.ndarray:
+    """
+    Chunk index of each section's enclosing section ("3.4" for "3.4.1"), -1 if none.
+    The nearest preceding chunk is used, since several documents (or the
+    pieces of a split section) can carry the same section number.
+    """
+    position = {}
+    parents = np.full(len(sections), -1, dtype='<i4')
+    for i, section in enumerate(sections):
+        if "." in section:
+            parents[i] = position.get(section.rsplit(".", 1)[0], -1)
+        if section:
+            position[section] = i
+    return parents
+
+
+def locate_chunks(source: str, chunks: list) -> list:
+    """(start, end) UTF-8 byte offsets of each chunk in the source, (-1, -1) if not found verbatim"""
+    source_bytes = source.encode("utf-8")
+    ranges = []
+    cursor = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        start = source_bytes.find(data, cursor)
+        if start < 0:
+            ranges.append((-1, -1))
+            continue
+        ranges.append((start, start + len(data)))
+        cursor = start + len(data)
+    return ranges
+
+
+def _truncate_utf8(text: str, size: int) -> bytes:
+    return text.encode("utf-8")[:size].decode("utf-8", errors="ignore").encode("utf-8")
+
+
+def _align(position: int, alignment: int = 8) -> int:
+    return (position + alignment - 1) // alignment * alignment
+
+
+def write_chunk_store(path: str, chunks: list, token_counts: list = None, source: str = None):
+    """Write chunks (and their section metadata) in the chunk store format.
+
+    Pass the source document the chunks were split from to record their byte offsets.
+    """
+    encoded = [chunk.encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(chunks) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(data) for data in encoded])
+
+    metadata = np.zeros(len(chunks), dtype=METADATA_DTYPE)
+    sections = []
+    for i, chunk in enumerate(chunks):
+        section, title = parse_section_header(chunk)
+        sections.append(section)
+        metadata[i]['section'] = section.encode("ascii")
+        metadata[i]['title'] = _truncate_utf8(title, METADATA_DTYPE['title'].itemsize)
+        metadata[i]['token_count'] = token_counts[i] if token_counts else estimate_tokens(chunk)
+    metadata['parent'] = section_parents(sections)
+    source_ranges = locate_chunks(source, chunks) if source is not None else [(-1, -1)] * len(chunks)
+    metadata['source_start'] = [start for start, _ in source_ranges]
+    metadata['source_end'] = [end for _, end in source_ranges]
+
+    header = {
+        'count': len(chunks),
+        'metadata_dtype': METADATA_DTYPE.descr,
+        'token_counts': 'exact' if token_counts else 'estimated',
+    }
+    # Section positions depend on the header length, so lay it out until that length settles
+    header_bytes = b""
+    while True:
+        offsets_at = _align(len(MAGIC) + 4 + len(header_bytes))
+        metadata_at = _align(offsets_at + offsets.nbytes)
+        text_at = metadata_at + metadata.nbytes
+        header.update(offsets_offset=offsets_at, metadata_offset=metadata_at, text_offset=text_at)
+        laid_out_for = len(header_bytes)
+        header_bytes = json.dumps(header).encode("utf-8")
+        if len(header_bytes) == laid_out_for:
+            break
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * (offsets_at - f.tell()))
+        f.write(offsets.tobytes())
+        f.write(b"\0" * (metadata_at - f.tell()))
+        f.write(metadata.tobytes())
+        for data in encoded:
+            f.write(data)
+
+
+class ChunkStore:
+    """
+    Read-only, memory-mapped view of a chunk store file.
+
+    Behaves like the list of chunk strings it replaces (`len`, indexing,
+    iteration); chunk text and section metadata are only decoded when they
+    are accessed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a chunk store file")
+        (header_length,) = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self._mmap[start:start + header_length])
+
+        count = self.header['count']
+        metadata_dtype = np.dtype([tuple(field) for field in self.header['metadata_dtype']])
+        self.offsets = np.frombuffer(self._mmap, dtype='<u8', count=count + 1,
+                                     offset=self.header['offsets_offset'])
+        self.metadata = np.frombuffer(self._mmap, dtype=metadata_dtype, count=count,
+                                      offset=self.header['metadata_offset'])
+        self._text_offset = self.header['text_offset']
+
+        # Built from the metadata column on first use, so opening stays constant-time
+        self._parents = None
+        self._top_level_sections = None
+        self._top_level_masks = {}
+
+    def __len__(self):
+        return self.header['count']
+
+    def _bytes(self, i: int, limit: int = None) -> bytes:
+        start = self._text_offset + int(self.offsets[i])
+        end = self._text_offset + int(self.offsets[i + 1])
+        if limit is not None:
+            end = min(end, start + limit)
+        return self._mmap[start:end]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        return self._bytes(i).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def preview(self, i: int, length: int = 200) -> str:
+        """First `length` characters of a chunk, decoding only what is needed"""
+        i = int(i)
+        size = int(self.offsets[i + 1] - self.offsets[i])
+        text = self._bytes(i, limit=length * 4).decode("utf-8", errors="ignore")
+        if len(text) > length or size > length * 4:
+            return text[:length] + "..."
+        return text
+
+    def chunk_metadata(self, i: int) -> dict:
+        i = int(i)
+        record = self.metadata[i]
+        metadata = {
+            'section': self.section(i),
+            'section_path': self.section_path(i),
+            'title': record['title'].decode("utf-8"),
+            'parent': int(self.parents[i]),
+            'token_count': int(record['token_count']),
+        }
+        if 'source_start' in self.metadata.dtype.names and record['source_start'] >= 0:
+            metadata['source_range'] = [int(record['source_start']), int(record['source_end'])]
+        return metadata
+
+    def token_count(self, i: int) -> int:
+        return int(self.metadata[int(i)]['token_count'])
+
+    # --- Section hierarchy ------------------------------------------------
+
+    def section(self, i: int) -> str:
+        """A chunk's section number ("3.4.1"), empty for unnumbered chunks"""
+        return self.metadata[int(i)]['section'].decode("ascii")
+
+    @property
+    def parents(self) -> np.ndarray:
+        """Chunk index of each chunk's enclosing section, -1 if none"""
+        if 'parent' in self.metadata.dtype.names:
+            return self.metadata['parent']
+        if self._parents is None:
+            # Stores written before the parent field was added
+            self._parents = section_parents([self.section(i) for i in range(len(self))])
+        return self._parents
+
+    def section_label(self, i: int) -> str:
+        """Section number and title for a numbered section, otherwise the chunk's first line"""
+        i = int(i)
+        section = self.section(i)
+        if section:
+            return f"{section}. {self.metadata[i]['title'].decode('utf-8')}"
+        first_line = self.preview(i, 80).split("\n", 1)[0]
+        return first_line.strip().strip("*#").strip()
+
+    def section_path(self, i: int) -> str:
+        """Labels from the top-level section down to this chunk, joined with SECTION_PATH_SEPARATOR"""
+        labels = []
+        i = int(i)
+        while i >= 0 and len(labels) < 8:
+            labels.append(self.section_label(i))
+            i = int(self.parents[i])
+        return SECTION_PATH_SEPARATOR.join(reversed(labels))
+
+    def siblings(self, i: int) -> np.ndarray:
+        """Other chunks with the same parent section (none for top-level sections)"""
+        parent = self.parents[int(i)]
+        if parent < 0:
+            return np.array([], dtype=np.int64)
+        siblings = np.flatnonzero(self.parents == parent)
+        return siblings[siblings != int(i)]
+
+    def top_level_sections(self) -> list:
+        """[{'section': "3", 'title': "ACADEMIC POLICIES"}, ...] in document order"""
+        if self._top_level_sections is None:
+            sections = self.metadata['section']
+            top_level = np.flatnonzero((sections != b"") & (np.char.find(sections, b".") < 0))
+            self._top_level_sections = [{'section': self.section(i), 'title': self.metadata[i]['title'].decode("utf-8")}
+                                        for i in top_level]
+        return self._top_level_sections
+
+    def top_level_mask(self, section: str) -> np.ndarray:
+        """
+        Boolean mask of the chunks in a top-level section, given by number ("3")
+        or title ("Academic Policies"); raises KeyError for an unknown section.
+        """
+        key = section.strip().rstrip(".").lower()
+        if key not in self._top_level_masks:
+            number = next((s['section'] for s in self.top_level_sections()
+                           if key in (s['section'], s['title'].lower())), None)
+            if number is None:
+                raise KeyError(section)
+            sections = self.metadata['section']
+            prefix = number.encode("ascii")
+            self._top_level_masks[key] = (sections == prefix) | np.char.startswith(sections, prefix + b".")
+        return self._top_level_masks[key]
+
+
+def load_chunks(path: str):
+    """Open a chunk store, or unpickle a legacy `.pkl` chunk list"""
+    if path.endswith(".pkl"):
+        print(f"⚠️  Loading chunks from pickle {path}; run `python chunk_store.py {path} <output>` to migrate")
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return ChunkStore(path)
+
+
+def migrate_pickle(pickle_path: str, store_path: str):
+    """Convert a pickled chunk list into the chunk store format"""
+    with open(pickle_path, "rb") as f:
+        chunks = pickle.load(f)
+    tmp_path = f"{store_path}.tmp-{os.getpid()}"
+    write_chunk_store(tmp_path, chunks)
+    os.replace(tmp_path, store_path)
+    print(f"Migrated {len(chunks)} chunks from {pickle_path} to {store_path}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(f"usage: python {sys.argv[0]} <chunks.pkl> <output.chunks>")
+    migrate_pickle(sys.argv[1], sys.argv[2])
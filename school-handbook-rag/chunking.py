@@ -0,0 +1,151 @@
+import re
+
+from chunk_store import estimate_tokens
+
+BLOCK_SEPARATOR = "---"
+TABLE_OF_CONTENTS_MARKER = "**TABLE OF CONTENTS**"
+CHARS_PER_TOKEN = 4  # The ratio estimate_tokens assumes
+
+# Lines that start a new chunk, matched against the stripped line (compiled once):
+# - Numbered section headers: **1. TITLE**, **1.1. TITLE**, **3.4.1. TITLE** (closing ** optional)
+# - Numbered Markdown headings: ## 1. TITLE, ## 3.4 TITLE
+# - The disclaimer: *(Disclaimer: ...)*
+_section_header_pattern = re.compile(
+    r"\*\*\d+(?:\.\d+){0,2}\.\s+.|#{1,6}\s+(?:\d+(?:\.\d+){1,2}\.?|\d+\.)\s+.|\*\(Disclaimer:.*?\)\*$")
+# Markdown headings (# Title). A run of headings stays together, so a title and subtitle are one chunk.
+_heading_pattern = re.compile(r"#{1,6}\s")
+
+
+def split_blocks(lines):
+    """Group lines into the blocks between "---" separator lines, stripped; empty blocks are skipped"""
+    block = []
+    for line in lines:
+        if line == BLOCK_SEPARATOR and block:
+            text = "\n".join(block).strip()
+            if text:
+                yield text
+            block = []
+        else:
+            block.append(line)
+    text = "\n".join(block).strip()
+    if text:
+        yield text
+
+
+def chunk_block(block: str):
+    """Split one block into chunks, each starting at a section header or heading"""
+    # The Table of Contents is kept as one chunk
+    if TABLE_OF_CONTENTS_MARKER in block:
+        yield block
+        return
+
+    lines = []
+    has_body = False  # Whether the current chunk has lines other than headings
+    for line in block.split("\n"):
+        stripped = line.strip()
+        if _section_header_pattern.match(stripped):
+            starts_chunk, is_heading = True, False
+        elif _heading_pattern.match(stripped):
+            starts_chunk, is_heading = has_body, True
+        else:
+            starts_chunk, is_heading = False, False
+
+        if starts_chunk and lines:
+            chunk = "\n".join(lines).strip()
+            if chunk:
+                yield chunk
+            lines = []
+            has_body = False
+        lines.append(line)
+        if stripped and not is_heading:
+            has_body = True
+
+    chunk = "\n".join(lines).strip()
+    if chunk:
+        yield chunk
+
+
+def _split_long_line(line: str, max_chars: int) -> list:
+    """Split a line longer than max_chars at spaces (or anywhere, if it has none)"""
+    pieces = []
+    while len(line) > max_chars:
+        cut = line.rfind(" ", 0, max_chars + 1)
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(line[:cut].rstrip())
+        line = line[cut:].lstrip()
+    pieces.append(line)
+    return pieces
+
+
+def limit_chunk_size(chunk: str, max_tokens: int = None, overlap_tokens: int = 0):
+    """
+    Split a chunk longer than `max_tokens` at line boundaries into pieces that
+    overlap by up to `overlap_tokens`. Each piece repeats the chunk's header
+    line, so it is still attributed to its section.
+    """
+    if not max_tokens or estimate_tokens(chunk) <= max_tokens:
+        yield chunk
+        return
+
+    lines = chunk.split("\n")
+    first = lines[0].strip()
+    header = lines.pop(0) if _section_header_pattern.match(first) or _heading_pattern.match(first) else None
+    budget = max(1, max_tokens * CHARS_PER_TOKEN - (len(header) + 1 if header else 0))
+    overlap_chars = overlap_tokens * CHARS_PER_TOKEN
+    lines = [piece for line in lines for piece in _split_long_line(line, budget)]
+
+    def piece_text(piece_lines):
+        return "\n".join(([header] if header else []) + piece_lines).strip()
+
+    piece, size, carried = [], 0, 0
+    for line in lines:
+        if len(piece) > carried and size + len(line) + 1 > budget:
+            yield piece_text(piece)
+            # Start the next piece with the previous one's last lines, up to the overlap
+            overlap, overlap_size = [], 0
+            for previous in reversed(piece):
+                if overlap_size + len(previous) + 1 > overlap_chars:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += len(previous) + 1
+            if overlap_size + len(line) + 1 > budget:
+                overlap, overlap_size = [], 0
+            piece, size, carried = overlap, overlap_size, len(overlap)
+        piece.append(line)
+        size += len(line) + 1
+    if len(piece) > carried:
+        text = piece_text(piece)
+        if text:
+            yield text
+
+
+def iter_chunks(lines, max_tokens: int = None, overlap_tokens: int = 0):
+    """Chunk a document given as an iterable of lines (without line endings), one chunk at a time"""
+    for block in split_blocks(lines):
+        for chunk in chunk_block(block):
+            yield from limit_chunk_size(chunk, max_tokens, overlap_tokens)
+
+
+def get_school_handbook_chunks(school_handbook_string: str, max_tokens: int = None,
+                               overlap_tokens: int = 0) -> list[str]:
+    """
+    Divides the school handbook string into logical chunks suitable for a RAG system.
+
+    The chunking strategy is as follows:
+    1. Split the document at "---" separator lines. These are "major blocks".
+    2. For each major block:
+        a. If the block is the Table of Contents (contains "**TABLE OF CONTENTS**"),
+           it's kept as one chunk.
+        b. Otherwise, the block is further processed line by line.
+           A new sub-chunk starts when a line matches a defined header pattern
+           (e.g., numbered section headers like "**1. SECTION TITLE**",
+           "**1.1. SUBSECTION TITLE**", special headers like the disclaimer,
+           or a Markdown heading after some body text).
+           Lines between headers form a chunk.
+    3. Chunks longer than `max_tokens` are split into pieces overlapping by
+       `overlap_tokens` (see limit_chunk_size).
+
+    Documents that do not fit in memory are chunked with iter_chunks instead.
+    """
+    return list(iter_chunks(school_handbook_string.split("\n"), max_tokens, overlap_tokens))
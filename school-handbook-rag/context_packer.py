@@ -0,0 +1,124 @@
+"""
+Token-budgeted packing of retrieved chunks into the generation prompt.
+
+Retrieval returns a ranked pool of candidate chunks, larger than what goes
+into the prompt. The packer walks them best first and
+
+    - skips a chunk whose text is already (mostly) covered by packed chunks
+    - packs it whole if its token count fits the remaining budget
+    - otherwise packs its header and the lines that share the most words
+      with the question, in their original order, if enough budget remains
+
+Token counts come from the chunk store (exact when the index was built with
+--count-tokens, estimated otherwise), so packing makes no API calls. Trimmed
+text is costed in proportion to the characters kept.
+"""
+import re
+
+from chunk_store import estimate_tokens
+from lexical_index import tokenize
+
+SHINGLE_SIZE = 5
+_sentence_split_pattern = re.compile(r"(?<=[.!?])\s+(?=[A-Z*])")
+
+
+def _shingles(text: str) -> set:
+    words = tokenize(text)
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _segments(chunk: str) -> list:
+    """Lines of a chunk, with long lines split into sentences"""
+    segments = []
+    for line in chunk.split("\n"):
+        if len(line) > 400:
+            segments.extend(_sentence_split_pattern.split(line))
+        elif line.strip():
+            segments.append(line)
+    return segments
+
+
+def trim_chunk(chunk: str, question: str, max_tokens: int, chunk_tokens: int):
+    """
+    The chunk's first line plus its segments that best match the question,
+    in document order, within `max_tokens`; returns (text, tokens) or (None, 0).
+    """
+    segments = _segments(chunk)
+    if not segments:
+        return None, 0
+    tokens_per_char = chunk_tokens / max(1, len(chunk))
+    cost = [max(1, round(len(segment) * tokens_per_char)) for segment in segments]
+    if cost[0] > max_tokens:
+        return None, 0
+
+    question_terms = set(tokenize(question))
+    ranked = sorted(range(1, len(segments)),
+                    key=lambda i: (-len(question_terms.intersection(tokenize(segments[i]))), i))
+    keep = {0}
+    used = cost[0]
+    for i in ranked:
+        if used + cost[i] <= max_tokens:
+            keep.add(i)
+            used += cost[i]
+    if len(keep) == 1:
+        return None, 0
+    return "\n".join(segments[i] for i in sorted(keep)), used
+
+
+def pack_context(question: str, chunks: list, chunk_info: list, token_counts: list, budget: int,
+                 overlap_threshold: float = 0.8, min_trim_tokens: int = 50):
+    """
+    Greedily pack ranked chunks into `budget` tokens.
+
+    Returns the packed chunks, their sources_info (with `tokens` and, for
+    partially included chunks, `trimmed`) and packing stats.
+    """
+    packed_chunks, packed_info = [], []
+    seen_shingles = set()
+    used = dropped = duplicates = trimmed = 0
+
+    for chunk, info, tokens in zip(chunks, chunk_info, token_counts):
+        shingles = _shingles(chunk)
+        if shingles and len(shingles & seen_shingles) >= overlap_threshold * len(shingles):
+            duplicates += 1
+            dropped += tokens
+            continue
+
+        remaining = budget - used
+        if tokens <= remaining:
+            text, cost = chunk, tokens
+        elif remaining >= min_trim_tokens:
+            text, cost = trim_chunk(chunk, question, remaining, tokens)
+            if text is None:
+                dropped += tokens
+                continue
+            trimmed += 1
+            dropped += tokens - cost
+        else:
+            dropped += tokens
+            continue
+
+        packed_chunks.append(text)
+        packed_info.append({**info, 'tokens': cost, **({'trimmed': True} if text is not chunk else {})})
+        seen_shingles |= shingles
+        used += cost
+
+    stats = {
+        'token_budget': budget,
+        'tokens_used': used,
+        'tokens_dropped': dropped,
+        'candidates': len(chunks),
+        'packed': len(packed_chunks),
+        'trimmed': trimmed,
+        'duplicates': duplicates,
+    }
+    return packed_chunks, packed_info, stats
+
+
+def chunk_token_counts(chunks, chunk_info: list) -> list:
+    """Precomputed token counts of retrieved chunks, estimated for chunk lists without metadata"""
+    if hasattr(chunks, 'token_count'):
+        return [chunks.token_count(info['index']) for info in chunk_info]
+    return [estimate_tokens(chunks[info['index']]) for info in chunk_info]
@@ -0,0 +1,117 @@
+"""
+Follow-up questions in a conversation.
+
+"What about for seniors?" after a dress code question means nothing on its
+own, so embedding it as is retrieves unrelated chunks. Each question is
+classified against the last turns of the session history:
+
+    standalone   no sign of referring back: retrieved and answered as is,
+                 without history (and eligible for the answer cache)
+    follow-up    condensed into a standalone retrieval query; the generation
+                 prompt includes a bounded window of earlier turns
+    same topic   a follow-up that adds no new terms ("can you explain that
+                 in more detail?") reuses the previous turn's retrieved
+                 chunks: no embedding, no index search
+
+The classification is a word-level heuristic, so standalone questions cost
+nothing extra. Only follow-ups that bring new terms are condensed, either by
+the generation model (see `condense_prompt`) or by `heuristic_rewrite`.
+"""
+from lexical_index import tokenize
+
+# Openings that only make sense as a continuation of the previous turn
+FOLLOW_UP_PREFIXES = (
+    "what about", "how about", "and ", "but ", "also ", "what if", "same for", "same with",
+    "how so", "how come", "tell me more", "more about", "more on", "what else",
+    "can you elaborate", "could you elaborate", "elaborate", "explain that", "explain it",
+    "and what", "so ",
+)
+
+# Words that point back at something said earlier
+REFERRING_WORDS = {
+    "it", "its", "that", "those", "these", "this", "they", "them", "their", "theirs",
+    "he", "she", "him", "her", "his", "hers", "same", "above", "previous", "earlier",
+    "former", "latter", "ones", "one", "else", "instead", "too", "either",
+}
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "so", "of", "to", "in", "on", "at", "for", "from",
+    "by", "with", "about", "as", "into", "than", "then", "if", "is", "are", "was", "were",
+    "be", "been", "being", "am", "do", "does", "did", "done", "have", "has", "had", "can",
+    "could", "would", "should", "will", "shall", "may", "might", "must", "what", "which",
+    "who", "whom", "whose", "when", "where", "why", "how", "i", "me", "my", "we", "our",
+    "you", "your", "there", "here", "not", "no", "yes", "any", "some", "all", "more",
+    "most", "much", "many", "also", "just", "only", "very", "please", "tell", "know",
+    "explain", "elaborate", "mean", "means", "say", "says", "said", "like", "get", "need",
+    "want", "detail", "details", "again", "okay", "ok", "thanks", "thank", "s", "t",
+}
+
+# Questions with at most this many content words and a referring word are follow-ups
+MAX_REFERRING_CONTENT_TERMS = 3
+# Questions with this many content words stand on their own unless they refer back
+MIN_STANDALONE_CONTENT_TERMS = 2
+MAX_CONDENSED_CHARS = 300
+
+
+def content_terms(text: str) -> set:
+    """Tokens of a text that carry its topic"""
+    return {token for token in tokenize(text) if token not in STOPWORDS and token not in REFERRING_WORDS}
+
+
+def is_follow_up(question: str, previous_query: str) -> bool:
+    """Whether a question needs the previous turn to be understood"""
+    if not previous_query:
+        return False
+    normalized = " ".join(question.lower().split())
+    if normalized.startswith(FOLLOW_UP_PREFIXES):
+        return True
+    terms = content_terms(question)
+    referring = bool(set(tokenize(question)) & REFERRING_WORDS)
+    # Nothing the previous query did not already cover ("can you explain that in more detail?", "why?"),
+    # unless it is a standalone question in its own right: a repeat or a narrower rephrasing
+    if not new_terms(question, previous_query) and (referring or len(terms) < MIN_STANDALONE_CONTENT_TERMS):
+        return True
+    return referring and len(terms) <= MAX_REFERRING_CONTENT_TERMS
+
+
+def new_terms(question: str, previous_query: str) -> set:
+    """Content terms of a follow-up that the previous query did not have"""
+    return content_terms(question) - content_terms(previous_query)
+
+
+def heuristic_rewrite(question: str, previous_query: str) -> str:
+    """A standalone query without a model call: the previous query followed by the follow-up"""
+    return f"{previous_query.strip()} {question.strip()}"
+
+
+def _format_turn(turn: dict, max_answer_chars: int) -> str:
+    answer = " ".join(str(turn.get('response', '')).split())
+    if len(answer) > max_answer_chars:
+        answer = answer[:max_answer_chars].rsplit(" ", 1)[0] + " ..."
+    return f"Student: {turn['question']}\nAssistant: {answer}"
+
+
+def format_turns(turns: list, max_answer_chars: int = 600) -> str:
+    """Earlier turns, oldest first, for a prompt; long answers are cut"""
+    return "\n\n".join(_format_turn(turn, max_answer_chars) for turn in turns)
+
+
+def condense_prompt(question: str, turns: list, max_answer_chars: int = 300) -> str:
+    """Prompt asking the generation model to rewrite a follow-up as a standalone question"""
+    return f"""Rewrite the student's follow-up question as a single standalone question about the school handbook, using the conversation for context. Keep names, grades and terms from the conversation that the follow-up refers to. Reply with the question only.
+
+CONVERSATION:
+{format_turns(turns, max_answer_chars)}
+
+FOLLOW-UP QUESTION: {question}
+
+STANDALONE QUESTION:"""
+
+
+def parse_condensed(text: str, fallback: str) -> str:
+    """The first line of the model's rewrite, or `fallback` if it is empty"""
+    for line in (text or "").splitlines():
+        line = line.strip().strip('"').strip()
+        if line:
+            return line[:MAX_CONDENSED_CHARS]
+    return fallback
@@ -0,0 +1,198 @@
+import json
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import numpy as np
+
+# The index built before embedders were recorded used this configuration
+LEGACY_EMBEDDER_INFO = {'backend': 'gemini', 'model': 'models/text-embedding-004', 'dimension': 768}
+
+
+class Embedder(ABC):
+    """
+    Turns text into float32 vectors for the FAISS index.
+
+    Documents (chunks at index time) and queries (user questions) are embedded
+    separately because some backends embed them differently.
+    """
+    backend = None
+    remote = False  # Calls an API: query embedding goes through the upstream client (see upstream.py)
+
+    @abstractmethod
+    def embed_documents(self, texts: list) -> np.ndarray:
+        """Vectors of chunks at index time, one row per text"""
+
+    @abstractmethod
+    def embed_queries(self, texts: list) -> np.ndarray:
+        """Vectors of user questions, one row per text"""
+
+    @abstractmethod
+    def describe(self) -> dict:
+        """Identity recorded in the index metadata; queries must match it"""
+
+
+class GeminiEmbedder(Embedder):
+    """Embeds text with the Gemini embedding API"""
+    backend = 'gemini'
+    remote = True
+    max_batch_size = 100  # batchEmbedContents limit
+
+    def __init__(self, model_name: str = "models/text-embedding-004", dimension: int = 768):
+        self.model_name = model_name
+        self.dimension = dimension
+
+    def _embed(self, texts: list, task_type: str) -> np.ndarray:
+        import google.generativeai as genai
+
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            response = genai.embed_content(
+                model=self.model_name,
+                content=list(texts[start:start + self.max_batch_size]),
+                task_type=task_type
+            )
+            vectors.extend(response['embedding'])
+        return np.array(vectors, dtype='float32').reshape(len(texts), -1)
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        return self._embed(texts, "RETRIEVAL_DOCUMENT")
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        return self._embed(texts, "RETRIEVAL_QUERY")
+
+    def describe(self) -> dict:
+        return {'backend': self.backend, 'model': self.model_name, 'dimension': self.dimension}
+
+
+class HashingEmbedder(Embedder):
+    """
+    Local, in-process embedder: hashed TF-IDF features and a sparse random projection.
+
+    Words and word bigrams are hashed (crc32, stable across processes) into
+    `n_features` buckets, weighted by sublinear term frequency times the IDF
+    learned by `fit()`, then projected down to `dimension` by adding each
+    bucket's weight to `projections` random output dimensions with random
+    signs. Vectors are L2-normalized, so L2 distance ranks like cosine.
+    """
+    backend = 'local-hashing'
+    token_pattern = re.compile(r"[a-z0-9]+(?:['.-][a-z0-9]+)*")
+    stop_words = frozenset("""a an and are as at be by can do does for from how i if in is it me my
+        of on or our should the their there this to was we what when where which who why will
+        with you your""".split())
+
+    def __init__(self, dimension: int = 512, n_features: int = 2 ** 18, projections: int = 4,
+                 seed: int = 0, idf=None):
+        self.dimension = dimension
+        self.n_features = n_features
+        self.projections = projections
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self._targets = rng.integers(0, dimension, size=(n_features, projections), dtype=np.int32)
+        self._signs = rng.choice(np.array([-1.0, 1.0], dtype='float32'), size=(n_features, projections))
+        self.idf = np.asarray(idf, dtype='float32') if idf is not None else np.ones(n_features, dtype='float32')
+
+    # --- Persistence ------------------------------------------------------
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(dimension=int(data['dimension']), n_features=int(data['n_features']),
+                   projections=int(data['projections']), seed=int(data['seed']), idf=data['idf'])
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, dimension=self.dimension, n_features=self.n_features,
+                     projections=self.projections, seed=self.seed, idf=self.idf)
+
+    # --- Features ---------------------------------------------------------
+
+    def _hash_features(self, texts: list):
+        """Return parallel (row, feature) arrays for every token and bigram"""
+        rows, features = [], []
+        for row, text in enumerate(texts):
+            tokens = [t for t in self.token_pattern.findall(text.lower()) if t not in self.stop_words]
+            terms = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            rows.extend([row] * len(terms))
+            features.extend(zlib.crc32(term.encode("utf-8")) % self.n_features for term in terms)
+        return np.array(rows, dtype=np.int64), np.array(features, dtype=np.int64)
+
+    def fit(self, documents: list):
+        """Learn IDF weights from the documents being indexed"""
+        rows, features = self._hash_features(documents)
+        doc_features = np.unique(rows * self.n_features + features) % self.n_features
+        df = np.bincount(doc_features, minlength=self.n_features)
+        self.idf = (np.log((1 + len(documents)) / (1 + df)) + 1).astype('float32')
+        return self
+
+    def _embed(self, texts: list) -> np.ndarray:
+        rows, features = self._hash_features(texts)
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        if rows.size:
+            keys, counts = np.unique(rows * self.n_features + features, return_counts=True)
+            rows, features = keys // self.n_features, keys % self.n_features
+            weights = (1 + np.log(counts)).astype('float32') * self.idf[features]
+            for j in range(self.projections):
+                np.add.at(vectors, (rows, self._targets[features, j]), weights * self._signs[features, j])
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        return self._embed(texts)
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        return self._embed(texts)
+
+    def describe(self) -> dict:
+        # The IDF checksum ties the index to the exact fitted weights
+        idf_checksum = zlib.crc32(self.idf.tobytes())
+        return {'backend': self.backend,
+                'model': f"hashing-{self.n_features}x{self.projections}-seed{self.seed}-idf{idf_checksum:08x}",
+                'dimension': self.dimension}
+
+
+def get_embedder(backend: str, model_name: str = "models/text-embedding-004", local_model_path: str = None):
+    """Create the embedder selected in the configuration"""
+    if backend == 'gemini':
+        return GeminiEmbedder(model_name)
+    if backend == 'local-hashing':
+        if local_model_path and os.path.exists(local_model_path):
+            return HashingEmbedder.load(local_model_path)
+        return HashingEmbedder()
+    raise ValueError(f"Unknown embedding backend: {backend!r}")
+
+
+# --- Index metadata -----------------------------------------------------------
+
+def write_index_metadata(path: str, embedder: Embedder, vector_count: int, **extra):
+    """Record which embedder built an index"""
+    metadata = {
+        'embedder': embedder.describe(),
+        'vectors': int(vector_count),
+        'created': datetime.now().isoformat(),
+        **extra,
+    }
+    with open(path, "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def read_index_metadata(path: str) -> dict:
+    """Read index metadata, assuming the legacy Gemini embedder if none was written"""
+    if not os.path.exists(path):
+        return {'embedder': dict(LEGACY_EMBEDDER_INFO), 'legacy': True}
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_embedder_matches(metadata: dict, embedder: Embedder):
+    """Raise ValueError if `embedder` is not the one that built the index"""
+    built_with = metadata['embedder']
+    configured = embedder.describe()
+    if built_with != configured:
+        raise ValueError(f"Index was built with embedder {built_with}, but the configured embedder is {configured}")
@@ -0,0 +1,81 @@
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def content_hash(text: str) -> str:
+    """Stable hash of a chunk's text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings keyed by (content hash, model, task_type).
+
+    Backed by SQLite so every batch is committed as soon as it is embedded: an
+    interrupted index build resumes from the cache instead of re-embedding.
+    Token counts are cached the same way, keyed by (content hash, model).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            task_type TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (content_hash, model, task_type))""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS token_counts (
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            PRIMARY KEY (content_hash, model))""")
+        self._conn.commit()
+
+    def get_many(self, hashes: list, model: str, task_type: str) -> dict:
+        """Return {content_hash: vector} for the hashes that are cached"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND task_type = ? "
+                    f"AND content_hash IN ({placeholders})", [model, task_type, *batch])
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype='float32')
+        return found
+
+    def put_many(self, hashes: list, vectors, model: str, task_type: str):
+        """Store a batch of embeddings and commit immediately"""
+        rows = [(key, model, task_type, np.asarray(vector, dtype='float32').tobytes())
+                for key, vector in zip(hashes, vectors)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def get_token_counts(self, hashes: list, model: str) -> dict:
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT content_hash, total_tokens FROM token_counts WHERE model = ? "
+                    f"AND content_hash IN ({placeholders})", [model, *batch])
+                found.update(rows)
+        return found
+
+    def put_token_counts(self, counts: dict, model: str):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)",
+                                   [(key, model, count) for key, count in counts.items()])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
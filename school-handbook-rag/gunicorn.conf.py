@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration for serving the Flask app with pre-forked workers.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The index and chunk store are loaded once in the master before it forks, so
+workers start without loading anything and share the index pages instead of
+each holding a private copy. Threads do not survive fork, so each worker
+starts its own index watcher.
+"""
+import app as rag
+
+bind = "0.0.0.0:8000"
+workers = 4
+threads = 8
+preload_app = True
+
+
+def on_starting(server):
+    if not rag.load_rag_data():
+        raise SystemExit("Failed to load RAG data. Please ensure FAISS index and chunks files exist.")
+
+
+def post_fork(server, worker):
+    rag.index_reloader.start()
@@ -0,0 +1,237 @@
+"""
+Server-side chat history, keyed by the `session_id` kept in the session cookie.
+
+The cookie only carries the session id, so its size and the per-request
+serialization cost stay constant however long a conversation runs. Each
+session keeps at most `max_turns` turns (oldest dropped first) and sessions
+idle for longer than `ttl_seconds` are discarded. Backends:
+
+    memory   per-process LRU of sessions (single process, or for development)
+    sqlite   a local database file shared by every worker on the host
+    redis    any server speaking the Redis protocol, shared across hosts
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+try:
+    import redis
+except ImportError:  # Only needed for the redis backend
+    redis = None
+
+
+class HistoryStore(ABC):
+    """Stores chat turns per session and returns them a page at a time"""
+    backend = None
+
+    @abstractmethod
+    def append(self, session_id: str, entry: dict):
+        """Add a turn to the end of the session's history"""
+
+    @abstractmethod
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        """
+        (entries, total) for up to `limit` turns, skipping the `offset` most
+        recent ones; entries are oldest first, so offset 0 is the latest page.
+        """
+
+    @abstractmethod
+    def clear(self, session_id: str):
+        """Delete the session's history"""
+
+    def stats(self) -> dict:
+        return {'backend': self.backend}
+
+
+class MemoryHistoryStore(HistoryStore):
+    """In-process history: at most `max_sessions` sessions, least recently used evicted first"""
+    backend = 'memory'
+
+    def __init__(self, max_turns: int = 100, ttl_seconds: float = 7 * 24 * 3600, max_sessions: int = 10000):
+        self.max_turns = max_turns
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session_id -> (last used, deque of turns)
+        self.evictions = 0
+
+    def _get(self, session_id: str, now: float):
+        """The session's turns, or None if unknown or expired (lock held)"""
+        item = self._sessions.get(session_id)
+        if item is None:
+            return None
+        if now - item[0] > self.ttl_seconds:
+            del self._sessions[session_id]
+            return None
+        return item[1]
+
+    def append(self, session_id: str, entry: dict):
+        now = time.time()
+        with self._lock:
+            turns = self._get(session_id, now)
+            if turns is None:
+                turns = deque(maxlen=self.max_turns)
+            turns.append(entry)
+            self._sessions[session_id] = (now, turns)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        with self._lock:
+            turns = self._get(session_id, time.time())
+            if turns is None:
+                return [], 0
+            total = len(turns)
+            end = max(0, total - offset)
+            return [turns[i] for i in range(max(0, end - limit), end)], total
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'backend': self.backend, 'sessions': len(self._sessions),
+                    'max_sessions': self.max_sessions, 'max_turns': self.max_turns, 'evictions': self.evictions}
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    History in a SQLite database; WAL mode lets pre-forked workers share it.
+
+    The connection is opened lazily in each process, since SQLite
+    connections must not be used across fork.
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path: str, max_turns: int = 100, ttl_seconds: float = 7 * 24 * 3600,
+                 prune_interval_seconds: float = 300):
+        self.path = path
+        self.max_turns = max_turns
+        self.ttl_seconds = ttl_seconds
+        self.prune_interval_seconds = prune_interval_seconds
+        self._lock = threading.Lock()
+        self._conn_pid = None
+        self._last_prune = 0.0
+
+    @property
+    def _conn(self):
+        """This process's connection (lock held)"""
+        if self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                created REAL NOT NULL,
+                entry TEXT NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS turns_by_session ON turns (session_id, id)")
+            conn.commit()
+            self._connection, self._conn_pid = conn, os.getpid()
+        return self._connection
+
+    def append(self, session_id: str, entry: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT INTO turns (session_id, created, entry) VALUES (?, ?, ?)",
+                               (session_id, now, json.dumps(entry)))
+            # Keep only the newest max_turns turns of this session
+            self._conn.execute("""DELETE FROM turns WHERE session_id = ? AND id <= (
+                SELECT id FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+                               (session_id, session_id, self.max_turns))
+            if now - self._last_prune > self.prune_interval_seconds:
+                self._prune(now)
+            self._conn.commit()
+
+    def _prune(self, now: float):
+        """Delete sessions whose latest turn is older than the TTL (lock held)"""
+        self._conn.execute("""DELETE FROM turns WHERE session_id IN (
+            SELECT session_id FROM turns GROUP BY session_id HAVING MAX(created) < ?)""",
+                           (now - self.ttl_seconds,))
+        self._last_prune = now
+
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        with self._lock:
+            total, latest = self._conn.execute(
+                "SELECT COUNT(*), MAX(created) FROM turns WHERE session_id = ?", (session_id,)).fetchone()
+            if not total or time.time() - latest > self.ttl_seconds:
+                return [], 0
+            rows = self._conn.execute(
+                "SELECT entry FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (session_id, limit, offset)).fetchall()
+        return [json.loads(entry) for (entry,) in reversed(rows)], total
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions, turns = self._conn.execute(
+                "SELECT COUNT(DISTINCT session_id), COUNT(*) FROM turns").fetchone()
+        return {'backend': self.backend, 'sessions': sessions, 'turns': turns, 'max_turns': self.max_turns}
+
+
+class RedisHistoryStore(HistoryStore):
+    """
+    History in Redis: one list per session, trimmed to `max_turns` and
+    expiring `ttl_seconds` after the last turn. Pass `client` to use any
+    object with the redis-py interface (e.g. a local stand-in for testing).
+    """
+    backend = 'redis'
+
+    def __init__(self, url: str = "redis://localhost:6379/0", max_turns: int = 100,
+                 ttl_seconds: float = 7 * 24 * 3600, key_prefix: str = "chat_history:", client=None):
+        if client is None:
+            if redis is None:
+                raise ImportError("The redis history backend requires the redis package: pip install redis")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.max_turns = max_turns
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.key_prefix}{session_id}"
+
+    def append(self, session_id: str, entry: dict):
+        key = self._key(session_id)
+        pipeline = self.client.pipeline()
+        pipeline.rpush(key, json.dumps(entry))
+        pipeline.ltrim(key, -self.max_turns, -1)
+        pipeline.expire(key, int(self.ttl_seconds))
+        pipeline.execute()
+
+    def page(self, session_id: str, offset: int = 0, limit: int = 20):
+        key = self._key(session_id)
+        pipeline = self.client.pipeline()
+        pipeline.llen(key)
+        pipeline.lrange(key, -(offset + limit), -(offset + 1))
+        total, rows = pipeline.execute()
+        return [json.loads(row) for row in rows], total
+
+    def clear(self, session_id: str):
+        self.client.delete(self._key(session_id))
+
+    def stats(self) -> dict:
+        return {'backend': self.backend, 'max_turns': self.max_turns}
+
+
+def get_history_store(backend: str, max_turns: int = 100, ttl_seconds: float = 7 * 24 * 3600,
+                      max_sessions: int = 10000, sqlite_path: str = "chat_history.sqlite",
+                      redis_url: str = "redis://localhost:6379/0") -> HistoryStore:
+    """Create the history store selected in the configuration"""
+    if backend == 'memory':
+        return MemoryHistoryStore(max_turns, ttl_seconds, max_sessions)
+    if backend == 'sqlite':
+        return SQLiteHistoryStore(sqlite_path, max_turns, ttl_seconds)
+    if backend == 'redis':
+        return RedisHistoryStore(redis_url, max_turns, ttl_seconds)
+    raise ValueError(f"Unknown history backend: {backend!r}")
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+
+import faiss
+
+from ann_index import enable_reconstruction, set_search_params
+from chunk_store import load_chunks
+from embedders import read_index_metadata, check_embedder_matches
+from lexical_index import LexicalIndex
+
+
+class IndexSnapshot:
+    """
+    One loaded version of the index artifacts: FAISS index, chunks, embedder and metadata.
+
+    Snapshots are never modified after loading. A reload builds a new snapshot
+    and swaps the reference, so requests that already hold the old snapshot
+    finish on it.
+    """
+
+    def __init__(self, index, chunks, embedder, metadata: dict, version: str, load_seconds: float,
+                 lexical=None, size_bytes: int = 0):
+        self.index = index
+        self.lexical = lexical
+        self.chunks = chunks
+        self.embedder = embedder
+        self.metadata = metadata
+        self.version = version
+        self.loaded_at = datetime.now()
+        self.load_seconds = load_seconds
+        self.size_bytes = size_bytes  # Size of the artifacts on disk: what it maps or holds in memory
+
+        # Indexes built before index types were recorded are exact L2 indexes
+        index_info = metadata.get('index', {})
+        self.index_type = index_info.get('type', 'flat')
+        self.metric = index_info.get('metric', 'l2')
+
+    def describe(self) -> dict:
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at.isoformat(),
+            'load_seconds': round(self.load_seconds, 4),
+            'size_bytes': self.size_bytes,
+            'vectors': self.index.ntotal,
+            'index_type': self.index_type,
+            'metric': self.metric,
+            'chunks': len(self.chunks),
+            'embedder': self.embedder.describe(),
+            'lexical': self.lexical.describe() if self.lexical is not None else None,
+        }
+
+
+def artifact_fingerprint(paths: list) -> tuple:
+    """(path, mtime, size) for each artifact; changes whenever a file is replaced"""
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+def read_faiss_index(path: str, use_mmap: bool = True):
+    """
+    Read a FAISS index, memory-mapped and read-only if `use_mmap` is set.
+
+    With IO_FLAG_MMAP_IFC (faiss >= 1.8) flat indexes are mapped without
+    copying, so every process serving the same file shares its pages.
+    Older faiss versions only map the inverted lists of IVF indexes and
+    copy everything else onto the heap.
+    """
+    if not use_mmap:
+        return faiss.read_index(path)
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return faiss.read_index(path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+
+
+def load_snapshot(index_path: str, chunks_path: str, metadata_path: str, make_embedder,
+                  lexical_path: str = None, mmap_index: bool = True, nprobe: int = None, ef_search: int = None,
+                  reconstruct: bool = False) -> IndexSnapshot:
+    """Load and validate the index artifacts; raises if they are missing or mismatched.
+
+    The keyword index is optional: indexes built before it existed load without one.
+    With `reconstruct` the stored vectors can be read back by id (for reranking).
+    """
+    started = time.perf_counter()
+    fingerprint = artifact_fingerprint([p for p in (index_path, chunks_path, metadata_path, lexical_path) if p])
+
+    index = read_faiss_index(index_path, mmap_index)
+    set_search_params(index, nprobe, ef_search)
+    if reconstruct:
+        enable_reconstruction(index)
+    chunks = load_chunks(chunks_path)
+    metadata = read_index_metadata(metadata_path)
+
+    # Refuse to serve an index built with a different embedder
+    embedder = make_embedder()
+    check_embedder_matches(metadata, embedder)
+    if embedder.dimension != index.d:
+        raise ValueError(f"Embedder dimension {embedder.dimension} does not match index dimension {index.d}")
+    if index.ntotal != len(chunks):
+        raise ValueError(f"Index has {index.ntotal} vectors but there are {len(chunks)} chunks")
+
+    lexical = None
+    if lexical_path and os.path.exists(lexical_path):
+        lexical = LexicalIndex.load(lexical_path)
+        if lexical.doc_count != len(chunks):
+            raise ValueError(f"Keyword index has {lexical.doc_count} chunks but there are {len(chunks)} chunks")
+    elif lexical_path:
+        print(f"⚠️ {lexical_path} not found, using vector search only")
+
+    version = hashlib.sha1(repr(fingerprint).encode()).hexdigest()[:12]
+    size_bytes = sum(size for _, _, size in fingerprint if size)
+    return IndexSnapshot(index, chunks, embedder, metadata, version, time.perf_counter() - started, lexical,
+                         size_bytes)
+
+
+class SnapshotReloader:
+    """
+    Watches the index artifacts and loads a new snapshot in the background when they change.
+
+    The build writes the metadata file last, but the artifacts are still only
+    loaded once their fingerprint has stayed the same for one full poll
+    interval, so a half-finished build is never picked up.
+    """
+
+    def __init__(self, paths: list, load, on_swap, poll_seconds: float = 5.0):
+        self.paths = paths
+        self.load = load
+        self.on_swap = on_swap
+        self.poll_seconds = poll_seconds
+
+        self._lock = threading.Lock()
+        self._loaded_fingerprint = artifact_fingerprint(paths)
+        self._pending = None
+        self._thread = None
+        self.last_error = None
+        self.reloads = 0
+
+    def reload(self) -> bool:
+        """Load the artifacts now and swap them in; returns False if loading failed"""
+        with self._lock:
+            fingerprint = artifact_fingerprint(self.paths)
+            try:
+                snapshot = self.load()
+            except Exception as e:
+                self.last_error = f"{datetime.now().isoformat()}: {e}"
+                print(f"❌ Error reloading RAG data: {e}")
+                return False
+            self._loaded_fingerprint = fingerprint
+            self.last_error = None
+            self.reloads += 1
+            self.on_swap(snapshot)
+            return True
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name="index-reloader", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            self.poll()
+
+    def poll(self):
+        """Check the artifacts once, reloading if they changed and stayed the same since the last check"""
+        fingerprint = artifact_fingerprint(self.paths)
+        if fingerprint == self._loaded_fingerprint:
+            self._pending = None
+        elif fingerprint != self._pending:
+            self._pending = fingerprint  # Changed: wait one more poll for the build to settle
+        else:
+            self.reload()
+            self._pending = None
+
+    def stats(self) -> dict:
+        return {
+            'watching': self._thread is not None and self._thread.is_alive(),
+            'poll_seconds': self.poll_seconds,
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,351 @@
+"""
+Streaming, parallel ingestion of handbook documents.
+
+    python ingest.py handbooks/                          # chunk every document and report throughput
+    python ingest.py handbooks/ --output chunks.jsonl    # one {"path", "chunks"} line per document
+    python ingest.py handbooks/ --workers 8 --max-chunk-tokens 400
+    python build_index.py --source handbooks/            # index every document in a directory
+
+Documents (Markdown, plain text and HTML) are found by walking the directory
+and pass through generator stages, so no stage holds a whole document:
+
+    read     the file in fixed-size blocks, decoded incrementally
+    convert  blocks into lines (HTML is converted to Markdown-style lines:
+             headings become "#" headings, <hr> a "---" separator)
+    chunk    lines into chunks (chunking.iter_chunks), with size and overlap limits
+
+Files are fanned out over a process pool in small batches. At most
+2 * workers batches are in flight and results come back in file order, so
+memory is bounded by a few batches' chunks whatever the corpus size. The
+report gives the time spent and throughput of each stage (summed over the
+workers) next to the overall wall-clock throughput.
+"""
+import argparse
+import codecs
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+
+from chunking import iter_chunks
+
+MARKDOWN_SUFFIXES = (".md", ".markdown")
+TEXT_SUFFIXES = (".txt",)
+HTML_SUFFIXES = (".html", ".htm")
+DOCUMENT_SUFFIXES = MARKDOWN_SUFFIXES + TEXT_SUFFIXES + HTML_SUFFIXES
+READ_BLOCK_BYTES = 1024 * 1024
+STAGES = ("read", "convert", "chunk")
+
+
+def discover_documents(root: str):
+    """Paths of the documents under `root` (a directory or a single file), in sorted order"""
+    if not os.path.isdir(root):
+        yield root
+        return
+    with os.scandir(root) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            yield from discover_documents(entry.path)
+        elif entry.name.lower().endswith(DOCUMENT_SUFFIXES):
+            yield entry.path
+
+
+def read_blocks(path: str, counters: dict = None):
+    """The file's text in blocks of about READ_BLOCK_BYTES, decoded as UTF-8 (invalid bytes replaced)"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_BLOCK_BYTES)
+            if counters is not None:
+                counters['bytes'] += len(data)
+            if not data:
+                break
+            yield decoder.decode(data)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def split_lines(blocks):
+    """Lines (without line endings) of text arriving in blocks; lines end with "\n", "\r\n" or "\r" """
+    pending = ""
+    for block in blocks:
+        text = pending + block
+        # A "\r" ending the block may be the first half of a "\r\n" split across blocks
+        held = "\r" if text.endswith("\r") else ""
+        lines = text[:len(text) - len(held)].replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        # The last line may continue in the next block
+        pending = lines.pop() + held
+        yield from lines
+    if pending:
+        yield pending.removesuffix("\r")
+
+
+class HTMLToText(HTMLParser):
+    """Converts HTML fed in pieces to Markdown-style lines, collected in `lines`"""
+
+    BLOCK_TAGS = {"p", "div", "section", "article", "main", "header", "footer", "aside", "nav", "table", "tr",
+                  "ul", "ol", "dl", "dt", "dd", "blockquote", "pre", "figure", "figcaption", "form", "address"}
+    SKIPPED_TAGS = {"script", "style", "head", "noscript", "template", "svg"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self._text = []
+        self._prefix = ""
+        self._skipping = 0
+
+    def _flush(self):
+        text = " ".join("".join(self._text).split())
+        if text:
+            self.lines.append(self._prefix + text)
+        self._text = []
+        self._prefix = ""
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self._flush()
+            self._prefix = "#" * int(tag[1]) + " "
+        elif tag == "li":
+            self._flush()
+            self._prefix = "* "
+        elif tag == "hr":
+            self._flush()
+            self.lines.append("---")
+        elif tag == "br" or tag in self.BLOCK_TAGS:
+            self._flush()
+        elif tag in ("td", "th"):
+            self._text.append(" | ")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6", "li") or tag in self.BLOCK_TAGS:
+            self._flush()
+            if tag in ("h1", "h2", "h3", "h4", "h5", "h6", "p"):
+                self.lines.append("")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self._text.append(data)
+
+
+def html_lines(blocks):
+    """Markdown-style lines of HTML arriving in blocks"""
+    parser = HTMLToText()
+    for block in blocks:
+        parser.feed(block)
+        yield from parser.lines
+        parser.lines.clear()
+    parser.close()
+    parser._flush()
+    yield from parser.lines
+
+
+def _timed(items, timings: dict, stage: str):
+    """Yield from `items`, adding the time spent producing them (including upstream stages) to timings[stage]"""
+    iterator = iter(items)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] += time.perf_counter() - started
+            return
+        timings[stage] += time.perf_counter() - started
+        yield item
+
+
+def chunk_path(path: str, max_tokens: int = None, overlap_tokens: int = 0, counters: dict = None) -> list:
+    """
+    Chunk one document through the read, convert and chunk stages.
+
+    `counters`, if given, accumulates 'bytes' read and the seconds spent in each stage.
+    """
+    counters = counters if counters is not None else new_counters()
+    inclusive = dict.fromkeys(STAGES, 0.0)
+    blocks = _timed(read_blocks(path, counters), inclusive, "read")
+    converter = html_lines if path.lower().endswith(HTML_SUFFIXES) else split_lines
+    lines = _timed(converter(blocks), inclusive, "convert")
+    chunks = list(_timed(iter_chunks(lines, max_tokens, overlap_tokens), inclusive, "chunk"))
+    # Each stage's time includes the stages feeding it
+    counters['read'] += inclusive['read']
+    counters['convert'] += inclusive['convert'] - inclusive['read']
+    counters['chunk'] += inclusive['chunk'] - inclusive['convert']
+    return chunks
+
+
+def new_counters() -> dict:
+    return {'bytes': 0, **dict.fromkeys(STAGES, 0.0)}
+
+
+def _chunk_batch(paths: list, max_tokens: int, overlap_tokens: int) -> tuple:
+    """Worker: ([(path, chunks or None, error or None)], counters) for a batch of files"""
+    counters = new_counters()
+    results = []
+    for path in paths:
+        try:
+            results.append((path, chunk_path(path, max_tokens, overlap_tokens, counters), None))
+        except (OSError, ValueError) as e:
+            results.append((path, None, repr(e)))
+    return results, counters
+
+
+def _batches(paths, batch_files: int):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= batch_files:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class IngestStats:
+    """Files, bytes and chunks ingested, with the seconds spent in each stage"""
+
+    def __init__(self):
+        self.files = 0
+        self.errors = 0
+        self.chunks = 0
+        self.counters = new_counters()
+        self.discover_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.workers = 1
+
+    def add(self, counters: dict):
+        for key, value in counters.items():
+            self.counters[key] += value
+
+    def report(self) -> dict:
+        """Per-stage seconds and throughput, and the overall wall-clock throughput"""
+        megabytes = self.counters['bytes'] / 1e6
+
+        def rate(amount, seconds):
+            return round(amount / seconds, 1) if seconds > 0 else None
+
+        stages = {'discover': {'seconds': round(self.discover_seconds, 3),
+                               'files_per_second': rate(self.files, self.discover_seconds)}}
+        for stage in STAGES:
+            seconds = self.counters[stage]
+            stages[stage] = {'seconds': round(seconds, 3), 'mb_per_second': rate(megabytes, seconds),
+                             'files_per_second': rate(self.files, seconds)}
+        stages['chunk']['chunks_per_second'] = rate(self.chunks, self.counters['chunk'])
+        return {
+            'files': self.files,
+            'errors': self.errors,
+            'megabytes': round(megabytes, 2),
+            'chunks': self.chunks,
+            'workers': self.workers,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'files_per_second': rate(self.files, self.wall_seconds),
+            'mb_per_second': rate(megabytes, self.wall_seconds),
+            'chunks_per_second': rate(self.chunks, self.wall_seconds),
+            'stages': stages,
+        }
+
+    def print_report(self):
+        report = self.report()
+        print(f"Ingested {report['files']} files ({report['megabytes']} MB, {report['chunks']} chunks, "
+              f"{report['errors']} errors) in {report['wall_seconds']}s with {report['workers']} workers: "
+              f"{report['files_per_second']} files/s, {report['mb_per_second']} MB/s, "
+              f"{report['chunks_per_second']} chunks/s")
+        for stage, numbers in report['stages'].items():
+            rates = ", ".join(f"{value} {name.replace('_per_second', '/s')}"
+                              for name, value in numbers.items() if name != 'seconds' and value is not None)
+            print(f"  {stage:<9}{numbers['seconds']:>9.3f}s  {rates}")
+
+
+def ingest(root: str, workers: int = 1, max_tokens: int = None, overlap_tokens: int = 0,
+           stats: IngestStats = None, batch_files: int = 16):
+    """
+    Yield (path, chunks) for each document under `root`, in sorted path order.
+
+    With more than one worker, batches of `batch_files` files are chunked in a
+    process pool with at most 2 * workers batches in flight. Files that cannot
+    be read are counted in `stats.errors` and skipped.
+    """
+    stats = stats if stats is not None else IngestStats()
+    stats.workers = max(1, workers)
+    started = time.perf_counter()
+
+    def discovered():
+        paths = discover_documents(root)
+        while True:
+            began = time.perf_counter()
+            path = next(paths, None)
+            stats.discover_seconds += time.perf_counter() - began
+            if path is None:
+                return
+            yield path
+
+    def collect(results, counters):
+        stats.add(counters)
+        for path, chunks, error in results:
+            stats.files += 1
+            if error is not None:
+                stats.errors += 1
+                print(f"⚠️ Skipping {path}: {error}")
+                continue
+            stats.chunks += len(chunks)
+            yield path, chunks
+
+    try:
+        if workers <= 1:
+            for batch in _batches(discovered(), batch_files):
+                yield from collect(*_chunk_batch(batch, max_tokens, overlap_tokens))
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight = deque()
+            for batch in _batches(discovered(), batch_files):
+                if len(in_flight) >= 2 * workers:
+                    yield from collect(*in_flight.popleft().result())
+                in_flight.append(executor.submit(_chunk_batch, batch, max_tokens, overlap_tokens))
+            while in_flight:
+                yield from collect(*in_flight.popleft().result())
+    finally:
+        stats.wall_seconds += time.perf_counter() - started
+
+
+def main():
+    from app import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, INGEST_WORKERS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="directory (or single file) of Markdown, text and HTML documents")
+    parser.add_argument("--output", help="write the chunks as JSON lines to this file")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="chunking processes (default: INGEST_WORKERS)")
+    parser.add_argument("--batch-files", type=int, default=16, help="files per task sent to a worker")
+    parser.add_argument("--max-chunk-tokens", type=int, default=CHUNK_MAX_TOKENS,
+                        help="split longer chunks (default: CHUNK_MAX_TOKENS, 0 for no limit)")
+    parser.add_argument("--chunk-overlap-tokens", type=int, default=CHUNK_OVERLAP_TOKENS,
+                        help="overlap between the pieces of a split chunk (default: CHUNK_OVERLAP_TOKENS)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    stats = IngestStats()
+    documents = ingest(args.root, args.workers, args.max_chunk_tokens, args.chunk_overlap_tokens, stats,
+                       args.batch_files)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for path, chunks in documents:
+                f.write(json.dumps({'path': path, 'chunks': chunks}, ensure_ascii=False) + "\n")
+    else:
+        for _ in documents:
+            pass
+    if args.json:
+        print(json.dumps(stats.report(), indent=2))
+    else:
+        stats.print_report()
+
+
+if __name__ == '__main__':
+    main()
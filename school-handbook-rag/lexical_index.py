@@ -0,0 +1,163 @@
+"""
+BM25 keyword index over the chunks, built alongside the FAISS index.
+
+Dense retrieval misses exact terms such as "Form 4.2", "PTO" or a staff email
+address; BM25 finds them. The index is stored as compressed sparse postings:
+
+    terms            sorted vocabulary, UTF-8 bytes
+    term_offsets     postings of term i are [term_offsets[i], term_offsets[i + 1])
+    postings_docs    chunk ids, int32
+    postings_weight  precomputed BM25 weight of the term in that chunk, float32
+    idf, doc_lengths kept for inspection and rebuilding the weights
+
+Because the BM25 weights are precomputed, scoring a query is a dictionary
+lookup per query term and one np.add.at over the concatenated postings.
+
+    python lexical_index.py school_handbook.chunks school_handbook.bm25.npz
+"""
+import os
+import re
+import sys
+
+import numpy as np
+
+from chunk_store import load_chunks
+
+# Words, numbers and compounds such as 4.2, sick-leave or jane.doe@school.edu
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['.@_-][a-z0-9]+)*")
+PART_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list:
+    """Lowercased tokens; compounds are kept whole and also split into their parts"""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = PART_PATTERN.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class LexicalIndex:
+    """BM25 inverted index with precomputed per-posting weights"""
+
+    def __init__(self, terms, term_offsets, postings_docs, postings_weight, idf, doc_lengths,
+                 k1: float = 1.5, b: float = 0.75):
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.postings_docs = postings_docs
+        self.postings_weight = postings_weight
+        self.idf = idf
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self._term_ids = {term.decode("utf-8"): i for i, term in enumerate(terms.tolist())}
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, documents, k1: float = 1.5, b: float = 0.75):
+        """Tokenize the documents and compute the postings and BM25 weights"""
+        term_ids = {}
+        doc_ids, token_ids = [], []
+        doc_lengths = np.zeros(len(documents), dtype='float32')
+        for doc, text in enumerate(documents):
+            tokens = tokenize(text)
+            doc_lengths[doc] = len(tokens)
+            doc_ids.extend([doc] * len(tokens))
+            token_ids.extend(term_ids.setdefault(token, len(term_ids)) for token in tokens)
+
+        # Renumber terms in sorted order so the vocabulary can be stored as a sorted array
+        sorted_terms = sorted(term_ids)
+        terms = np.array([term.encode("utf-8") for term in sorted_terms], dtype=bytes)
+        remap = np.empty(len(term_ids), dtype=np.int64)
+        remap[[term_ids[term] for term in sorted_terms]] = np.arange(len(terms))
+
+        # One posting per (term, doc) with its term frequency, grouped by term
+        keys = remap[np.array(token_ids, dtype=np.int64)] * len(documents) + np.array(doc_ids, dtype=np.int64)
+        keys, tf = np.unique(keys, return_counts=True)
+        posting_terms, postings_docs = keys // len(documents), (keys % len(documents)).astype(np.int32)
+
+        df = np.bincount(posting_terms, minlength=len(terms))
+        term_offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5)).astype('float32')
+
+        average_length = doc_lengths.mean() if len(documents) else 1.0
+        norm = k1 * (1 - b + b * doc_lengths[postings_docs] / max(average_length, 1.0))
+        postings_weight = (idf[posting_terms] * tf * (k1 + 1) / (tf + norm)).astype('float32')
+        return cls(terms, term_offsets, postings_docs, postings_weight, idf, doc_lengths, k1, b)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path, allow_pickle=False)
+        return cls(data['terms'], data['term_offsets'], data['postings_docs'], data['postings_weight'],
+                   data['idf'], data['doc_lengths'], float(data['k1']), float(data['b']))
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(f, terms=self.terms, term_offsets=self.term_offsets, postings_docs=self.postings_docs,
+                     postings_weight=self.postings_weight, idf=self.idf, doc_lengths=self.doc_lengths,
+                     k1=self.k1, b=self.b)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk for the query"""
+        scores = np.zeros(self.doc_count, dtype='float32')
+        slices = [slice(self.term_offsets[i], self.term_offsets[i + 1])
+                  for i in (self._term_ids.get(token) for token in set(tokenize(query))) if i is not None]
+        if slices:
+            docs = np.concatenate([self.postings_docs[s] for s in slices])
+            weights = np.concatenate([self.postings_weight[s] for s in slices])
+            np.add.at(scores, docs, weights)
+        return scores
+
+    def search(self, query: str, top_k: int = 3, mask: np.ndarray = None):
+        """
+        (scores, chunk ids) of the best matching chunks, best first; chunks
+        without a matching term, or excluded by the boolean `mask`, are left out.
+        """
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        matching = np.flatnonzero(scores)
+        if len(matching) > top_k:
+            matching = matching[np.argpartition(-scores[matching], top_k - 1)[:top_k]]
+        order = matching[np.argsort(-scores[matching], kind='stable')]
+        return scores[order], order
+
+    def describe(self) -> dict:
+        return {'terms': len(self.terms), 'postings': len(self.postings_docs), 'chunks': self.doc_count}
+
+
+def reciprocal_rank_fusion(rankings: list, doc_count: int, k: int = 60, weights: list = None):
+    """
+    Fuse ranked lists of chunk ids: each list adds weight / (k + rank) to its chunks.
+
+    Returns (fused scores, chunk ids) best first. Only ranks are used, so BM25
+    scores and vector distances do not need to be on the same scale.
+    """
+    fused = np.zeros(doc_count, dtype='float32')
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        ranking = np.asarray(ranking, dtype=np.int64)
+        ranking = ranking[(ranking >= 0) & (ranking < doc_count)]
+        fused[ranking] += weight / (k + np.arange(1, len(ranking) + 1))
+    order = np.flatnonzero(fused)
+    order = order[np.argsort(-fused[order], kind='stable')]
+    return fused[order], order
+
+
+def build_from_chunk_store(chunks_path: str, output_path: str):
+    """Build the BM25 index for an existing chunk store"""
+    index = LexicalIndex.build(list(load_chunks(chunks_path)))
+    tmp_path = f"{output_path}.tmp-{os.getpid()}"
+    index.save(tmp_path)
+    os.replace(tmp_path, output_path)
+    print(f"Indexed {index.doc_count} chunks ({len(index.terms)} terms) from {chunks_path} into {output_path}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(f"usage: python {sys.argv[0]} <chunks file> <output.npz>")
+    build_from_chunk_store(sys.argv[1], sys.argv[2])
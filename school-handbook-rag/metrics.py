@@ -0,0 +1,307 @@
+"""
+In-process metrics for the request hot path, exported in the Prometheus text format.
+
+    with metrics.stage("embed"):
+        vector = embed(question)
+
+records the duration in the `rag_stage_duration_seconds` histogram and, when a
+request is being timed (see `request_timing`), in that request's per-stage
+breakdown. Histograms keep Prometheus buckets for scraping plus a window of
+recent observations for the p50/p95/p99 reported on /metrics and /health.
+
+Metrics live in the process that records them: with several gunicorn workers
+each worker reports its own, so scrape them individually or sum the series.
+"""
+import bisect
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Latency buckets from 1 ms to 1 minute: index searches are sub-millisecond to
+# a few ms, embedding calls tens of ms and generation seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+QUANTILE_WINDOW = 1024   # Recent observations per series used for the quantiles
+
+
+def _label_text(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class Gauge(Counter):
+    """Current value (queue depth, requests in flight), optionally split by labels"""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """
+    Bucketed histogram (cumulative counts, sum, count) per label set, plus a
+    sliding window of recent observations for quantiles.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 window: int = QUANTILE_WINDOW):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.window = window
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts, sum, count, recent observations]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0, deque(maxlen=self.window)]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+            series[3].append(value)
+
+    def quantiles(self, **labels) -> dict:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            recent = sorted(series[3]) if series else []
+        return self._quantiles(recent)
+
+    @staticmethod
+    def _quantiles(recent: list) -> dict:
+        if not recent:
+            return {}
+        return {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in QUANTILES}
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count, _) in sorted(self._series.items())]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {count}")
+        return lines
+
+    def render_quantiles(self) -> list:
+        """Recent-window quantiles as a separate summary family (`<name>_recent`)"""
+        with self._lock:
+            items = [(key, sorted(series[3])) for key, series in sorted(self._series.items())]
+        lines = []
+        for key, recent in items:
+            for q, value in self._quantiles(recent).items():
+                quantile = 'quantile="%s"' % q
+                lines.append(f"{self.name}_recent{_label_text(self.labelnames, key, quantile)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self) -> dict:
+        """Count, mean and recent p50/p95/p99 in milliseconds per label set"""
+        with self._lock:
+            items = [(key, total, count, sorted(recent)) for key, (_, total, count, recent) in sorted(self._series.items())]
+        result = {}
+        for key, total, count, recent in items:
+            entry = {'count': count, 'mean_ms': round(total / count * 1000, 3) if count else 0.0}
+            for q, value in self._quantiles(recent).items():
+                entry[f"p{int(q * 100)}_ms"] = round(value * 1000, 3)
+            result[",".join(key) or "total"] = entry
+        return result
+
+
+class Registry:
+    """The metrics of this process, rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+            if isinstance(metric, Histogram):
+                lines.append(f"# HELP {metric.name}_recent {metric.help} (last {metric.window} observations)")
+                lines.append(f"# TYPE {metric.name}_recent summary")
+                lines.extend(metric.render_quantiles())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+
+registry = Registry()
+
+stage_duration = registry.histogram(
+    "rag_stage_duration_seconds", "Duration of each stage of answering a question", ("stage",))
+request_duration = registry.histogram(
+    "rag_request_duration_seconds", "Duration of question requests", ("endpoint",))
+requests_total = registry.counter(
+    "rag_requests_total", "Question requests handled", ("endpoint",))
+errors_total = registry.counter(
+    "rag_errors_total", "Errors by stage", ("stage",))
+cache_lookups_total = registry.counter(
+    "rag_answer_cache_lookups_total", "Answer cache lookups by result", ("result",))
+upstream_retries_total = registry.counter(
+    "rag_upstream_retries_total", "Retried calls to the Gemini API", ("call",))
+upstream_calls_total = registry.counter(
+    "rag_upstream_calls_total", "Calls to the Gemini API by outcome", ("call", "result"))
+upstream_hedges_total = registry.counter(
+    "rag_upstream_hedges_total", "Hedged calls to the Gemini API by which request answered first", ("call", "winner"))
+rerank_total = registry.counter(
+    "rag_rerank_total", "Reranked candidate pools by outcome (mmr, cross_encoder or why it was skipped)", ("result",))
+admission_in_flight = registry.gauge(
+    "rag_admission_in_flight", "Questions being answered (admitted past the concurrency cap)")
+admission_queue_depth = registry.gauge(
+    "rag_admission_queue_depth", "Questions waiting for admission")
+admission_wait = registry.histogram(
+    "rag_admission_wait_seconds", "Time questions waited for admission", ("priority",))
+admission_rejections_total = registry.counter(
+    "rag_admission_rejections_total", "Questions rejected by admission control by reason", ("reason",))
+single_flight_total = registry.counter(
+    "rag_single_flight_total", "Questions answered by their own pipeline run (leader) or a shared one (follower)", ("role",))
+tokens_total = registry.counter(
+    "rag_generation_tokens_total", "Estimated tokens sent to and generated by the model", ("direction",))
+
+# Per-stage milliseconds of the request being handled, if it is being timed
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def request_timing():
+    """Collect the stages timed while the block runs into a dict of milliseconds"""
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def observe_stage(name: str, seconds: float):
+    """Record a stage duration measured by the caller"""
+    stage_duration.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 3)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one stage; exceptions are counted in rag_errors_total and re-raised"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors_total.inc(stage=name)
+        raise
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def current_timings() -> dict:
+    """Stage timings of the request being handled, or None outside `request_timing`"""
+    return _request_timings.get()
+
+
+def record_request(endpoint: str, seconds: float):
+    """Count a finished request and record its duration"""
+    requests_total.inc(endpoint=endpoint)
+    request_duration.observe(seconds, endpoint=endpoint)
+
+
+def timed_request(endpoint: str):
+    """Decorator for (sync or async) views: counts and times the request and collects its stage timings"""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                with request_timing():
+                    try:
+                        return await view(*args, **kwargs)
+                    finally:
+                        record_request(endpoint, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            with request_timing():
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    record_request(endpoint, time.perf_counter() - started)
+        return wrapper
+    return decorator
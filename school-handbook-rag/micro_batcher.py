@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
+
+import upstream
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted by concurrent requests into batches.
+
+    `submit()` blocks the calling thread until its result is ready. A collector
+    thread waits for the first item, keeps collecting until `max_batch_size`
+    items have arrived or `max_wait_ms` has passed, then hands the whole batch
+    to `process_batch(items) -> results` on a small thread pool, so a slow batch
+    does not hold up collection of the next one.
+
+    A batch runs under the tightest upstream deadline of its callers (see
+    upstream.py), and items whose caller has already given up are left out.
+    If `process_batch` raises for a batch of several items, each item is
+    retried on its own, so one bad item or transient error only fails the
+    callers it belongs to.
+    """
+
+    def __init__(self, process_batch, max_batch_size: int = 32, max_wait_ms: float = 5,
+                 max_concurrent_batches: int = 4, name: str = "batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix=name)
+        self._collector = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self.split_batches = 0
+        self.abandoned = 0
+
+    def _ensure_started(self):
+        # Started lazily so that pre-forked workers each get their own thread
+        if self._collector is None or not self._collector.is_alive():
+            with self._start_lock:
+                if self._collector is None or not self._collector.is_alive():
+                    self._collector = threading.Thread(target=self._collect, name=f"{self.name}-collector", daemon=True)
+                    self._collector.start()
+
+    def submit(self, item, timeout: float = None):
+        """Queue an item and wait for its result, at most `timeout` seconds (also the item's deadline)"""
+        self._ensure_started()
+        future = Future()
+        until = None if timeout is None else time.monotonic() + timeout
+        self._queue.put((item, future, until))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()  # Leave it out of its batch if that has not started yet
+            raise
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        now = time.monotonic()
+        waiting = []
+        for item, future, until in batch:
+            if not future.set_running_or_notify_cancel():
+                continue  # The caller timed out
+            if until is not None and until <= now:
+                future.set_exception(upstream.UpstreamTimeout("The request deadline ran out before its batch started"))
+                continue
+            waiting.append((item, future, until))
+        with self._stats_lock:
+            self.abandoned += len(batch) - len(waiting)
+            if waiting:
+                self._batch_sizes[len(waiting)] += 1
+        if not waiting:
+            return
+
+        deadlines = [until for _, _, until in waiting if until is not None]
+        with upstream.deadline(min(deadlines) - now) if deadlines else nullcontext():
+            try:
+                results = self.process_batch([item for item, _, _ in waiting])
+            except Exception as e:
+                if len(waiting) == 1:
+                    waiting[0][1].set_exception(e)
+                    return
+                with self._stats_lock:
+                    self.split_batches += 1
+                for item, future, _ in waiting:
+                    self._run_one(item, future)
+                return
+
+        for (_, future, _), result in zip(waiting, results):
+            future.set_result(result)
+
+    def _run_one(self, item, future: Future):
+        try:
+            future.set_result(self.process_batch([item])[0])
+        except Exception as e:
+            future.set_exception(e)
+
+    def stats(self) -> dict:
+        """Batch-size histogram for tuning `max_batch_size` and `max_wait_ms`"""
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            items = sum(size * count for size, count in self._batch_sizes.items())
+            return {
+                'batches': batches,
+                'items': items,
+                'mean_batch_size': round(items / batches, 2) if batches else 0.0,
+                'batch_size_histogram': {str(size): self._batch_sizes[size] for size in sorted(self._batch_sizes)},
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'split_batches': self.split_batches,
+                'abandoned': self.abandoned,
+            }
@@ -0,0 +1,314 @@
+"""
+Answers generated ahead of time for the questions asked most often.
+
+    python precomputed_answers.py                # regenerate for the current index
+    python precomputed_answers.py --top 100      # include the 100 most frequent logged questions
+    python precomputed_answers.py --school riverside
+
+The quick questions on the main page and the most frequent standalone
+questions in the query log (one question per line, appended by the app) are
+answered with the full retrieval and generation pipeline, and the answers
+and their sources are stored in one JSON file together with the index
+version they were generated from. The app answers those questions from the
+store with a dictionary lookup on the normalized question text.
+
+Answers are only served while their index version is the one being served.
+When the index changes, the first lookup that sees the new version starts a
+regeneration in a background thread; a lock file next to the store makes
+sure only one process regenerates, and the other processes pick up the new
+file when it is replaced. Questions whose answer came out degraded (the
+upstream was failing) are left out and counted in the store; such an
+incomplete store is served but regenerated again, as is a version whose
+regeneration failed or was locked by another process, with the retries
+backing off exponentially.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from answer_cache import normalize_question
+
+STORE_FORMAT_VERSION = 1
+
+
+def rotated_log_path(path: str) -> str:
+    """Where the query log's previous generation is kept"""
+    return f"{path}.1"
+
+
+def append_query_log(path: str, question: str, max_bytes: int = None):
+    """
+    Append a question to the query log (one O_APPEND write, so lines from
+    several workers do not interleave). Once the log outgrows `max_bytes` it
+    replaces the previous generation, so the two together hold between
+    `max_bytes` and twice that of the most recent questions.
+    """
+    line = " ".join(question.split()) + "\n"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+        stat = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if max_bytes and stat.st_size > max_bytes:
+        try:
+            # Another worker may have rotated it first: only move the file this line went to
+            if os.stat(path).st_ino == stat.st_ino:
+                os.replace(path, rotated_log_path(path))
+        except OSError:
+            pass
+
+
+def top_logged_questions(path: str, limit: int) -> list:
+    """The `limit` most frequent questions in the query log and its previous generation, each in its most common wording"""
+    if not limit or not path:
+        return []
+    counts = Counter()
+    wordings = {}
+    for log_path in (rotated_log_path(path), path):
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                question = line.strip()
+                key = normalize_question(question)
+                if key:
+                    counts[key] += 1
+                    wordings.setdefault(key, Counter())[question] += 1
+    return [wordings[key].most_common(1)[0][0] for key, _ in counts.most_common(limit)]
+
+
+def question_catalog(quick_questions: list, logged_questions: list) -> list:
+    """Quick questions first, then logged ones, without duplicates (by normalized text)"""
+    seen = set()
+    catalog = []
+    for question in list(quick_questions) + list(logged_questions):
+        key = normalize_question(question)
+        if key and key not in seen:
+            seen.add(key)
+            catalog.append(question)
+    return catalog
+
+
+def read_store(path: str) -> tuple:
+    """(index version, {normalized question: entry}, questions left out) of a store file; (None, {}, 0) if there is none"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None, {}, 0
+    if data.get('format') != STORE_FORMAT_VERSION:
+        return None, {}, 0
+    return data.get('index_version'), data.get('answers', {}), data.get('dropped', 0)
+
+
+def write_store(path: str, index_version: str, answers: dict, dropped: int = 0):
+    """Atomically replace the store with answers for `index_version`, `dropped` questions having been left out"""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({'format': STORE_FORMAT_VERSION, 'index_version': index_version,
+                       'created': datetime.now().isoformat(), 'answers': answers, 'dropped': dropped}, f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PrecomputedAnswers:
+    """
+    Serves the store file for the current index version and regenerates it
+    when the version changes.
+
+    `regenerate(index_version)` returns ({normalized question: entry}, number
+    of questions left out), or None if that version is no longer being
+    served. The file is re-read when it changes on disk, checked at most every
+    `check_interval_seconds`. A regeneration that does not leave a complete
+    store is retried after `retry_base_seconds`, doubling up to
+    `retry_max_seconds`.
+    """
+
+    def __init__(self, path: str, regenerate=None, check_interval_seconds: float = 1.0,
+                 lock_timeout_seconds: float = 900, retry_base_seconds: float = 30,
+                 retry_max_seconds: float = 1800):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.regenerate = regenerate
+        self.check_interval_seconds = check_interval_seconds
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+
+        self._lock = threading.Lock()
+        self._version = None
+        self._answers = {}
+        self._dropped = 0
+        self._file_stat = None
+        self._checked_at = 0.0
+        self._thread = None
+        # Regeneration attempts for the latest version this process was asked for
+        self._retry_version = None
+        self._failures = 0
+        self._next_attempt = 0.0     # time.monotonic() before which it is not retried
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.regenerations = 0
+        self.last_regeneration_seconds = None
+        self.last_error = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _reload_if_changed(self, force: bool = False):
+        """Re-read the store file if it was replaced (lock held)"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval_seconds:
+            return
+        self._checked_at = now
+        stat = self._stat()
+        if stat != self._file_stat:
+            self._file_stat = stat
+            self._version, self._answers, self._dropped = read_store(self.path)
+
+    def get(self, question: str, index_version: str):
+        """The stored entry for a question, if there is one for this index version"""
+        with self._lock:
+            self._reload_if_changed()
+            entry = None
+            if self._version != index_version:
+                self.stale += 1
+            else:
+                entry = self._answers.get(normalize_question(question))
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            # The answers of an incomplete store are right for its version, so they are served meanwhile
+            complete = self._version == index_version and not self._dropped
+        if not complete:
+            self._schedule(index_version)
+        return entry
+
+    def _schedule(self, index_version: str):
+        """Regenerate for an index version in the background, unless running or backing off after a failure"""
+        if self.regenerate is None:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if index_version != self._retry_version:
+                self._retry_version, self._failures, self._next_attempt = index_version, 0, 0.0
+            elif time.monotonic() < self._next_attempt:
+                return
+            self._thread = threading.Thread(target=self._regenerate_in_background, args=(index_version,),
+                                            name="precompute-answers", daemon=True)
+            self._thread.start()
+
+    def _regenerate_in_background(self, index_version: str):
+        complete = self.regenerate_now(index_version)
+        with self._lock:
+            if index_version != self._retry_version:
+                return
+            if complete:
+                self._failures = 0
+                return
+            delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** self._failures)
+            self._failures += 1
+            self._next_attempt = time.monotonic() + delay
+        print(f"⚠️ Precomputed answers for index version {index_version} are incomplete; retrying in {delay:.0f}s")
+
+    def _acquire_file_lock(self) -> bool:
+        """Take the cross-process regeneration lock; a lock older than the timeout is presumed abandoned"""
+        for _ in range(2):
+            try:
+                os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) < self.lock_timeout_seconds:
+                        return False
+                    os.remove(self.lock_path)
+                except OSError:
+                    pass
+        return False
+
+    def regenerate_now(self, index_version: str) -> bool:
+        """
+        Generate and store the answers for `index_version` unless another
+        process is already doing it; True once the store holds every answer.
+        """
+        if not self._acquire_file_lock():
+            return False
+        try:
+            stored_version, _, dropped = read_store(self.path)
+            if stored_version == index_version and not dropped:
+                return True  # Another process finished first
+            started = time.perf_counter()
+            result = self.regenerate(index_version)
+            if result is None:
+                return True  # No longer served: nothing left to do for this version
+            answers, dropped = result
+            write_store(self.path, index_version, answers, dropped)
+            with self._lock:
+                self.regenerations += 1
+                self.last_regeneration_seconds = round(time.perf_counter() - started, 2)
+                self.last_error = f"{dropped} questions left out with degraded answers" if dropped else None
+                self._reload_if_changed(force=True)
+            print(f"✅ Precomputed {len(answers)} answers for index version {index_version}"
+                  + (f" ({dropped} left out)" if dropped else ""))
+            return not dropped
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"⚠️ Precomputing answers failed: {e!r}")
+            return False
+        finally:
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'index_version': self._version,
+                'entries': len(self._answers),
+                'dropped': self._dropped,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_lookups': self.stale,
+                'regenerating': self._thread is not None and self._thread.is_alive(),
+                'failed_attempts': self._failures,
+                'regenerations': self.regenerations,
+                'last_regeneration_seconds': self.last_regeneration_seconds,
+                'last_error': self.last_error,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, help="number of logged questions to include (default: PRECOMPUTE_TOP_QUERIES)")
+    parser.add_argument("--school", help="a school's handbook (see tenants.py) instead of the default one")
+    args = parser.parse_args()
+
+    import app as rag
+    if args.top is not None:
+        rag.PRECOMPUTE_TOP_QUERIES = args.top
+    if args.school is None and not rag.load_rag_data():
+        raise SystemExit("Failed to load RAG data")
+    tenant = rag.resolve_tenant(args.school)
+    if not tenant.precomputed.regenerate_now(tenant.snapshot.version):
+        raise SystemExit(f"Answers not regenerated: {tenant.precomputed.last_error or 'locked by another process'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Second-stage reranking of the retrieved candidate pool.
+
+First-stage retrieval returns its nearest neighbours in order, and the top
+few are often near-duplicates of each other. The reranker takes a wider pool
+and picks the chunks to keep with maximal marginal relevance (MMR):
+
+    score(c) = lambda * relevance(c) - (1 - lambda) * max similarity(c, already picked)
+
+Similarities come from the candidates' stored vectors, read back from the
+FAISS index (index.reconstruct_batch), so no embedding calls are made. A
+candidate's relevance is its first-stage rank (1 for the top hit, falling
+linearly): the hybrid ranking already combines vector and keyword scores,
+and blending the raw cosine similarity back in lowered MRR on the
+retrieval evaluation set. With a cross-encoder (optional, needs
+sentence-transformers) the question and each candidate are scored together
+on CPU and those scores are the relevance instead.
+
+Reranking runs within a latency budget: the cross-encoder only runs if its
+measured cost per candidate fits the time left, and the pool is returned in
+first-stage order if the budget is already spent. The model is loaded on a
+background thread on first use; until it is ready, MMR runs alone.
+"""
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:  # Only needed for cross-encoder reranking
+    CrossEncoder = None
+
+
+def _min_max(values: np.ndarray) -> np.ndarray:
+    spread = values.max() - values.min() if len(values) else 0
+    if spread <= 0:
+        return np.ones_like(values)
+    return (values - values.min()) / spread
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_select(relevance: np.ndarray, similarity: np.ndarray, top_k: int, mmr_lambda: float = 0.7):
+    """
+    Greedy MMR over candidates with `relevance` scores and a pairwise
+    `similarity` matrix; returns (picked positions, their MMR scores).
+    """
+    count = len(relevance)
+    redundancy = np.zeros(count, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    picked, scores = [], []
+    for _ in range(min(top_k, count)):
+        mmr = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        picked.append(best)
+        scores.append(float(mmr[best]))
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return picked, scores
+
+
+class CrossEncoderScorer:
+    """A sentence-transformers cross-encoder on CPU, loaded on a background thread on first use"""
+
+    def __init__(self, model_name: str, max_length: int = 512):
+        if CrossEncoder is None:
+            raise ImportError("Cross-encoder reranking requires sentence-transformers: pip install sentence-transformers")
+        self.model_name = model_name
+        self.max_length = max_length
+        self.model = None
+        self.seconds_per_pair = None  # Measured cost, used to decide whether scoring fits the budget
+        self.error = None
+        self._lock = threading.Lock()
+        self._loader = None
+
+    def ready(self) -> bool:
+        """Whether the model is loaded; starts loading it (once per process) if not"""
+        if self.model is not None:
+            return True
+        with self._lock:
+            # Started lazily so that pre-forked workers each load their own copy
+            if self._loader is None and self.error is None:
+                self._loader = threading.Thread(target=self._load, name="cross-encoder-loader", daemon=True)
+                self._loader.start()
+        return False
+
+    def _load(self):
+        try:
+            model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+            started = time.perf_counter()
+            model.predict([("warm up", "warm up")] * 4)
+            self.seconds_per_pair = (time.perf_counter() - started) / 4
+            self.model = model
+            print(f"✅ Loaded cross-encoder {self.model_name}")
+        except Exception as e:
+            self.error = repr(e)
+            print(f"⚠️ Cross-encoder {self.model_name} could not be loaded, reranking with MMR only: {e!r}")
+
+    def score(self, question: str, texts: list) -> np.ndarray:
+        started = time.perf_counter()
+        scores = np.asarray(self.model.predict([(question, text) for text in texts]), dtype=np.float32)
+        measured = (time.perf_counter() - started) / max(1, len(texts))
+        self.seconds_per_pair = 0.8 * self.seconds_per_pair + 0.2 * measured
+        return scores
+
+
+class Reranker:
+    """
+    Reranks a candidate pool with MMR (and a cross-encoder, if given) within
+    `budget_ms`, keeping the best `top_k`.
+    """
+
+    def __init__(self, top_k: int = 4, mmr_lambda: float = 0.7, budget_ms: float = 30,
+                 cross_encoder: CrossEncoderScorer = None):
+        self.top_k = top_k
+        self.mmr_lambda = mmr_lambda
+        self.budget_ms = budget_ms
+        self.cross_encoder = cross_encoder
+
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.cross_encoded = 0
+        self.skipped = Counter()  # reason -> requests
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def rerank(self, question: str, index, candidates: list, texts: list, top_k: int = None) -> tuple:
+        """
+        Rerank candidate chunk ids (in first-stage order) given their texts.
+
+        Returns (positions into `candidates` to keep, their scores or None,
+        details); the scores are None if reranking was skipped, in which case
+        the first `top_k` (default: self.top_k) candidates are kept.
+        """
+        top_k = self.top_k if top_k is None else top_k
+        started = time.perf_counter()
+        deadline = started + self.budget_ms / 1000
+        details = {'candidates': len(candidates), 'cross_encoder': False, 'skipped': None}
+
+        scores = None
+        keep = list(range(min(top_k, len(candidates))))
+        if len(candidates) <= 1:
+            details['skipped'] = 'too_few_candidates'
+        else:
+            try:
+                vectors = _normalize_rows(index.reconstruct_batch(np.asarray(candidates, dtype='int64')))
+            except RuntimeError as e:
+                vectors = None
+                details['skipped'] = 'vectors_unavailable'
+                print(f"⚠️ Reranking skipped, the index cannot return stored vectors: {e}")
+            if vectors is not None:
+                relevance = self._relevance(question, texts, deadline, details)
+                if time.perf_counter() > deadline:
+                    details['skipped'] = 'budget'
+                else:
+                    keep, scores = mmr_select(relevance, vectors @ vectors.T, top_k, self.mmr_lambda)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        details['kept'] = len(keep)
+        details['ms'] = round(elapsed_ms, 3)
+        with self._lock:
+            if details['skipped']:
+                self.skipped[details['skipped']] += 1
+            else:
+                self.reranked += 1
+            self.cross_encoded += details['cross_encoder']
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+        return keep, scores, details
+
+    def _relevance(self, question: str, texts: list, deadline: float, details: dict) -> np.ndarray:
+        """Cross-encoder scores if they fit the budget, else the first-stage rank"""
+        encoder = self.cross_encoder
+        if encoder is not None and encoder.ready():
+            remaining = deadline - time.perf_counter()
+            if encoder.seconds_per_pair * len(texts) <= remaining:
+                details['cross_encoder'] = True
+                return _min_max(encoder.score(question, texts))
+            details['cross_encoder_skipped'] = 'budget'
+        return 1 - np.arange(len(texts), dtype=np.float32) / len(texts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.reranked + sum(self.skipped.values())
+            encoder = self.cross_encoder
+            return {
+                'top_k': self.top_k,
+                'budget_ms': self.budget_ms,
+                'reranked': self.reranked,
+                'skipped': dict(self.skipped),
+                'cross_encoder': None if encoder is None else {
+                    'model': encoder.model_name,
+                    'loaded': encoder.model is not None,
+                    'ms_per_pair': round(encoder.seconds_per_pair * 1000, 3) if encoder.seconds_per_pair else None,
+                    'error': encoder.error,
+                },
+                'cross_encoded': self.cross_encoded,
+                'avg_ms': round(self.total_ms / requests, 3) if requests else None,
+                'max_ms': round(self.max_ms, 3),
+            }
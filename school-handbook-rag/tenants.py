@@ -0,0 +1,233 @@
+"""
+Serving several schools' handbooks from one process.
+
+Each school (tenant) has a directory under the tenants root holding the same
+artifacts as the default handbook, built with
+
+    python build_index.py --tenant riverside      # tenants/riverside/school_handbook.md -> tenants/riverside/
+
+and optionally a tenant.json with its settings:
+
+    {"name": "Riverside Elementary",
+     "prompt_template": "You answer questions about {school_name}... {context} {conversation} {question}",
+     "quick_questions": [["fa-bus", "Bus Routes", "Which bus routes are there?"]]}
+
+Nothing is read at startup, so startup time and memory do not depend on the
+number of schools. A school is loaded the first time a request names it
+(concurrent requests wait for the one load), and loaded schools are unloaded
+least recently used first when their combined size (index artifacts plus
+answer cache) exceeds the memory budget. Requests that still hold an unloaded
+school's snapshot finish on it.
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+TENANT_SETTINGS_FILE = "tenant.json"
+PROMPT_FIELDS = ('school_name', 'context', 'conversation', 'question')
+
+
+class TenantError(Exception):
+    """A request names a school that cannot be served; `status` is the HTTP status to answer with"""
+    status = 500
+
+
+class UnknownTenantError(TenantError):
+    status = 404
+
+    def __init__(self, tenant_id):
+        super().__init__(f"Unknown school: {tenant_id}")
+
+
+class TenantLoadError(TenantError):
+    status = 503
+
+
+def read_tenant_settings(directory: str) -> dict:
+    """The school's tenant.json, or {} if it has none"""
+    path = os.path.join(directory, TENANT_SETTINGS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+class Tenant:
+    """
+    One school's handbook: its loaded index snapshot, name, prompt template,
+    quick questions, answer cache and precomputed answers.
+
+    Requests read `snapshot` once, the way the single-handbook app reads
+    `current_snapshot`; `reloader` swaps in rebuilt artifacts.
+    """
+
+    def __init__(self, tenant_id, directory: str, name: str, prompt_template: str, quick_questions: list,
+                 answer_cache, precomputed=None, query_log_path: str = None):
+        try:
+            prompt_template.format(**{field: "" for field in PROMPT_FIELDS})
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Invalid prompt_template for {name}: {e!r} "
+                             f"(available fields: {', '.join(PROMPT_FIELDS)})")
+        self.id = tenant_id
+        self.directory = directory
+        self.name = name
+        self.prompt_template = prompt_template
+        self.quick_questions = [tuple(question) for question in quick_questions]
+        self.answer_cache = answer_cache
+        self.precomputed = precomputed
+        self.query_log_path = query_log_path
+        self.snapshot = None
+        self.reloader = None
+
+    def swap(self, snapshot):
+        """Serve a newly loaded snapshot; answers cached from the old one are dropped"""
+        self.snapshot = snapshot
+        self.answer_cache.clear()
+        print(f"✅ Loaded {self.name} index version {snapshot.version} with {len(snapshot.chunks)} chunks")
+
+    def memory_bytes(self) -> int:
+        snapshot = self.snapshot
+        return (snapshot.size_bytes if snapshot is not None else 0) + self.answer_cache.stats()['bytes']
+
+    def describe(self) -> dict:
+        snapshot = self.snapshot
+        return {
+            'name': self.name,
+            'index_version': snapshot.version if snapshot is not None else None,
+            'chunks': len(snapshot.chunks) if snapshot is not None else 0,
+            'memory_bytes': self.memory_bytes(),
+            'answer_cache_entries': self.answer_cache.stats()['entries'],
+        }
+
+
+class TenantRegistry:
+    """
+    Loads schools from `root/<tenant id>/` on first use and keeps the recently
+    used ones loaded within `memory_budget_bytes`.
+
+    `open_tenant(tenant_id, directory)` loads a school and returns its Tenant
+    (with `reloader` set). A watcher thread, started with the first load,
+    polls the loaded schools' artifacts for rebuilds every `poll_seconds`.
+    """
+
+    def __init__(self, root: str, open_tenant, memory_budget_bytes: int, poll_seconds: float = 5.0):
+        self.root = root
+        self.open_tenant = open_tenant
+        self.memory_budget_bytes = memory_budget_bytes
+        self.poll_seconds = poll_seconds
+
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()  # tenant id -> Tenant, least recently used first
+        self._load_locks = {}         # tenant id -> lock held while it loads
+        self._stats = {}              # tenant id -> counters, kept after eviction
+        self._thread = None
+        self.evictions = 0
+
+    def _record(self, tenant_id: str) -> dict:
+        """The counters of a tenant (lock held)"""
+        stats = self._stats.get(tenant_id)
+        if stats is None:
+            stats = self._stats[tenant_id] = {'hits': 0, 'loads': 0, 'load_errors': 0, 'evictions': 0,
+                                              'last_load_seconds': None, 'last_used': None, 'last_error': None}
+        return stats
+
+    def _hit(self, tenant_id: str):
+        """The loaded tenant, marked as most recently used, or None (lock held)"""
+        tenant = self._loaded.get(tenant_id)
+        if tenant is not None:
+            self._loaded.move_to_end(tenant_id)
+            stats = self._record(tenant_id)
+            stats['hits'] += 1
+            stats['last_used'] = time.time()
+        return tenant
+
+    def get(self, tenant_id: str) -> Tenant:
+        """The school's Tenant, loading it if needed; raises UnknownTenantError or TenantLoadError"""
+        with self._lock:
+            tenant = self._hit(tenant_id)
+        if tenant is not None:
+            return tenant
+
+        directory = os.path.join(self.root, tenant_id) if TENANT_ID_PATTERN.match(tenant_id) else None
+        if directory is None or not os.path.isdir(directory):
+            raise UnknownTenantError(tenant_id)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(tenant_id, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                tenant = self._hit(tenant_id)  # Loaded by a concurrent request meanwhile
+            if tenant is not None:
+                return tenant
+            started = time.perf_counter()
+            try:
+                tenant = self.open_tenant(tenant_id, directory)
+            except Exception as e:
+                with self._lock:
+                    stats = self._record(tenant_id)
+                    stats['load_errors'] += 1
+                    stats['last_error'] = f"{datetime.now().isoformat()}: {e}"
+                print(f"❌ Error loading school {tenant_id}: {e}")
+                raise TenantLoadError(f"The handbook of {tenant_id} could not be loaded") from e
+            with self._lock:
+                stats = self._record(tenant_id)
+                stats['loads'] += 1
+                stats['last_load_seconds'] = round(time.perf_counter() - started, 4)
+                stats['last_used'] = time.time()
+                stats['last_error'] = None
+                self._loaded[tenant_id] = tenant
+                self._evict()
+                self._start_watcher()
+        return tenant
+
+    def _evict(self):
+        """Unload the least recently used tenants until the rest fit the memory budget (lock held)"""
+        sizes = {tenant_id: tenant.memory_bytes() for tenant_id, tenant in self._loaded.items()}
+        total = sum(sizes.values())
+        while total > self.memory_budget_bytes and len(self._loaded) > 1:
+            tenant_id, tenant = self._loaded.popitem(last=False)
+            total -= sizes[tenant_id]
+            self._record(tenant_id)['evictions'] += 1
+            self.evictions += 1
+            print(f"Unloaded {tenant.name} ({sizes[tenant_id]} bytes) to stay within the memory budget")
+
+    def _start_watcher(self):
+        """Start polling the loaded tenants for rebuilt artifacts (lock held)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name="tenant-reloader", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            with self._lock:
+                tenants = list(self._loaded.values())
+            for tenant in tenants:
+                tenant.reloader.poll()
+            with self._lock:
+                self._evict()  # Rebuilt indexes and answer caches change the sizes
+
+    def stats(self) -> dict:
+        """Per-tenant load, hit and eviction counters for the /health endpoint"""
+        with self._lock:
+            loaded = dict(self._loaded)
+            stats = {tenant_id: dict(counters) for tenant_id, counters in self._stats.items()}
+        tenants = {}
+        for tenant_id, counters in sorted(stats.items()):
+            tenant = loaded.get(tenant_id)
+            tenants[tenant_id] = {'loaded': tenant is not None, **counters,
+                                  **(tenant.describe() if tenant is not None else {})}
+        return {
+            'root': self.root,
+            'loaded': len(loaded),
+            'memory_bytes': sum(tenant['memory_bytes'] for tenant in tenants.values() if tenant['loaded']),
+            'memory_budget_bytes': self.memory_budget_bytes,
+            'evictions': self.evictions,
+            'watching': self._thread is not None and self._thread.is_alive(),
+            'tenants': tenants,
+        }
@@ -0,0 +1,70 @@
+import pytest
+
+from chunk_store import ChunkStore, load_chunks, write_chunk_store
+
+SOURCE = """**1. GENERAL INFORMATION**
+Welcome to the school.
+
+**1.1. Hours** The school day runs from 8:00 to 3:00.
+
+**2. ACADEMIC POLICIES**
+Grades are posted every quarter.
+
+**2.1. Attendance** Students must attend 90% of classes. Señora Núñez takes attendance.
+
+**2.1.1. Tardies** Three tardies count as one absence.
+"""
+
+
+def handbook_chunks():
+    return [piece.strip() for piece in SOURCE.split("\n\n")]
+
+
+@pytest.mark.parametrize("count", range(0, 400, 7))
+@pytest.mark.parametrize("exact_tokens", [False, True])
+def test_round_trip(tmp_path, count, exact_tokens):
+    # Different sizes move the header's section offsets across digit (and so alignment) boundaries
+    base = handbook_chunks()
+    chunks = [f"{base[i % len(base)]} ({i})" for i in range(count)]
+    token_counts = list(range(1, count + 1)) if exact_tokens else None
+    path = str(tmp_path / "handbook.chunks")
+    write_chunk_store(path, chunks, token_counts)
+
+    store = ChunkStore(path)
+    assert len(store) == count
+    assert list(store) == chunks
+    assert store[-1:] == chunks[-1:]
+    if exact_tokens:
+        assert [store.token_count(i) for i in range(count)] == token_counts
+
+
+def test_round_trip_metadata(tmp_path):
+    chunks = handbook_chunks()
+    path = str(tmp_path / "handbook.chunks")
+    write_chunk_store(path, chunks, source=SOURCE)
+
+    store = load_chunks(path)
+    assert list(store) == chunks
+    assert store.chunk_metadata(4)['section'] == "2.1.1"
+    assert store.section_path(4) == "2. ACADEMIC POLICIES › 2.1. Attendance › 2.1.1. Tardies"
+    start, end = store.chunk_metadata(3)['source_range']
+    assert SOURCE.encode("utf-8")[start:end].decode("utf-8") == chunks[3]
+    assert store.preview(3, 20) == chunks[3][:20] + "..."
+    with pytest.raises(IndexError):
+        store[len(chunks)]
+
+
+def test_section_lookups(tmp_path):
+    path = str(tmp_path / "handbook.chunks")
+    write_chunk_store(path, handbook_chunks())
+    store = ChunkStore(path)
+
+    assert [store.section(i) for i in range(len(store))] == ["1", "1.1", "2", "2.1", "2.1.1"]
+    assert list(store.parents) == [-1, 0, -1, 2, 3]
+    assert list(store.siblings(1)) == []
+    assert store.top_level_sections() == [{'section': "1", 'title': "GENERAL INFORMATION"},
+                                          {'section': "2", 'title': "ACADEMIC POLICIES"}]
+    assert list(store.top_level_mask("2")) == [False, False, True, True, True]
+    assert list(store.top_level_mask("General Information")) == [True, True, False, False, False]
+    with pytest.raises(KeyError):
+        store.top_level_mask("9")
@@ -0,0 +1,43 @@
+import pytest
+
+from conversation import is_follow_up, new_terms
+
+PREVIOUS = "What is the dress code for juniors?"
+
+
+@pytest.mark.parametrize("question", [
+    "What is PTO?",
+    "Who is the principal?",
+    "Where is the library?",
+    "Why do students wear uniforms?",
+    "When does school start?",
+    "How do I apply for a parking permit?",
+    "What is the dress code?",
+    "What is the dress code for juniors?",
+])
+def test_standalone_questions(question):
+    assert not is_follow_up(question, PREVIOUS)
+
+
+@pytest.mark.parametrize("question", [
+    "What about for seniors?",
+    "And for seniors?",
+    "Does that apply to seniors too?",
+    "Can you explain that in more detail?",
+    "Why?",
+    "Why not?",
+    "Tell me more",
+    "What about juniors?",
+    "Is that the dress code for juniors?",
+])
+def test_follow_ups(question):
+    assert is_follow_up(question, PREVIOUS)
+
+
+def test_no_history():
+    assert not is_follow_up("What about for seniors?", "")
+
+
+def test_new_terms():
+    assert new_terms("What about for seniors?", PREVIOUS) == {"seniors"}
+    assert new_terms("Can you explain that in more detail?", PREVIOUS) == set()
@@ -0,0 +1,37 @@
+import pytest
+
+import ingest
+from ingest import chunk_path, read_blocks, split_lines
+
+DOCUMENT = ("# Handbook\r\n\r\n**1. GENERAL INFORMATION**\r\nWelcome to the school.\r\n\r\n"
+            "**1.1. Hours** Classes run\x0cfrom 8:00 to 3:00  (Señora Núñez).\r\n"
+            "\r\n**2. ATTENDANCE**\nOld Mac line\rNext line\r\n")
+LINES = ["# Handbook", "", "**1. GENERAL INFORMATION**", "Welcome to the school.", "",
+         "**1.1. Hours** Classes run\x0cfrom 8:00 to 3:00  (Señora Núñez).",
+         "", "**2. ATTENDANCE**", "Old Mac line", "Next line"]
+
+
+@pytest.fixture
+def document(tmp_path):
+    path = tmp_path / "handbook.md"
+    path.write_bytes(DOCUMENT.encode("utf-8"))
+    return str(path)
+
+
+@pytest.mark.parametrize("block_bytes", [1, 2, 3, 5, 7, 16, 64, 1024 * 1024])
+def test_lines_do_not_depend_on_block_size(monkeypatch, document, block_bytes):
+    monkeypatch.setattr(ingest, "READ_BLOCK_BYTES", block_bytes)
+    assert list(split_lines(read_blocks(document))) == LINES
+
+
+@pytest.mark.parametrize("block_bytes", [1, 3, 64])
+def test_chunks_do_not_depend_on_block_size(monkeypatch, document, block_bytes):
+    expected = chunk_path(document)
+    monkeypatch.setattr(ingest, "READ_BLOCK_BYTES", block_bytes)
+    assert chunk_path(document) == expected
+
+
+def test_crlf_split_across_blocks():
+    assert list(split_lines(["a\r", "\nb"])) == ["a", "b"]
+    assert list(split_lines(["a\r", "b\r"])) == ["a", "b"]
+    assert list(split_lines(["a\n\r"])) == ["a", ""]
@@ -0,0 +1,68 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import upstream
+from micro_batcher import MicroBatcher
+
+
+def submit_all(batcher, items, timeout=None):
+    with ThreadPoolExecutor(len(items)) as pool:
+        futures = [pool.submit(batcher.submit, item, timeout) for item in items]
+        return [future.exception() or future.result() for future in futures]
+
+
+def test_coalesces_items():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=8, max_wait_ms=50)
+    assert submit_all(batcher, [1, 2, 3, 4]) == [2, 4, 6, 8]
+    assert batcher.stats()['mean_batch_size'] > 1
+
+
+def test_failure_only_fails_the_offending_item():
+    def process(items):
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=50)
+    results = submit_all(batcher, ["a", "bad", "c"])
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], ValueError)
+
+
+def test_batch_runs_under_the_callers_deadline():
+    seen = []
+
+    def process(items):
+        seen.append(upstream.remaining())
+        return items
+
+    batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=20)
+    assert batcher.submit("a", timeout=5) == "a"
+    assert seen[0] is not None and 0 < seen[0] <= 5
+    assert batcher.submit("b") == "b"
+    assert seen[1] is None
+
+
+def test_timed_out_items_are_left_out():
+    processed = []
+    release = threading.Event()
+
+    def process(items):
+        release.wait(1)
+        processed.extend(items)
+        return items
+
+    batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=1, max_concurrent_batches=1)
+    first = threading.Thread(target=batcher.submit, args=("first",))
+    first.start()
+    time.sleep(0.05)
+    with pytest.raises(TimeoutError):
+        batcher.submit("late", timeout=0.05)
+    release.set()
+    first.join()
+    time.sleep(0.05)
+    assert processed == ["first"]
+    assert batcher.stats()['abandoned'] == 1
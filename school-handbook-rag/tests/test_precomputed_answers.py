@@ -0,0 +1,108 @@
+import os
+import time
+
+from precomputed_answers import (PrecomputedAnswers, append_query_log, read_store, rotated_log_path,
+                                 top_logged_questions, write_store)
+
+
+def entry(question):
+    return {'question': question, 'response': f"Answer to {question}", 'sources_info': [], 'context': {}}
+
+
+def wait_idle(store):
+    for _ in range(200):
+        if not store.stats()['regenerating']:
+            return
+        time.sleep(0.01)
+
+
+def test_store_round_trip(tmp_path):
+    path = str(tmp_path / "answers.json")
+    write_store(path, "v1", {'a': entry("a")}, dropped=2)
+    assert read_store(path) == ("v1", {'a': entry("a")}, 2)
+    assert read_store(str(tmp_path / "missing.json")) == (None, {}, 0)
+
+
+def test_regenerates_a_new_version(tmp_path):
+    calls = []
+
+    def regenerate(version):
+        calls.append(version)
+        return {'what is pto': entry("What is PTO?")}, 0
+
+    store = PrecomputedAnswers(str(tmp_path / "answers.json"), regenerate, check_interval_seconds=0)
+    assert store.get("What is PTO?", "v1") is None
+    wait_idle(store)
+    assert store.get("What is PTO?", "v1")['response'] == "Answer to What is PTO?"
+    wait_idle(store)
+    assert calls == ["v1"]
+
+
+def test_incomplete_store_is_served_and_retried_with_backoff(tmp_path):
+    results = [({'what is pto': entry("What is PTO?")}, 1),
+               ({'what is pto': entry("What is PTO?"), 'dress code': entry("Dress code")}, 0)]
+    calls = []
+
+    def regenerate(version):
+        calls.append(version)
+        return results[len(calls) - 1]
+
+    store = PrecomputedAnswers(str(tmp_path / "answers.json"), regenerate, check_interval_seconds=0,
+                               retry_base_seconds=0.2)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert store.stats()['dropped'] == 1
+    assert store.get("What is PTO?", "v1") is not None  # Served while incomplete...
+    wait_idle(store)
+    assert len(calls) == 1                                # ...but not retried before the backoff
+    time.sleep(0.25)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert len(calls) == 2
+    assert store.get("Dress code", "v1") is not None
+    assert store.stats()['dropped'] == 0
+
+
+def test_failed_regeneration_is_retried(tmp_path):
+    calls = []
+
+    def regenerate(version):
+        calls.append(version)
+        if len(calls) == 1:
+            raise RuntimeError("upstream down")
+        return {'what is pto': entry("What is PTO?")}, 0
+
+    store = PrecomputedAnswers(str(tmp_path / "answers.json"), regenerate, check_interval_seconds=0,
+                               retry_base_seconds=0.05)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert store.stats()['last_error'] == "upstream down"
+    time.sleep(0.1)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert store.get("What is PTO?", "v1") is not None
+
+
+def test_locked_regeneration_is_retried(tmp_path):
+    path = str(tmp_path / "answers.json")
+    open(f"{path}.lock", "w").close()
+    store = PrecomputedAnswers(path, lambda version: ({'what is pto': entry("What is PTO?")}, 0),
+                               check_interval_seconds=0, retry_base_seconds=0.05)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert store.stats()['failed_attempts'] == 1
+    (tmp_path / "answers.json.lock").unlink()
+    time.sleep(0.1)
+    store.get("What is PTO?", "v1")
+    wait_idle(store)
+    assert store.get("What is PTO?", "v1") is not None
+
+
+def test_query_log_is_rotated(tmp_path):
+    path = str(tmp_path / "query_log.txt")
+    for _ in range(30):
+        append_query_log(path, "What is PTO?", max_bytes=100)
+    append_query_log(path, "Where is the library?", max_bytes=100)
+    assert os.path.getsize(path) <= 100
+    assert os.path.getsize(rotated_log_path(path)) <= 113
+    assert top_logged_questions(path, 2) == ["What is PTO?", "Where is the library?"]
@@ -0,0 +1,449 @@
+"""
+Resilient calls to the Gemini API: deadlines, retries, a circuit breaker and hedging.
+
+    with upstream.deadline(30):
+        vectors = embedding_client.call(embedder.embed_queries, texts)
+
+Each call is made in attempts. An attempt has a timeout of the client's
+`timeout`, cut short by the deadline of the request being served (set with
+`deadline` or `with_deadline`, and carried along in a context variable).
+Transient failures (timeouts, connection errors, HTTP 408/429/5xx) are
+retried with exponential backoff and jitter while the deadline allows.
+
+Every client has a circuit breaker: after `failure_threshold` consecutive
+transient failures it opens and calls fail immediately with
+`CircuitOpenError` for `reset_seconds`, so a struggling upstream is not
+flooded with requests that would time out anyway. Then a single probe call
+is let through; it closes the breaker if it succeeds and reopens it if not.
+
+With hedging on, an attempt still running after the recent p95 latency of
+its call gets a second, identical request, and whichever answers first is
+used. Only idempotent calls should be hedged.
+
+Calls made inside `batch_priority()` are background work (bulk answering):
+they wait while `batch_limit` or more calls of the same client are in
+flight, so they use spare capacity and interactive calls never queue behind
+them, and they share the interactive calls' retries and circuit breaker.
+
+The pinned SDK (google-generativeai 0.3.2) takes no timeout, so synchronous
+attempts run on the client's thread pool and are abandoned when they time
+out: the call finishes in the background and its result is discarded. The
+pool size bounds how many can pile up. Async attempts are cancelled. The
+SDK also retries 503 responses itself for up to a minute; the attempt
+timeout cuts that short, and a timed-out attempt counts as a failure.
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import metrics
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+CALL_RESULTS = ("ok", "error", "timeout", "rejected", "stream_error")
+HEDGE_MIN_SAMPLES = 20      # Successful calls needed before the p95 is trusted as a hedge delay
+LATENCY_WINDOW = 200        # Recent successful call latencies kept per client
+
+_END = object()
+
+
+class UpstreamError(Exception):
+    """An upstream call failed for a reason the caller should handle by degrading"""
+
+
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker is open: the call was not attempted"""
+
+
+class UpstreamTimeout(UpstreamError, TimeoutError):
+    """An attempt or the request deadline ran out"""
+
+
+# Absolute time.monotonic() by which the request being served must finish
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+# Whether the calls being made are low-priority batch work
+_batch = contextvars.ContextVar("upstream_batch", default=False)
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Bound the upstream calls made inside the block to `seconds` from now (or an earlier enclosing deadline)"""
+    until = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(until if current is None else min(current, until))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None without one"""
+    until = _deadline.get()
+    return None if until is None else until - time.monotonic()
+
+
+@contextmanager
+def batch_priority():
+    """Make the upstream calls inside the block batch work, which waits for spare capacity"""
+    token = _batch.set(True)
+    try:
+        yield
+    finally:
+        _batch.reset(token)
+
+
+def with_deadline(seconds: float):
+    """Decorator for (sync or async) views: the request's upstream calls share a deadline"""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                with deadline(seconds):
+                    return await view(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with deadline(seconds):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error is transient: timeouts, connection errors and HTTP 408, 429 and 5xx"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, OSError):  # Includes TimeoutError and the requests library's connection errors
+        return True
+    code = getattr(error, 'code', None)  # google.api_core exceptions carry the HTTP status
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Closed until `failure_threshold` consecutive failures, then open for
+    `reset_seconds`, then half-open: one probe call decides whether it closes
+    or opens again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._state, self._probing = "half_open", False
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may be made now; in the half-open state only the first caller probes"""
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state, self._failures, self._probing = "closed", 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._current_state() == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self.times_opened += 1
+                self._state, self._opened_at, self._probing = "open", time.monotonic(), False
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            retry_in = None
+            if state == "open":
+                retry_in = round(max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at)), 1)
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_seconds': self.reset_seconds,
+                'probe_in_seconds': retry_in,
+                'times_opened': self.times_opened,
+            }
+
+
+class UpstreamClient:
+    """Makes calls of one kind ("embed", "generate") with timeouts, retries, a circuit breaker and hedging"""
+
+    def __init__(self, name: str, timeout: float, max_attempts: int = 3, backoff_base: float = 0.2,
+                 backoff_max: float = 2.0, breaker: CircuitBreaker = None, hedge: bool = False,
+                 hedge_quantile: float = 0.95, max_workers: int = 32, batch_limit: int = None):
+        self.name = name
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"upstream-{name}")
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._latency_lock = threading.Lock()
+        self.batch_limit = batch_limit
+        self.in_flight = 0
+        self.batch_wait_seconds = 0.0
+        self._capacity = threading.Condition()
+
+    # --- Shared by the sync and async paths -------------------------------
+
+    def hedge_delay(self):
+        """Seconds after which an attempt is hedged: the recent p95 latency, None until there are enough samples"""
+        with self._latency_lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            recent = sorted(self._latencies)
+        return recent[min(len(recent) - 1, int(self.hedge_quantile * len(recent)))]
+
+    def _observe(self, seconds: float):
+        with self._latency_lock:
+            self._latencies.append(seconds)
+
+    @contextmanager
+    def _slot(self, wait: bool = True):
+        """Count a call as in flight; batch calls first wait until fewer than `batch_limit` are"""
+        with self._capacity:
+            if wait and self.batch_limit and _batch.get():
+                started = time.monotonic()
+                try:
+                    while self.in_flight >= self.batch_limit:
+                        left = remaining()
+                        if left is not None and left <= 0:
+                            self._count("timeout")
+                            raise UpstreamTimeout(f"{self.name}: no spare capacity for a batch call before the deadline")
+                        self._capacity.wait(timeout=left)
+                finally:
+                    self.batch_wait_seconds += time.monotonic() - started
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._capacity:
+                self.in_flight -= 1
+                self._capacity.notify()
+
+    def _count(self, result: str):
+        metrics.upstream_calls_total.inc(call=self.name, result=result)
+
+    def _attempt_timeout(self) -> float:
+        """Timeout of the next attempt; raises if the breaker is open or the deadline has passed"""
+        left = remaining()
+        if left is not None and left <= 0:
+            self._count("timeout")
+            raise UpstreamTimeout(f"{self.name}: request deadline exceeded")
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        return self.timeout if left is None else min(self.timeout, left)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Record a failed attempt; the backoff before the next one, or re-raise if there is none"""
+        if not is_retryable(error):
+            self.breaker.record_success()  # The upstream answered; the request itself was bad
+            self._count("error")
+            raise error
+        self.breaker.record_failure()
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        left = remaining()
+        if attempt >= self.max_attempts or (left is not None and left <= delay):
+            self._count("timeout" if isinstance(error, TimeoutError) else "error")
+            raise error
+        metrics.upstream_retries_total.inc(call=self.name)
+        print(f"⚠️ {self.name} call failed ({error!r}), retrying in {delay:.2f}s")
+        return delay
+
+    def _succeeded(self, started: float):
+        self.breaker.record_success()
+        self._observe(time.monotonic() - started)
+        self._count("ok")
+
+    def _hedged(self, winner: str):
+        metrics.upstream_hedges_total.inc(call=self.name, winner=winner)
+
+    # --- Synchronous calls -----------------------------------------------
+
+    def call(self, fn, *args, hedge: bool = True):
+        """fn(*args) with retries; raises the last error, CircuitOpenError or UpstreamTimeout"""
+        with self._slot():
+            return self._call(fn, args, hedge)
+
+    def _call(self, fn, args: tuple, hedge: bool):
+        for attempt in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout()
+            started = time.monotonic()
+            try:
+                result = self._attempt(fn, args, timeout, hedge and self.hedge)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt))
+            else:
+                self._succeeded(started)
+                return result
+
+    def _attempt(self, fn, args: tuple, timeout: float, hedge: bool):
+        """One attempt on the thread pool, plus a hedged duplicate if the first is slow"""
+        started = time.monotonic()
+        futures = [self._executor.submit(fn, *args)]
+        delay = self.hedge_delay() if hedge else None
+        if delay is not None and delay < timeout:
+            if not wait(futures, timeout=delay).done:
+                futures.append(self._executor.submit(fn, *args))
+
+        pending, error = set(futures), None
+        while pending:
+            left = started + timeout - time.monotonic()
+            if left <= 0:
+                break
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if len(futures) > 1:
+                        self._hedged("primary" if future is futures[0] else "hedge")
+                    return future.result()
+                error = future.exception()
+        for future in pending:
+            future.cancel()
+        if error is not None and not pending:
+            raise error
+        raise UpstreamTimeout(f"{self.name} attempt timed out after {timeout:.1f}s")
+
+    def stream(self, open_stream):
+        """Yield the items of open_stream(); opening it and getting the first item are retried, later failures raised"""
+        with self._slot():
+            iterator, item = self._call(_open_first, (open_stream,), False)
+            while item is not _END:
+                yield item
+                future = self._executor.submit(next, iterator, _END)
+                try:
+                    item = future.result(timeout=self.timeout)
+                except Exception as e:
+                    if is_retryable(e):
+                        self.breaker.record_failure()
+                    self._count("stream_error")
+                    if isinstance(e, TimeoutError):
+                        raise UpstreamTimeout(f"{self.name} stream stalled for {self.timeout:.1f}s") from e
+                    raise
+
+    # --- Async calls -----------------------------------------------------
+
+    async def call_async(self, make_coro, hedge: bool = True):
+        """await make_coro() with retries; a new coroutine is made for every attempt"""
+        with self._slot(wait=False):  # Counted only: waiting here would block the event loop
+            return await self._call_async(make_coro, hedge)
+
+    async def _call_async(self, make_coro, hedge: bool):
+        for attempt in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout()
+            started = time.monotonic()
+            try:
+                result = await self._attempt_async(make_coro, timeout, hedge and self.hedge)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+            else:
+                self._succeeded(started)
+                return result
+
+    async def _attempt_async(self, make_coro, timeout: float, hedge: bool):
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(make_coro())]
+        try:
+            delay = self.hedge_delay() if hedge else None
+            if delay is not None and delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    tasks.append(asyncio.ensure_future(make_coro()))
+
+            pending, error = set(tasks), None
+            while pending:
+                left = started + timeout - time.monotonic()
+                if left <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            self._hedged("primary" if task is tasks[0] else "hedge")
+                        return task.result()
+                    error = task.exception()
+            if error is not None and not pending:
+                raise error
+            raise UpstreamTimeout(f"{self.name} attempt timed out after {timeout:.1f}s")
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream_async(self, open_stream):
+        """Async version of `stream`: `await open_stream()` returns an async iterator"""
+        async def open_first():
+            iterator = (await open_stream()).__aiter__()
+            return iterator, await anext(iterator, _END)
+
+        with self._slot(wait=False):
+            iterator, item = await self._call_async(open_first, False)
+            while item is not _END:
+                yield item
+                try:
+                    item = await asyncio.wait_for(anext(iterator, _END), timeout=self.timeout)
+                except Exception as e:
+                    if is_retryable(e):
+                        self.breaker.record_failure()
+                    self._count("stream_error")
+                    if isinstance(e, TimeoutError):
+                        raise UpstreamTimeout(f"{self.name} stream stalled for {self.timeout:.1f}s") from e
+                    raise
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay() if self.hedge else None
+        return {
+            'breaker': self.breaker.stats(),
+            'timeout_seconds': self.timeout,
+            'max_attempts': self.max_attempts,
+            'hedging': self.hedge,
+            'hedge_delay_ms': round(delay * 1000, 1) if delay is not None else None,
+            'in_flight': self.in_flight,
+            'batch_limit': self.batch_limit,
+            'batch_wait_seconds': round(self.batch_wait_seconds, 3),
+            'calls': {result: metrics.upstream_calls_total.value(call=self.name, result=result)
+                      for result in CALL_RESULTS},
+            'retries': metrics.upstream_retries_total.value(call=self.name),
+            'hedges': {winner: metrics.upstream_hedges_total.value(call=self.name, winner=winner)
+                       for winner in ("primary", "hedge")},
+        }
+
+
+def _open_first(open_stream) -> tuple:
+    """Open a stream and read its first item (_END if it is empty)"""
+    iterator = iter(open_stream())
+    return iterator, next(iterator, _END)